@@ -8,6 +8,11 @@ from trytond.pool import Pool
 from sale import Sale, SaleChannel, SaleLine, SaleConfiguration
 from address import Address
 from shipment import ShipmentOut, ShipmentOutReturn
+from request import POSRequest
+from product import Product
+from summary import SaleChannelDailySummary
+from session import POSCartJournal
+from static_file import NereidStaticFile
 
 
 def register():
@@ -19,5 +24,10 @@ def register():
         ShipmentOutReturn,
         Address,
         SaleConfiguration,
+        POSRequest,
+        Product,
+        SaleChannelDailySummary,
+        POSCartJournal,
+        NereidStaticFile,
         module='pos', type_='model'
     )
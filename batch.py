@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+    batch.py
+
+"""
+import logging
+from multiprocessing.pool import ThreadPool
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.transaction import Transaction
+from trytond.exceptions import UserError
+
+__all__ = ['process_in_chunks']
+
+logger = logging.getLogger('pos')
+
+
+def _message(exception):
+    if isinstance(exception, UserError):
+        return exception.message
+    return repr(exception)
+
+
+def _process_chunk(database_name, user, context, function, ids):
+    """
+    Call the function for each id in a transaction of its own for the
+    chunk. When the function fails for an id, the transaction is rolled
+    back, the failure is recorded and the chunk is retried without it. When
+    the commit fails, the failure is recorded for all the ids of the chunk.
+
+    A DatabaseOperationalError (a serialization failure or a lock timeout,
+    as the terminals may change the same sales) is not a failure of the id:
+    the chunk is retried up to the `retry` option of the [database] section
+    of the configuration, like the dispatcher retries the RPCs, and then
+    recorded as failed for all its ids.
+
+    Returns the list of processed ids and a list of (id, error message).
+    """
+    DatabaseOperationalError = backend.get('DatabaseOperationalError')
+
+    retries = config.getint('database', 'retry')
+    pending = list(ids)
+    failures = []
+    while True:
+        current = None
+        with Transaction().start(
+                database_name, user, context=context) as transaction:
+            Cache.clean(database_name)
+            try:
+                for current in pending:
+                    function(current)
+                current = None
+                transaction.cursor.commit()
+            except DatabaseOperationalError, exception:
+                transaction.cursor.rollback()
+                if retries:
+                    retries -= 1
+                    logger.info(
+                        'Batch processing of %s retried: %s', pending,
+                        exception
+                    )
+                    continue
+            except Exception, exception:
+                transaction.cursor.rollback()
+                if current is not None:
+                    logger.info(
+                        'Batch processing of %s failed: %s', current,
+                        exception
+                    )
+                    failures.append((current, _message(exception)))
+                    pending.remove(current)
+                    continue
+            else:
+                Cache.resets(database_name)
+                return pending, failures
+        logger.info(
+            'Batch processing of %s failed: %s', pending, exception
+        )
+        message = _message(exception)
+        failures.extend((id_, message) for id_ in pending)
+        return [], failures
+
+
+def process_in_chunks(ids, function, chunk_size=20, workers=4):
+    """
+    Call the function with each id, partitioned into chunks processed in
+    their own transaction by a pool of worker threads.
+
+    The database, user and context are the ones of the current transaction,
+    which is not used by the workers: only committed data is visible to
+    them. SQLite serializes writing transactions, so a single worker is
+    used on SQLite.
+
+    The progress is logged after each chunk.
+
+    Returns the list of processed ids and a list of (id, error message) for
+    the ids the function failed on, which do not abort the batch.
+    """
+    transaction = Transaction()
+    database_name = transaction.cursor.database_name
+    user = transaction.user
+    context = transaction.context.copy()
+
+    if backend.name() == 'sqlite':
+        workers = 1
+
+    chunks = [
+        ids[i:i + chunk_size] for i in xrange(0, len(ids), chunk_size)
+    ]
+    pool = ThreadPool(max(1, min(workers, len(chunks))))
+    results = []
+    try:
+        for result in pool.imap(
+                lambda chunk: _process_chunk(
+                    database_name, user, context, function, chunk
+                ), chunks):
+            results.append(result)
+            logger.info(
+                'Batch processing: %s/%s chunks done', len(results),
+                len(chunks)
+            )
+    finally:
+        pool.close()
+        pool.join()
+
+    processed, failures = [], []
+    for chunk_processed, chunk_failures in results:
+        processed.extend(chunk_processed)
+        failures.extend(chunk_failures)
+    return processed, failures
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks/__init__.py
+
+    Performance benchmarks for the POS module. These are not part of the
+    test suite and are run by hand, for example::
+
+        python -m benchmarks.line_lookup --max-rows 1048576
+        python -m benchmarks.hot_paths --output results.json
+        DB_NAME=load TRYTOND_CONFIG=trytond.conf python -m benchmarks.load
+        python -m benchmarks.encoding --cart-sizes 10,100
+
+"""
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks/encoding.py
+
+    Compare the size and the encode and decode times of the POS responses
+    in JSON, as sent by the JSON-RPC protocol of trytond, and packed with
+    MessagePack (see binary.py).
+
+    Usage::
+
+        python -m benchmarks.encoding [--cart-sizes 1,10,100]
+            [--recent-sales 20] [--repeat R] [--output FILE]
+
+    The responses are the ones of pos_serialize for carts of each size,
+    with the lines as a list and in the columnar format (see columnar.py),
+    and of get_recent_sales. They are encoded as:
+
+        * json: the JSON-RPC encoding of the response.
+        * msgpack: the packed response, as sent by a binary transport.
+        * msgpack+json: the packed response returned by the RPC as a buffer
+          in JSON-RPC, which encodes it in base64.
+
+    The database is picked from TRYTOND_DATABASE_URI and DB_NAME like the
+    test suite does (defaults to an in memory SQLite database).
+"""
+import os
+import json
+import argparse
+from datetime import datetime
+
+os.environ.setdefault('TRYTOND_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('DB_NAME', ':memory:')
+
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT  # noqa
+from trytond.transaction import Transaction  # noqa
+from trytond.protocols import jsonrpc  # noqa
+from trytond import backend  # noqa
+
+from tests.test_sale import TestSale  # noqa
+from trytond.modules.pos.binary import pack, unpack  # noqa
+from benchmarks.hot_paths import Fixtures, measure, median, sizes  # noqa
+
+ENCODINGS = ['json', 'msgpack', 'msgpack+json']
+
+
+def to_json(value):
+    return jsonrpc.json.dumps(value, cls=jsonrpc.JSONEncoder)
+
+
+def from_json(data):
+    return jsonrpc.json.loads(data, object_hook=jsonrpc.JSONDecoder())
+
+
+# Encoding name to (encode, decode)
+CODECS = {
+    'json': (to_json, from_json),
+    'msgpack': (pack, unpack),
+    'msgpack+json': (
+        lambda value: to_json(buffer(pack(value))),
+        lambda data: unpack(from_json(data)),
+    ),
+}
+
+
+def bench_payload(payload, repeat):
+    """
+    Return the size in bytes and the median encode and decode times in
+    milliseconds of the payload for each encoding
+    """
+    results = {}
+    for encoding in ENCODINGS:
+        encode, decode = CODECS[encoding]
+        data = encode(payload)
+        results[encoding] = {
+            'bytes': len(data),
+            'encode_ms': median(measure(lambda: encode(payload), repeat)),
+            'decode_ms': median(measure(lambda: decode(data), repeat)),
+        }
+    return results
+
+
+def payloads(fixtures, cart_sizes, recent_sales):
+    """
+    Return the (name, cart size, response) of the POS RPCs to encode
+    """
+    Sale = POOL.get('sale.sale')
+
+    result = []
+    for cart_size in cart_sizes:
+        cart = fixtures.cart(cart_size)
+        result.append(
+            ('pos_serialize', cart_size, Sale(cart.id).pos_serialize())
+        )
+        with Transaction().set_context(pos_line_format='columnar'):
+            result.append((
+                'pos_serialize columnar', cart_size,
+                Sale(cart.id).pos_serialize()
+            ))
+    for _ in xrange(recent_sales):
+        fixtures.cart(1)
+    with Transaction().set_context(current_channel=fixtures.channels[0].id):
+        result.append(('get_recent_sales', 0, Sale.get_recent_sales()))
+    return result
+
+
+def run(cart_sizes, recent_sales, repeat):
+    # Installs the module and gives access to the fixtures of the tests
+    case = TestSale('test_0010_test_sale')
+    case.setUp()
+
+    results = []
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        fixtures = Fixtures(case, max(cart_sizes))
+        with Transaction().set_context(company=case.company.id):
+            responses = payloads(fixtures, cart_sizes, recent_sales)
+        transaction.cursor.rollback()
+
+    for name, cart_size, payload in responses:
+        encodings = bench_payload(payload, repeat)
+        for encoding in ENCODINGS:
+            result = dict(
+                encodings[encoding], response=name, cart_size=cart_size,
+                encoding=encoding,
+            )
+            print '%-24s %6d %-14s %10d %12.3f %12.3f' % (
+                name, cart_size, encoding, result['bytes'],
+                result['encode_ms'], result['decode_ms'],
+            )
+            results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--cart-sizes', type=sizes, default=[1, 10, 100],
+        help='Comma separated numbers of lines of the carts'
+    )
+    parser.add_argument(
+        '--recent-sales', type=int, default=20,
+        help='Number of sales returned by get_recent_sales'
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=200,
+        help='Number of encodings and decodings measured for each response'
+    )
+    parser.add_argument(
+        '--output', help='Write the results as JSON to this file'
+    )
+    args = parser.parse_args()
+
+    print '%-24s %6s %-14s %10s %12s %12s' % (
+        'response', 'cart', 'encoding', 'bytes', 'encode (ms)',
+        'decode (ms)'
+    )
+    results = run(args.cart_sizes, args.recent_sales, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({
+                'backend': backend.name(),
+                'date': datetime.now().isoformat(),
+                'repeat': args.repeat,
+                'results': results,
+            }, output_file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks/hot_paths.py
+
+    Measure the POS entry points (pos_add_product, pos_serialize,
+    get_recent_sales, round_down_total and create_shipment) across cart
+    sizes and table sizes.
+
+    Usage::
+
+        python -m benchmarks.hot_paths [--cart-sizes 1,10,100]
+            [--table-sizes 0,1000,10000] [--repeat R] [--output FILE]
+            [--baseline FILE] [--tolerance T]
+
+    Synthetic channels, products and parties are created with the fixtures
+    of the test suite. The table size is the number of other sales (with
+    their lines) in the database, spread over the channels and mostly done
+    and old, like the history of a shop.
+
+    The results are printed and, with --output, written as JSON. With
+    --baseline, the medians are compared to the ones of a previous output
+    and the command fails if one of them is slower by more than the
+    tolerance (default 25%).
+
+    The database is picked from TRYTOND_DATABASE_URI and DB_NAME like the
+    test suite does (defaults to an in memory SQLite database).
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from sql import Table
+from sql.aggregate import Max
+
+os.environ.setdefault('TRYTOND_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('DB_NAME', ':memory:')
+
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT  # noqa
+from trytond.transaction import Transaction  # noqa
+from trytond import backend  # noqa
+
+from tests.test_sale import TestSale  # noqa
+from benchmarks.line_lookup import grow_sales, grow_lines  # noqa
+
+ENTRY_POINTS = [
+    'pos_add_product', 'pos_serialize', 'get_recent_sales',
+    'round_down_total', 'create_shipment',
+]
+CHANNELS = 4
+PARTIES = 10
+
+
+def measure(function, repeat):
+    """
+    Return the durations of `repeat` calls in milliseconds
+    """
+    durations = []
+    for _ in xrange(repeat):
+        start = time.time()
+        function()
+        durations.append((time.time() - start) * 1000.0)
+    return durations
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class Fixtures(object):
+    """
+    Synthetic data of the benchmark, on top of the test fixtures
+    """
+
+    def __init__(self, case, products):
+        pool = POOL
+        Party = pool.get('party.party')
+        Channel = pool.get('sale.channel')
+
+        case.setup_defaults()
+        self.case = case
+        self.channels = [case.channel] + Channel.copy(
+            [case.channel] * (CHANNELS - 1)
+        )
+        self.parties = Party.create([{
+            'name': 'Party %s' % i,
+            'addresses': [('create', [{'name': 'Party %s' % i}])],
+        } for i in xrange(PARTIES)])
+        templates = case._create_product_template('product', [{
+            'category': case.category.id,
+            'type': 'goods',
+            'salable': True,
+            'list_price': Decimal('10') + i,
+            'cost_price': Decimal('5'),
+            'account_expense': case._get_account_by_kind('expense').id,
+            'account_revenue': case._get_account_by_kind('revenue').id,
+        } for i in xrange(products)])
+        self.products = [template.products[0] for template in templates]
+        self.carts = 0
+
+    def cart(self, size, delivery_mode='pick_up'):
+        """
+        Return a new draft sale of the first channel with `size` lines
+        """
+        Sale = POOL.get('sale.sale')
+
+        party = self.parties[self.carts % len(self.parties)]
+        self.carts += 1
+        sale, = Sale.create([{
+            'party': party.id,
+            'invoice_address': party.addresses[0].id,
+            'shipment_address': party.addresses[0].id,
+            'currency': self.case.usd.id,
+            'company': self.case.company.id,
+            'channel': self.channels[0].id,
+            'invoice_method': 'order',
+            'shipment_method': 'order',
+        }])
+        sale.pos_apply_operations([{
+            'type': 'set',
+            'product': product.id,
+            'delivery_mode': delivery_mode,
+            'quantity': 1,
+        } for product in self.products[:size]])
+        return Sale(sale.id)
+
+    def grow(self, cursor, template, count):
+        """
+        Add `count` copies of the template sale and its lines, spread over
+        the channels, done and created a month ago
+        """
+        if count <= 0:
+            return
+        sale = Table('sale_sale')
+        cursor.execute(*sale.select(Max(sale.id)))
+        last_sale_id = cursor.fetchone()[0]
+        grow_sales(cursor, template.id, count)
+        grow_lines(cursor, template.id, last_sale_id)
+
+        old = datetime.now() - timedelta(days=30)
+        for i, channel in enumerate(self.channels):
+            cursor.execute(*sale.update(
+                [sale.channel, sale.state, sale.create_date, sale.write_date],
+                [channel.id, 'done', old, old],
+                where=(
+                    (sale.id > last_sale_id) &
+                    (sale.id % len(self.channels) == i)
+                )
+            ))
+
+
+def bench_cart(fixtures, cart_size, repeat):
+    """
+    Return the durations of each entry point for a cart of the size
+    """
+    Sale = POOL.get('sale.sale')
+
+    cart = fixtures.cart(cart_size)
+    product = fixtures.products[0]
+    durations = {}
+
+    durations['pos_add_product'] = measure(
+        lambda: cart.pos_add_product([product.id], 2), repeat
+    )
+    durations['pos_serialize'] = measure(
+        lambda: Sale(cart.id).pos_serialize(), repeat
+    )
+    with Transaction().set_context(current_channel=fixtures.channels[0].id):
+        durations['get_recent_sales'] = measure(Sale.get_recent_sales, repeat)
+    durations['round_down_total'] = measure(
+        lambda: Sale.round_down_total([Sale(cart.id)]), repeat
+    )
+
+    # Shipments are created once per sale, so each call gets its own
+    confirmed = []
+    for _ in xrange(repeat):
+        sale = fixtures.cart(cart_size, 'ship')
+        Sale.quote([sale])
+        Sale.confirm([sale])
+        confirmed.append(Sale(sale.id))
+    confirmed.reverse()
+    durations['create_shipment'] = measure(
+        lambda: confirmed.pop().create_shipment('out'), repeat
+    )
+    return durations
+
+
+def run(cart_sizes, table_sizes, repeat):
+    # Installs the module and gives access to the fixtures of the tests
+    case = TestSale('test_0010_test_sale')
+    case.setUp()
+
+    results = []
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        cursor = transaction.cursor
+        fixtures = Fixtures(case, max(cart_sizes))
+
+        with Transaction().set_context(company=case.company.id):
+            template = fixtures.cart(10)
+            table_size = 0
+            for size in sorted(table_sizes):
+                fixtures.grow(cursor, template, size - table_size)
+                table_size = size
+                for cart_size in cart_sizes:
+                    durations = bench_cart(fixtures, cart_size, repeat)
+                    for entry_point in ENTRY_POINTS:
+                        values = durations[entry_point]
+                        result = {
+                            'entry_point': entry_point,
+                            'cart_size': cart_size,
+                            'table_size': table_size,
+                            'mean_ms': sum(values) / len(values),
+                            'median_ms': median(values),
+                            'min_ms': min(values),
+                        }
+                        print '%-18s %10d %10d %12.3f %12.3f' % (
+                            entry_point, cart_size, table_size,
+                            result['mean_ms'], result['median_ms'],
+                        )
+                        results.append(result)
+
+        transaction.cursor.rollback()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the ratio of the medians to the baseline and return the results
+    slower than the baseline by more than the tolerance
+    """
+    def key(result):
+        return (
+            result['entry_point'], result['cart_size'], result['table_size']
+        )
+
+    reference = dict((key(r), r) for r in baseline['results'])
+    regressions = []
+    print
+    print '%-18s %10s %10s %12s' % (
+        'entry point', 'cart', 'table', 'vs baseline'
+    )
+    for result in results:
+        base = reference.get(key(result))
+        if not base or not base['median_ms']:
+            continue
+        ratio = result['median_ms'] / base['median_ms']
+        print '%-18s %10d %10d %11.2fx' % (key(result) + (ratio,))
+        if ratio > 1 + tolerance:
+            regressions.append(result)
+    return regressions
+
+
+def sizes(value):
+    return [int(size) for size in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--cart-sizes', type=sizes, default=[1, 10, 100],
+        help='Comma separated numbers of lines of the carts'
+    )
+    parser.add_argument(
+        '--table-sizes', type=sizes, default=[0, 1000, 10000],
+        help='Comma separated numbers of other sales in the database'
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=20,
+        help='Number of calls measured for each entry point'
+    )
+    parser.add_argument(
+        '--output', help='Write the results as JSON to this file'
+    )
+    parser.add_argument(
+        '--baseline', help='Compare the results to this previous output'
+    )
+    parser.add_argument(
+        '--tolerance', type=float, default=0.25,
+        help='Slowdown allowed against the baseline (default 0.25)'
+    )
+    args = parser.parse_args()
+
+    print '%-18s %10s %10s %12s %12s' % (
+        'entry point', 'cart', 'table', 'mean (ms)', 'median (ms)'
+    )
+    results = run(args.cart_sizes, args.table_sizes, args.repeat)
+    output = {
+        'backend': backend.name(),
+        'date': datetime.now().isoformat(),
+        'repeat': args.repeat,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(output, output_file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print
+            print '%s regressions beyond %d%%' % (
+                len(regressions), args.tolerance * 100
+            )
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks/line_lookup.py
+
+    Measure the sale line lookups done by the POS while the sale_line table
+    grows. The lookups (Sale.pos_find_sale_line_domain and the round off
+    line search in Sale.round_down_total) are backed by composite indexes
+    and their timings should stay flat as the table grows.
+
+    Usage::
+
+        python -m benchmarks.line_lookup [--max-rows N] [--without-index]
+
+    The database is picked from TRYTOND_DATABASE_URI and DB_NAME like the
+    test suite does (defaults to an in memory SQLite database).
+"""
+import os
+import time
+import argparse
+
+from sql import Table, Column, Literal
+from sql.aggregate import Count, Max
+
+os.environ.setdefault('TRYTOND_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('DB_NAME', ':memory:')
+
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT  # noqa
+from trytond.transaction import Transaction  # noqa
+from trytond import backend  # noqa
+
+from tests.test_sale import TestSale  # noqa
+
+INDEXES = [
+    ['sale', 'product', 'delivery_mode'],
+    ['sale', 'is_round_off'],
+]
+
+
+def table_columns(cursor, table_name):
+    """
+    Return the columns of the table except the id
+    """
+    cursor.execute('SELECT * FROM "%s" WHERE 1 = 0' % table_name)
+    return [c[0] for c in cursor.description if c[0] != 'id']
+
+
+def grow_sales(cursor, sale_id, count):
+    """
+    Create `count` copies of the given sale. Rows are copied with
+    INSERT ... SELECT, which is the only reasonable way to reach millions
+    of rows in a benchmark.
+    """
+    sale = Table('sale_sale')
+    columns = [
+        Column(sale, c) for c in table_columns(cursor, 'sale_sale')
+    ]
+    cursor.execute(*sale.insert(
+        columns, sale.select(*columns, where=(sale.id == sale_id))
+    ))
+    created = 1
+    while created < count:
+        cursor.execute(*sale.insert(columns, sale.select(
+            *columns, where=(sale.id > sale_id), limit=count - created
+        )))
+        created += cursor.rowcount
+
+
+def grow_lines(cursor, template_sale_id, first_sale_id):
+    """
+    Copy the lines of the template sale to every sale created after
+    `first_sale_id`
+    """
+    line = Table('sale_line')
+    sale = Table('sale_sale')
+    names = [
+        c for c in table_columns(cursor, 'sale_line') if c != 'sale'
+    ]
+    query = line.join(
+        sale, condition=(sale.id > first_sale_id)
+    ).select(
+        *([Column(line, c) for c in names] + [sale.id]),
+        where=(line.sale == template_sale_id)
+    )
+    cursor.execute(*line.insert(
+        [Column(line, c) for c in names] + [line.sale], query
+    ))
+
+
+def line_count(cursor):
+    line = Table('sale_line')
+    cursor.execute(*line.select(Count(Literal(1))))
+    return cursor.fetchone()[0]
+
+
+def timeit(function, repeat):
+    """
+    Return the average time of a call in milliseconds
+    """
+    start = time.time()
+    for _ in xrange(repeat):
+        function()
+    return (time.time() - start) * 1000.0 / repeat
+
+
+def run(max_rows, repeat, without_index):
+    TableHandler = backend.get('TableHandler')
+
+    # Installs the module and gives access to the fixtures of the tests
+    case = TestSale('test_0010_test_sale')
+    case.setUp()
+    Sale = POOL.get('sale.sale')
+    SaleLine = POOL.get('sale.line')
+
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        case.setup_defaults()
+        cursor = transaction.cursor
+
+        if without_index:
+            table = TableHandler(cursor, SaleLine, 'pos')
+            for columns in INDEXES:
+                table.index_action(columns, 'remove')
+
+        with Transaction().set_context(use_anonymous_customer=True):
+            sale, = Sale.create([{'currency': case.usd.id}])
+
+        with Transaction().set_context(
+                company=case.company.id, channel=case.channel.id):
+            for delivery_mode in ('pick_up', 'ship'):
+                with Transaction().set_context(delivery_mode=delivery_mode):
+                    sale.pos_add_product([
+                        case.product1.id, case.product2.id, case.product3.id
+                    ], 1)
+            Sale.round_down_total([sale])
+
+        def find_line():
+            with Transaction().set_context(
+                    product=case.product2.id, delivery_mode='ship'):
+                SaleLine.search(sale.pos_find_sale_line_domain())
+
+        def find_round_off():
+            SaleLine.search([
+                ('sale', '=', sale.id),
+                ('is_round_off', '=', True),
+            ])
+
+        print '%12s %20s %20s' % ('lines', 'find line (ms)', 'round off (ms)')
+        sales = 1
+        while True:
+            rows = line_count(cursor)
+            print '%12d %20.3f %20.3f' % (
+                rows, timeit(find_line, repeat),
+                timeit(find_round_off, repeat),
+            )
+            if rows * 2 > max_rows:
+                break
+            sale_table = Table('sale_sale')
+            cursor.execute(*sale_table.select(Max(sale_table.id)))
+            last_sale_id = cursor.fetchone()[0]
+            grow_sales(cursor, sale.id, sales)
+            grow_lines(cursor, sale.id, last_sale_id)
+            sales *= 2
+
+        transaction.cursor.rollback()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--max-rows', type=int, default=2 ** 20,
+        help='Stop once sale_line would grow beyond this many rows'
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=200,
+        help='Number of lookups averaged at each table size'
+    )
+    parser.add_argument(
+        '--without-index', action='store_true',
+        help='Drop the composite indexes first, for comparison'
+    )
+    args = parser.parse_args()
+    run(args.max_rows, args.repeat, args.without_index)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks/load.py
+
+    Simulate terminals of several channels selling at the same time to
+    reproduce the contention of a shop under load.
+
+    Usage::
+
+        python -m benchmarks.load [--terminals 8] [--channels 2]
+            [--duration 30] [--cart-size 10] [--shared 0.1] [--seed S]
+            [--output FILE]
+
+    Each terminal is a thread running sessions like a cashier: it opens a
+    cart, scans products with pos_add_product, edits quantities with
+    pos_update_lines, polls pos_serialize, looks up get_recent_sales and
+    checks out with pos_checkout. Each call is a transaction of its own and
+    is retried on DatabaseOperationalError like the dispatcher of trytond
+    does. With --shared, this fraction of the scans goes to the open cart of
+    another terminal of the channel, contending on the same sale rows.
+
+    The throughput, the latency percentiles of each call and the number of
+    serialization failures, lock errors (lock timeouts, deadlocks, locked
+    SQLite database) and other errors are printed and, with --output,
+    written as JSON.
+
+    The database is picked from TRYTOND_DATABASE_URI and DB_NAME like the
+    test suite does and is created by the run with the fixtures of the test
+    suite, so each run needs a new name. It must be shared by the threads: a
+    PostgreSQL database or a SQLite file (DB_NAME in the `path` of the
+    [database] section of TRYTOND_CONFIG), not an in memory one.
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from datetime import datetime
+from collections import defaultdict
+
+from trytond.config import config
+config.update_etc()
+
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT  # noqa
+from trytond.transaction import Transaction  # noqa
+from trytond.cache import Cache  # noqa
+from trytond.exceptions import UserError  # noqa
+from trytond import backend  # noqa
+
+from tests.test_sale import TestSale  # noqa
+from benchmarks.hot_paths import Fixtures  # noqa
+
+CALLS = [
+    'open', 'pos_add_product', 'pos_update_lines', 'pos_serialize',
+    'get_recent_sales', 'pos_checkout',
+]
+LOCK_MESSAGES = ('lock', 'deadlock')
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, percent):
+    """
+    Return the percentile of the values by the nearest rank
+    """
+    values = sorted(values)
+    if not values:
+        return 0.0
+    rank = max(int(round(len(values) * percent / 100.0)), 1)
+    return values[rank - 1]
+
+
+class Stats(object):
+    """
+    Latencies and failures of the calls of all the terminals
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = defaultdict(list)
+        self.retries = defaultdict(int)
+        self.failures = defaultdict(lambda: defaultdict(int))
+        # First message of each kind of failure of each call
+        self.messages = defaultdict(dict)
+
+    def add(self, name, duration, retries):
+        with self.lock:
+            self.durations[name].append(duration)
+            self.retries[name] += retries
+
+    def fail(self, name, exception):
+        kind = classify(exception)
+        if isinstance(exception, UserError):
+            message = exception.message
+        else:
+            message = repr(exception)
+        with self.lock:
+            self.failures[name][kind] += 1
+            self.messages[name].setdefault(kind, message)
+
+
+def classify(exception):
+    """
+    Return the kind of failure of the exception
+    """
+    DatabaseOperationalError = backend.get('DatabaseOperationalError')
+    if isinstance(exception, DatabaseOperationalError):
+        message = str(exception).lower()
+        if any(word in message for word in LOCK_MESSAGES):
+            return 'lock'
+        return 'serialization'
+    if isinstance(exception, UserError):
+        return 'user_error'
+    return 'error'
+
+
+class Terminal(threading.Thread):
+    """
+    A cashier of a channel, selling until the deadline
+    """
+
+    def __init__(self, number, channel, data, open_carts, stats, options):
+        super(Terminal, self).__init__(name='terminal-%s' % number)
+        self.number = number
+        self.channel = channel
+        self.data = data
+        # Open cart of each terminal of the channel, by terminal number
+        self.open_carts = open_carts
+        self.stats = stats
+        self.options = options
+        self.random = random.Random(options.seed + number)
+        self.sales = 0
+
+    def call(self, name, function):
+        """
+        Call the function in a transaction of its own, retried on
+        DatabaseOperationalError, and return its result or None on failure
+        """
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        context = dict(
+            CONTEXT, company=self.data['company'], channel=self.channel,
+            current_channel=self.channel, delivery_mode='pick_up',
+        )
+        retries = config.getint('database', 'retry')
+        start = time.time()
+        for count in range(retries, -1, -1):
+            with Transaction().start(
+                    DB_NAME, USER, context=context) as transaction:
+                Cache.clean(DB_NAME)
+                try:
+                    result = function()
+                    transaction.cursor.commit()
+                except DatabaseOperationalError, exception:
+                    transaction.cursor.rollback()
+                    self.stats.fail(name, exception)
+                    if count:
+                        continue
+                    return
+                except Exception, exception:
+                    transaction.cursor.rollback()
+                    self.stats.fail(name, exception)
+                    return
+                Cache.resets(DB_NAME)
+            self.stats.add(
+                name, (time.time() - start) * 1000.0, retries - count
+            )
+            return result
+
+    def open_cart(self):
+        Sale = POOL.get('sale.sale')
+
+        party, address = self.random.choice(self.data['parties'])
+        sale, = Sale.create([{
+            'party': party,
+            'invoice_address': address,
+            'shipment_address': address,
+            'currency': self.data['currency'],
+            'company': self.data['company'],
+            'channel': self.channel,
+            'invoice_method': 'order',
+            'shipment_method': 'order',
+        }])
+        return sale.id
+
+    def cart_to_scan(self, cart_id):
+        """
+        Return the own cart or, for the shared fraction of the scans, the
+        open cart of another terminal of the channel
+        """
+        if self.random.random() < self.options.shared:
+            others = [
+                other for number, other in self.open_carts.items()
+                if number != self.number and other
+            ]
+            if others:
+                return self.random.choice(others)
+        return cart_id
+
+    def session(self):
+        Sale = POOL.get('sale.sale')
+        options = self.options
+
+        cart_id = self.call('open', self.open_cart)
+        if cart_id is None:
+            return
+        self.open_carts[self.number] = cart_id
+        lines = []
+        for _ in xrange(self.random.randint(1, options.cart_size)):
+            product_id = self.random.choice(self.data['products'])
+            scanned_id = self.cart_to_scan(cart_id)
+            result = self.call(
+                'pos_add_product',
+                lambda: Sale(scanned_id).pos_add_product([product_id], 1)
+            )
+            if result and scanned_id == cart_id:
+                lines = [line['id'] for line in result['sale']['lines']]
+            if lines and self.random.random() < 0.2:
+                line_id = self.random.choice(lines)
+                quantity = self.random.randint(1, 5)
+                self.call(
+                    'pos_update_lines',
+                    lambda: Sale(cart_id).pos_update_lines([{
+                        'id': line_id, 'quantity': quantity,
+                    }])
+                )
+            if self.random.random() < 0.5:
+                self.call(
+                    'pos_serialize', lambda: Sale(cart_id).pos_serialize()
+                )
+        if self.random.random() < 0.3:
+            self.call('get_recent_sales', Sale.get_recent_sales)
+
+        self.open_carts[self.number] = None
+        if self.call(
+                'pos_checkout', lambda: Sale(cart_id).pos_checkout()):
+            self.sales += 1
+
+    def run(self):
+        deadline = time.time() + self.options.duration
+        while time.time() < deadline:
+            self.session()
+
+
+def setup(options):
+    """
+    Install the module, create and commit the fixtures and return the ids
+    used by the terminals
+    """
+    case = TestSale('test_0010_test_sale')
+    case.setUp()
+    Location = POOL.get('stock.location')
+    Inventory = POOL.get('stock.inventory')
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        fixtures = Fixtures(case, options.products)
+
+        # Enough stock for the pick ups of the whole run
+        warehouse, = Location.search([('code', '=', 'WH')])
+        inventory, = Inventory.create([{
+            'location': warehouse.storage_location,
+            'company': case.company.id,
+            'lines': [('create', [{
+                'product': product.id,
+                'quantity': 1000000,
+            } for product in fixtures.products])],
+        }])
+        Inventory.confirm([inventory])
+
+        data = {
+            'company': case.company.id,
+            'currency': case.usd.id,
+            'channels': [
+                channel.id
+                for channel in fixtures.channels[:options.channels]
+            ],
+            'products': [product.id for product in fixtures.products],
+            'parties': [
+                (party.id, party.addresses[0].id)
+                for party in fixtures.parties
+            ],
+        }
+        transaction.cursor.commit()
+    return data
+
+
+def run(options):
+    if DB_NAME == ':memory:':
+        raise SystemExit('The terminals need a database shared by threads')
+    data = setup(options)
+    channels = data['channels']
+    stats = Stats()
+    open_carts = defaultdict(dict)
+    terminals = [
+        Terminal(
+            number, channels[number % len(channels)], data,
+            open_carts[channels[number % len(channels)]], stats, options
+        ) for number in xrange(options.terminals)
+    ]
+    start = time.time()
+    for terminal in terminals:
+        terminal.start()
+    for terminal in terminals:
+        terminal.join()
+    elapsed = time.time() - start
+
+    results = []
+    for name in CALLS:
+        durations = stats.durations[name]
+        result = {
+            'call': name,
+            'calls': len(durations),
+            'throughput': len(durations) / elapsed,
+            'retries': stats.retries[name],
+            'failures': dict(stats.failures[name]),
+            'messages': stats.messages[name],
+        }
+        for percent in PERCENTILES:
+            result['p%s_ms' % percent] = percentile(durations, percent)
+        result['max_ms'] = max(durations) if durations else 0.0
+        results.append(result)
+    return {
+        'backend': backend.name(),
+        'date': datetime.now().isoformat(),
+        'terminals': options.terminals,
+        'channels': len(channels),
+        'duration': elapsed,
+        'sales': sum(terminal.sales for terminal in terminals),
+        'results': results,
+    }
+
+
+def report(output):
+    print '%-18s %8s %8s %10s %10s %10s %10s %8s %8s %8s' % (
+        'call', 'calls', 'per s', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)',
+        'max (ms)', 'retries', 'serial.', 'locks'
+    )
+    for result in output['results']:
+        failures = result['failures']
+        print '%-18s %8d %8.1f %10.1f %10.1f %10.1f %10.1f %8d %8d %8d' % (
+            result['call'], result['calls'], result['throughput'],
+            result['p50_ms'], result['p90_ms'], result['p99_ms'],
+            result['max_ms'], result['retries'],
+            failures.get('serialization', 0), failures.get('lock', 0),
+        )
+        for kind in ('user_error', 'error'):
+            if failures.get(kind):
+                print '%-18s %s %s, first: %s' % (
+                    '', failures[kind], kind, result['messages'][kind]
+                )
+    print
+    print '%s sales checked out in %.1f s by %s terminals of %s channels' % (
+        output['sales'], output['duration'], output['terminals'],
+        output['channels'],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--terminals', type=int, default=8,
+        help='Number of terminals selling at the same time'
+    )
+    parser.add_argument(
+        '--channels', type=int, default=2,
+        help='Number of channels the terminals are spread over (at most 4)'
+    )
+    parser.add_argument(
+        '--duration', type=float, default=30,
+        help='Seconds of selling'
+    )
+    parser.add_argument(
+        '--cart-size', type=int, default=10,
+        help='Maximum number of scans of a sale'
+    )
+    parser.add_argument(
+        '--products', type=int, default=50,
+        help='Number of products scanned'
+    )
+    parser.add_argument(
+        '--shared', type=float, default=0.0,
+        help='Fraction of the scans going to the cart of another terminal'
+    )
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='Seed of the random sessions'
+    )
+    parser.add_argument(
+        '--output', help='Write the results as JSON to this file'
+    )
+    options = parser.parse_args()
+
+    output = run(options)
+    report(output)
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            json.dump(output, output_file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+    binary.py
+
+    Binary encoding of the POS responses with MessagePack.
+
+    The values are encoded with the MessagePack types (strings are UTF-8 str
+    and never bin) and these extension types, whose data is ASCII text:
+
+        ====  ==========  ==========================================
+        code  type        data
+        ====  ==========  ==========================================
+        1     Decimal     str() of the decimal, e.g. ``12.50``
+        2     datetime    ISO 8601 without time zone (UTC), e.g.
+                          ``2015-06-01T10:20:30`` or with microseconds
+                          ``2015-06-01T10:20:30.500000``
+        3     date        ``2015-06-01``
+        4     time        ``10:20:30`` or ``10:20:30.500000``
+        ====  ==========  ==========================================
+"""
+import datetime
+from decimal import Decimal
+from functools import wraps
+
+import msgpack
+from trytond.transaction import Transaction
+
+__all__ = ['pack', 'unpack', 'packed']
+
+DECIMAL = 1
+DATETIME = 2
+DATE = 3
+TIME = 4
+
+
+def _default(value):
+    # datetime before date as it is a subclass
+    if isinstance(value, Decimal):
+        return msgpack.ExtType(DECIMAL, str(value))
+    if isinstance(value, datetime.datetime):
+        return msgpack.ExtType(DATETIME, value.isoformat())
+    if isinstance(value, datetime.date):
+        return msgpack.ExtType(DATE, value.isoformat())
+    if isinstance(value, datetime.time):
+        return msgpack.ExtType(TIME, value.isoformat())
+    raise TypeError('%r can not be packed' % (value,))
+
+
+def _parse(text, format_):
+    if '.' in text:
+        format_ += '.%f'
+    return datetime.datetime.strptime(text, format_)
+
+
+def _ext_hook(code, data):
+    if code == DECIMAL:
+        return Decimal(data)
+    if code == DATETIME:
+        return _parse(data, '%Y-%m-%dT%H:%M:%S')
+    if code == DATE:
+        return _parse(data, '%Y-%m-%d').date()
+    if code == TIME:
+        return _parse(data, '%H:%M:%S').time()
+    return msgpack.ExtType(code, data)
+
+
+def pack(value):
+    """
+    Return the MessagePack encoding of the value
+    """
+    return msgpack.packb(value, default=_default, use_bin_type=False)
+
+
+def unpack(data):
+    """
+    Return the value of the MessagePack encoding of pack
+    """
+    return msgpack.unpackb(
+        bytes(data), ext_hook=_ext_hook, raw=False, strict_map_key=False
+    )
+
+
+def packed(function):
+    """
+    Decorate a POS RPC to return its result packed by pack, as a buffer,
+    when the client gives `pos_encoding` 'msgpack' in the context.
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        result = function(*args, **kwargs)
+        if Transaction().context.get('pos_encoding') == 'msgpack':
+            return buffer(pack(result))
+        return result
+    return wrapper
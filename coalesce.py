@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+    coalesce.py
+
+"""
+import time
+from threading import Lock, Event
+
+__all__ = ['Coalescer']
+
+
+class _Batch(object):
+    __slots__ = ('sequence', 'event', 'result', 'failed')
+
+    def __init__(self):
+        self.sequence = 0
+        self.event = Event()
+        self.result = None
+        self.failed = False
+
+
+class Coalescer(object):
+    """
+    Coalesce calls for the same key arriving within a time window.
+
+    Every call waits for the window. Calls superseded by a later call for
+    the same key during that time do not run: only the last call runs and
+    its result is returned to all the callers of the batch. This is meant
+    for calls which set an absolute state, like the quantity of a line sent
+    by pos_add_product, where running only the last one gives the same
+    result as running all of them.
+
+    The coalescing is done between the threads of a process. If the last
+    call fails or does not complete in time, the superseded calls run
+    themselves. The superseded calls return as soon as the last call
+    returns, so they do not know whether what it did is eventually
+    committed.
+    """
+
+    def __init__(self, timeout=5):
+        self.timeout = timeout
+        self._lock = Lock()
+        self._batches = {}
+
+    def run(self, key, window, function):
+        """
+        Run the function unless it is superseded by a later call for the key
+        within `window` seconds, and return the result of the batch.
+        """
+        with self._lock:
+            batch = self._batches.setdefault(key, _Batch())
+            batch.sequence += 1
+            sequence = batch.sequence
+
+        time.sleep(window)
+
+        with self._lock:
+            last = batch.sequence == sequence
+            if last and self._batches.get(key) is batch:
+                # Later calls start a new batch
+                del self._batches[key]
+
+        if last:
+            try:
+                batch.result = function()
+            except Exception:
+                batch.failed = True
+                raise
+            finally:
+                batch.event.set()
+            return batch.result
+
+        if batch.event.wait(self.timeout) and not batch.failed:
+            return batch.result
+        return function()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+    columnar.py
+
+"""
+__all__ = ['encode_lines', 'decode_lines', 'line_count']
+
+# Line fields of records serialized as dictionaries with an id, which are
+# stored once in a lookup table of the same name
+LOOKUP_FIELDS = {
+    'product': 'products',
+    'unit': 'units',
+}
+
+
+def encode_lines(lines):
+    """
+    Return the serialized lines in the columnar format: a dictionary with
+    the `count` of lines and, in `columns`, the list of the values of each
+    field of the lines. The lines are the values at the same index.
+
+    The values of the fields of LOOKUP_FIELDS are the index of the record in
+    the lookup table of the field, in which each record is only once, or
+    None. So two lines of the same product are encoded as::
+
+        {
+            'count': 2,
+            'columns': {'id': [1, 2], 'product': [0, 0], ...},
+            'products': [{'id': 7, ...}],
+            'units': [...],
+        }
+    """
+    names = sorted(set(name for line in lines for name in line))
+    columns = dict((name, []) for name in names)
+    tables = dict((table, []) for table in LOOKUP_FIELDS.itervalues())
+    indexes = dict((table, {}) for table in LOOKUP_FIELDS.itervalues())
+    for line in lines:
+        for name in names:
+            value = line.get(name)
+            table = LOOKUP_FIELDS.get(name)
+            if table and value is not None:
+                index = indexes[table].get(value['id'])
+                if index is None:
+                    index = indexes[table][value['id']] = len(tables[table])
+                    tables[table].append(value)
+                value = index
+            columns[name].append(value)
+    result = {
+        'count': len(lines),
+        'columns': columns,
+    }
+    result.update(tables)
+    return result
+
+
+def decode_lines(table):
+    """
+    Return the list of lines of the columnar format of encode_lines
+    """
+    lines = [{} for _ in xrange(table['count'])]
+    for name, values in table['columns'].iteritems():
+        records = table.get(LOOKUP_FIELDS.get(name))
+        for line, value in zip(lines, values):
+            if records is not None and value is not None:
+                value = records[value]
+            line[name] = value
+    return lines
+
+
+def line_count(lines):
+    """
+    Return the number of the serialized lines, in any format
+    """
+    if isinstance(lines, dict):
+        return lines['count']
+    return len(lines)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+    latency.py
+
+"""
+import time
+from bisect import bisect_left, bisect_right
+from functools import wraps
+from threading import Lock
+
+from trytond.config import config
+
+__all__ = ['Histogram', 'timed', 'get_stats', 'dump']
+
+# Upper bounds of the buckets in milliseconds, the last bucket is unbounded
+BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+# Lower bounds of the cart size buckets, in lines
+SIZES = (0, 10, 50, 100, 500)
+
+PERCENTILES = (50, 90, 99)
+
+_histograms = {}
+_histograms_lock = Lock()
+
+
+def size_label(size):
+    index = bisect_right(SIZES, size) - 1
+    if index + 1 < len(SIZES):
+        return '%s-%s' % (SIZES[index], SIZES[index + 1] - 1)
+    return '%s+' % SIZES[index]
+
+
+class Histogram(object):
+    """
+    Latencies bucketed by BOUNDS
+    """
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        self.counts[bisect_left(BOUNDS, duration)] += 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def percentile(self, percent):
+        """
+        Return the estimated latency under which `percent` of the calls
+        completed, interpolated within its bucket
+        """
+        if not self.count:
+            return 0.0
+        rank = self.count * percent / 100.0
+        cumulated = 0
+        for index, count in enumerate(self.counts):
+            if count and cumulated + count >= rank:
+                lower = BOUNDS[index - 1] if index else 0.0
+                upper = BOUNDS[index] if index < len(BOUNDS) else self.max
+                upper = min(upper, self.max)
+                return lower + (upper - lower) * (rank - cumulated) / count
+            cumulated += count
+        return self.max
+
+
+def timed(name, size):
+    """
+    Decorate a POS method to add the latency of each call to the histogram
+    of the method and the size of the cart, computed by calling `size`
+    with the arguments and the result of the call.
+
+    It is enabled by the `latency_stats` option of the [pos] section of the
+    configuration. Else the call is only delayed by the reading of the
+    option.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not config.getboolean('pos', 'latency_stats', False):
+                return function(*args, **kwargs)
+            start = time.time()
+            result = function(*args, **kwargs)
+            duration = (time.time() - start) * 1000
+            key = (name, size_label(size(args, result)))
+            with _histograms_lock:
+                histogram = _histograms.get(key)
+                if histogram is None:
+                    histogram = _histograms[key] = Histogram()
+                histogram.add(duration)
+            return result
+        return wrapper
+    return decorator
+
+
+def get_stats(reset=False):
+    """
+    Return a dictionary of method name to a dictionary of cart size bucket
+    (like `10-49`) to the `count`, `mean`, `max`, percentiles (`p50`, `p90`
+    and `p99`) and `buckets` (list of [upper bound, count], the last bound
+    being None) of the latencies in milliseconds.
+    """
+    with _histograms_lock:
+        result = {}
+        for (name, label), histogram in _histograms.iteritems():
+            stats = {
+                'count': histogram.count,
+                'mean': histogram.total / histogram.count,
+                'max': histogram.max,
+                'buckets': [
+                    [bound, count] for bound, count in zip(
+                        BOUNDS + (None,), histogram.counts
+                    ) if count
+                ],
+            }
+            for percent in PERCENTILES:
+                stats['p%s' % percent] = histogram.percentile(percent)
+            result.setdefault(name, {})[label] = stats
+        if reset:
+            _histograms.clear()
+    return result
+
+
+def dump(reset=False):
+    """
+    Return the statistics of get_stats as a text table
+    """
+    def lower_bound(label):
+        return int(label.rstrip('+').split('-')[0])
+
+    stats = get_stats(reset)
+    lines = ['%-20s %10s %8s %10s %10s %10s %10s' % (
+        'method', 'lines', 'calls', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)',
+        'max (ms)'
+    )]
+    for name in sorted(stats):
+        for label in sorted(stats[name], key=lower_bound):
+            values = stats[name][label]
+            lines.append('%-20s %10s %8d %10.1f %10.1f %10.1f %10.1f' % (
+                name, label, values['count'], values['p50'], values['p90'],
+                values['p99'], values['max']
+            ))
+    return '\n'.join(lines)
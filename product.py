@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+    product.py
+
+"""
+from trytond.pool import PoolMeta
+from trytond.cache import Cache
+from trytond.config import config
+
+__metaclass__ = PoolMeta
+__all__ = ['Product']
+
+
+class Product:
+    __name__ = 'product.product'
+
+    # Index of product codes to product ids, used by POS terminals to add
+    # scanned products. It is filled lazily, bounded by the
+    # code_cache_size of the [pos] configuration section and cleared (in
+    # every server process) when codes of products change.
+    _pos_code_cache = Cache(
+        'product.product.pos_code', context=False,
+        size_limit=config.getint('pos', 'code_cache_size', 10000),
+    )
+
+    @classmethod
+    def get_ids_by_code(cls, codes):
+        """
+        Return a dictionary of the given codes to the id of the active
+        product with that code. Unknown codes are left out.
+        """
+        res = {}
+        missing = []
+        for code in codes:
+            product_id = cls._pos_code_cache.get(code)
+            if product_id is None:
+                missing.append(code)
+            else:
+                res[code] = product_id
+
+        if missing:
+            for product in cls.search([('code', 'in', missing)]):
+                res[product.code] = product.id
+                cls._pos_code_cache.set(product.code, product.id)
+        return res
+
+    @classmethod
+    def create(cls, vlist):
+        products = super(Product, cls).create(vlist)
+        cls._pos_code_cache.clear()
+        return products
+
+    @classmethod
+    def write(cls, *args):
+        super(Product, cls).write(*args)
+        actions = iter(args)
+        for _, values in zip(actions, actions):
+            if set(values) & set(['code', 'active']):
+                cls._pos_code_cache.clear()
+                break
+
+    @classmethod
+    def delete(cls, products):
+        super(Product, cls).delete(products)
+        cls._pos_code_cache.clear()
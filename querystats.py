@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+    querystats.py
+
+"""
+import time
+import logging
+from functools import wraps
+from contextlib import contextmanager
+from threading import Lock
+
+from trytond.transaction import Transaction
+from trytond.config import config
+
+__all__ = [
+    'QueryRecorder', 'record_queries', 'instrument', 'get_stats',
+    'max_queries',
+]
+
+logger = logging.getLogger('pos')
+
+SLOWEST = 5
+
+_stats = {}
+_stats_lock = Lock()
+
+
+class QueryRecorder(object):
+    """
+    Number, total time and slowest of the SQL statements executed
+    """
+    __slots__ = ('count', 'duration', 'slowest', 'statements')
+
+    def __init__(self, keep_statements=False):
+        self.count = 0
+        self.duration = 0.0
+        # List of (duration, statement), the slowest first
+        self.slowest = []
+        self.statements = [] if keep_statements else None
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        if self.statements is not None:
+            self.statements.append(statement)
+        if (len(self.slowest) < SLOWEST or
+                duration > self.slowest[-1][0]):
+            self.slowest.append((duration, statement))
+            self.slowest.sort(reverse=True)
+            del self.slowest[SLOWEST:]
+
+
+@contextmanager
+def record_queries(keep_statements=False):
+    """
+    Record the SQL statements executed by the cursor of the transaction
+    while in the context
+    """
+    cursor = Transaction().cursor
+    recorder = QueryRecorder(keep_statements)
+    # Recordings can be nested
+    wrapped = 'execute' in vars(cursor)
+    execute = cursor.execute
+
+    def execute_and_record(sql, params=None):
+        start = time.time()
+        try:
+            return execute(sql, params)
+        finally:
+            recorder.record(sql, time.time() - start)
+
+    cursor.execute = execute_and_record
+    try:
+        yield recorder
+    finally:
+        if wrapped:
+            cursor.execute = execute
+        else:
+            del cursor.execute
+
+
+def _add_stats(name, recorder):
+    with _stats_lock:
+        stats = _stats.setdefault(name, {
+            'calls': 0,
+            'queries': 0,
+            'max_queries': 0,
+            'sql_time': 0.0,
+            'slowest': [],
+        })
+        stats['calls'] += 1
+        stats['queries'] += recorder.count
+        stats['max_queries'] = max(stats['max_queries'], recorder.count)
+        stats['sql_time'] += recorder.duration
+        slowest = stats['slowest'] + recorder.slowest
+        slowest.sort(reverse=True)
+        stats['slowest'] = slowest[:SLOWEST]
+
+
+def instrument(name):
+    """
+    Decorate a POS RPC to record the SQL statements of each call when the
+    `query_stats` option of the [pos] section of the configuration is set.
+
+    Each call is logged and added to the statistics of the RPC returned by
+    get_stats.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not config.getboolean('pos', 'query_stats', False):
+                return function(*args, **kwargs)
+            with record_queries() as recorder:
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    _add_stats(name, recorder)
+                    logger.info(
+                        '%s: %s queries in %.1f ms', name, recorder.count,
+                        recorder.duration * 1000
+                    )
+                    for duration, statement in recorder.slowest:
+                        logger.debug(
+                            '%s: %.1f ms %s', name, duration * 1000, statement
+                        )
+        return wrapper
+    return decorator
+
+
+def get_stats(reset=False):
+    """
+    Return a dictionary of RPC name to the number of `calls`, the total
+    number of `queries`, the `max_queries` of a call, the total `sql_time`
+    in milliseconds and the `slowest` statements, as a list of (duration in
+    milliseconds, statement).
+    """
+    with _stats_lock:
+        result = dict((name, {
+            'calls': stats['calls'],
+            'queries': stats['queries'],
+            'max_queries': stats['max_queries'],
+            'sql_time': stats['sql_time'] * 1000,
+            'slowest': [
+                (duration * 1000, statement)
+                for duration, statement in stats['slowest']
+            ],
+        }) for name, stats in _stats.iteritems())
+        if reset:
+            _stats.clear()
+    return result
+
+
+@contextmanager
+def max_queries(count):
+    """
+    Fail with an AssertionError listing the statements if more than `count`
+    SQL statements are executed in the context. Meant for the tests::
+
+        with max_queries(10):
+            sale.serialize('pos')
+    """
+    with record_queries(keep_statements=True) as recorder:
+        yield recorder
+    if recorder.count > count:
+        raise AssertionError(
+            '%s queries executed, expected at most %s:\n%s' % (
+                recorder.count, count, '\n'.join(recorder.statements)
+            )
+        )
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+    replica.py
+
+"""
+import os
+import time
+import logging
+from threading import Lock
+
+from sql.aggregate import Max, Min
+from sql.functions import Extract, Now
+from trytond import backend
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.config import config
+
+__all__ = ['on_replica', 'replica_lag', 'is_fresh']
+
+logger = logging.getLogger('pos')
+
+# Seconds during which the measured lag of a replica is used
+LAG_CHECK_INTERVAL = 1
+
+# Replica database name to (time of the check, lag)
+_lags = {}
+_lags_lock = Lock()
+
+
+def replica_lag(cursor, primary_cursor=None):
+    """
+    Return the number of seconds the database of the cursor is behind the
+    primary database (of primary_cursor), or None if it is unknown:
+
+        * a PostgreSQL standby is behind by the time since the last
+          transaction it replayed.
+        * another PostgreSQL database, copied by other means, is behind by
+          the time since the first sale it does not have was created on the
+          primary database (see _missing_sales_lag). Its lag is unknown
+          without primary_cursor.
+        * a SQLite copy is as old as its file.
+    """
+    if backend.name() == 'postgresql':
+        cursor.execute('SELECT pg_is_in_recovery()')
+        standby, = cursor.fetchone()
+        if not standby:
+            if primary_cursor is None:
+                return None
+            return _missing_sales_lag(cursor, primary_cursor)
+        cursor.execute(
+            'SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())'
+        )
+        lag, = cursor.fetchone()
+        return float(lag) if lag is not None else None
+    elif backend.name() == 'sqlite':
+        if cursor.database_name == ':memory:':
+            return 0.0
+        path = os.path.join(
+            config.get('database', 'path'), cursor.database_name + '.sqlite'
+        )
+        return max(time.time() - os.path.getmtime(path), 0.0)
+
+
+def _missing_sales_lag(cursor, primary_cursor):
+    """
+    Return the number of seconds since the first sale missing from the
+    database of the cursor was created on the database of primary_cursor,
+    or 0 if it has all the sales.
+
+    Only the new sales are compared, both by their id: the changes of the
+    existing sales are not, which is_fresh checks for the client.
+    """
+    table = Pool().get('sale.sale').__table__()
+    cursor.execute(*table.select(Max(table.id)))
+    last_id, = cursor.fetchone()
+    primary_cursor.execute(*table.select(
+        Extract('EPOCH', Now() - Min(table.create_date)),
+        where=table.id > (last_id or 0)
+    ))
+    lag, = primary_cursor.fetchone()
+    return max(float(lag), 0.0) if lag is not None else 0.0
+
+
+def is_fresh(cursor, last_write):
+    """
+    Return whether the database of the cursor has the last write of the
+    client, a list of the sale id and its revision as returned by
+    serialize('pos'). Without last write, any database is fresh.
+    """
+    if not last_write:
+        return True
+    sale_id, revision = last_write
+    table = Pool().get('sale.sale').__table__()
+    cursor.execute(*table.select(
+        table.pos_revision, where=table.id == sale_id
+    ))
+    row = cursor.fetchone()
+    return row is not None and (row[0] or 0) >= (revision or 0)
+
+
+def on_replica(function):
+    """
+    Return the result of the function called on the replica database if
+    one is set by the `replica_database` option of the [pos] section of the
+    configuration, as a copy of the database for the readonly RPCs.
+
+    The function is called on the database of the transaction instead if
+    the replica is behind by more than `replica_max_lag` seconds (default
+    5) or by an unknown lag (see replica_lag), if it does not have the last
+    write of the client (the `pos_last_write` of the context, see is_fresh)
+    or if it can not be reached.
+
+    The records must be instantiated by the function. The cursor of the
+    replica is given the name of the database, so the pool and the caches of
+    the database are used with it.
+    """
+    name = config.get('pos', 'replica_database')
+    if not name:
+        return function()
+    max_lag = config.getfloat('pos', 'replica_max_lag', 5)
+    now = time.time()
+    with _lags_lock:
+        checked, lag = _lags.get(name, (0, None))
+    check = now - checked >= LAG_CHECK_INTERVAL
+    if not check and (lag is None or lag > max_lag):
+        return function()
+
+    transaction = Transaction()
+    try:
+        database = backend.get('Database')(name).connect()
+        cursor = database.cursor(readonly=True)
+    except Exception:
+        logger.warning('Replica %s can not be reached', name, exc_info=True)
+        with _lags_lock:
+            _lags[name] = (now, None)
+        return function()
+
+    try:
+        if check:
+            lag = replica_lag(cursor, transaction.cursor)
+            with _lags_lock:
+                _lags[name] = (now, lag)
+        if (lag is None or lag > max_lag or
+                not is_fresh(cursor, transaction.context.get(
+                    'pos_last_write'))):
+            logger.debug('Replica %s is behind (%s s)', name, lag)
+            return function()
+        cursor.database_name = transaction.cursor.database_name
+        with transaction.set_cursor(cursor):
+            return function()
+    finally:
+        cursor.close()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+    request.py
+
+"""
+import json
+from datetime import datetime, timedelta
+
+from sql.aggregate import Max
+from trytond.model import ModelSQL, fields
+from trytond.transaction import Transaction
+from trytond import backend
+from trytond.config import config
+from trytond.protocols.jsonrpc import JSONEncoder, JSONDecoder
+
+__all__ = ['POSRequest']
+
+
+class POSRequest(ModelSQL):
+    """
+    Responses to recent POS requests, by the request id of the client.
+
+    Terminals retry requests when the network drops the response. The
+    retried request is answered with the stored response instead of being
+    run again. The response is stored in the transaction of the request,
+    so it is only replayed if the changes of the request were committed.
+
+    The table is bounded: entries older than `request_timeout` seconds
+    (the [pos] section of the configuration, default 10 minutes) are not
+    replayed and are purged, and only the last `request_size_limit`
+    entries (default 10000) are kept.
+    """
+    __name__ = 'sale.pos.request'
+
+    sale = fields.Many2One(
+        'sale.sale', 'Sale', required=True, select=True, ondelete='CASCADE'
+    )
+    request_id = fields.Char('Request ID', required=True)
+    response = fields.Text('Response', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(POSRequest, cls).__setup__()
+        cls._sql_constraints += [
+            ('sale_request_id_uniq', 'UNIQUE(sale, request_id)',
+                'The request id must be unique per sale.'),
+        ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(POSRequest, cls).__register__(module_name)
+
+        TableHandler = backend.get('TableHandler')
+        table = TableHandler(Transaction().cursor, cls, module_name)
+
+        # Expired entries are purged by creation date
+        table.index_action('create_date', 'add')
+
+    @staticmethod
+    def _timeout():
+        return timedelta(
+            seconds=config.getint('pos', 'request_timeout', 600)
+        )
+
+    @staticmethod
+    def _size_limit():
+        return config.getint('pos', 'request_size_limit', 10000)
+
+    @classmethod
+    def get_response(cls, sale, request_id):
+        """
+        Return the stored response of the request made for the sale or None
+        if there is none which did not expire.
+
+        The table is queried directly to keep the replay away from the ORM.
+        """
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        cursor.execute(*table.select(
+            table.response,
+            where=(
+                (table.sale == sale.id) &
+                (table.request_id == request_id) &
+                (table.create_date >= datetime.now() - cls._timeout())
+            )
+        ))
+        row = cursor.fetchone()
+        if row:
+            return json.loads(row[0], object_hook=JSONDecoder())
+
+    @classmethod
+    def store_response(cls, sale, request_id, response):
+        """
+        Store the response of the request made for the sale and purge the
+        expired entries.
+        """
+        table = cls.__table__()
+        cursor = Transaction().cursor
+        now = datetime.now()
+
+        cursor.execute(*table.insert(
+            [
+                table.create_uid, table.create_date, table.sale,
+                table.request_id, table.response,
+            ],
+            [[
+                Transaction().user, now, sale.id, request_id,
+                json.dumps(response, cls=JSONEncoder, separators=(',', ':')),
+            ]]
+        ))
+
+        cursor.execute(*table.select(Max(table.id)))
+        last_id, = cursor.fetchone()
+        cursor.execute(*table.delete(
+            where=(
+                (table.create_date < now - cls._timeout()) |
+                (table.id <= last_id - cls._size_limit())
+            )
+        ))
@@ -3,8 +3,13 @@
     sale.py
 
 """
+import json
+import logging
 from datetime import datetime, timedelta
+from collections import OrderedDict
 from sql import Literal
+from sql.aggregate import Count, Sum
+from sql.conditionals import Coalesce
 from trytond.model import fields
 from trytond.pool import Pool, PoolMeta
 from trytond.transaction import Transaction
@@ -12,13 +17,35 @@ from trytond.rpc import RPC
 from trytond.model import ModelView
 from trytond.pyson import Eval, Bool, And
 from trytond import backend
+from trytond.config import config
 from math import floor
 from decimal import Decimal
 
+from coalesce import Coalescer
+from batch import process_in_chunks
+from session import CartSession, get_session, set_session
+from totals import compute_totals
+from querystats import instrument, get_stats
+from latency import timed
+from replica import on_replica
+from columnar import encode_lines, line_count
+from binary import packed
+import latency
 
 __metaclass__ = PoolMeta
 __all__ = ["Sale", "SaleChannel", "SaleLine"]
 
+logger = logging.getLogger('pos')
+
+_scan_coalescer = Coalescer()
+
+# Values of the lines stored by parked carts, in order, followed by the taxes.
+# New fields are appended so the carts parked before still resume.
+_PARKED_LINE_FIELDS = (
+    'type', 'product', 'unit', 'quantity', 'unit_price', 'delivery_mode',
+    'description', 'warehouse', 'sequence', 'note',
+)
+
 
 class SaleConfiguration:
     'Sale Configuration'
@@ -66,6 +93,276 @@ class SaleChannel:
 
         return sources
 
+    @classmethod
+    def __setup__(cls):
+        super(SaleChannel, cls).__setup__()
+        cls.__rpc__.update({
+            'pos_process_sales': RPC(instantiate=0, readonly=False),
+            'pos_sales_summary': RPC(instantiate=0, readonly=True),
+        })
+
+    @classmethod
+    def pos_process_sales(cls, channels, start_date, end_date):
+        """
+        Checkout the draft and quotation sales of the channels for the
+        dates between start_date and end_date (included) left at the end of
+        a shift.
+
+        The sales are processed in chunks of `batch_chunk_size` (default 20)
+        by a pool of `batch_workers` (default 4) threads, both from the [pos]
+        section of the configuration. Each chunk is processed in its own
+        transaction and failures, like items out of stock, are reported per
+        sale without aborting the batch.
+
+        Returns a dictionary with the list of `processed` sale ids and the
+        list of `failed` sales, as dictionaries of `sale` id and `error`.
+        """
+        sales = cls._pos_sales_to_process(channels, start_date, end_date)
+
+        def checkout(sale_id):
+            Pool().get('sale.sale')(sale_id)._pos_checkout()
+
+        processed, failures = process_in_chunks(
+            map(int, sales), checkout,
+            chunk_size=config.getint('pos', 'batch_chunk_size', 20),
+            workers=config.getint('pos', 'batch_workers', 4),
+        )
+        return {
+            'processed': processed,
+            'failed': [
+                {'sale': sale_id, 'error': error}
+                for sale_id, error in failures
+            ],
+        }
+
+    @classmethod
+    def _pos_sales_to_process(cls, channels, start_date, end_date):
+        """
+        Return the draft and quotation sales of the channels for the dates
+        between start_date and end_date (included). Sales without a sale
+        date yet are selected by their creation date.
+        """
+        Sale = Pool().get('sale.sale')
+
+        return Sale.search([
+            ('channel', 'in', map(int, channels)),
+            ('state', 'in', ['draft', 'quotation']),
+            ('pos_parked_lines', '=', None),
+            ['OR', [
+                ('sale_date', '>=', start_date),
+                ('sale_date', '<=', end_date),
+            ], [
+                ('sale_date', '=', None),
+                ('create_date', '>=', datetime.combine(
+                    start_date, datetime.min.time()
+                )),
+                ('create_date', '<', datetime.combine(
+                    end_date + timedelta(days=1), datetime.min.time()
+                )),
+            ]],
+        ], order=[('id', 'ASC')])
+
+    @classmethod
+    def pos_sales_summary(cls, channels, start_date, end_date):
+        """
+        Return the end of day summary of the sales of the channels for the
+        dates between start_date and end_date (included).
+
+        Only confirmed, processing and done sales are summarized, using the
+        amounts stored on them and on their lines. The aggregates are
+        computed by the database instead of reading the sales.
+
+        Returns a list with a dictionary per channel which has:
+            - channel: the id of the channel
+            - sales: the number of sales
+            - untaxed_amount, tax_amount and total_amount of the sales
+            - lines: a list of the lines grouped by delivery_mode and
+              is_round_off with their number of `lines`, `quantity`,
+              `amount` and the number of `return_lines` (negative quantity)
+        """
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+
+        sale = Sale.__table__()
+        line = SaleLine.__table__()
+        cursor = Transaction().cursor
+
+        where = (
+            sale.channel.in_(map(int, channels)) &
+            sale.state.in_(['confirmed', 'processing', 'done']) &
+            (sale.sale_date >= start_date) &
+            (sale.sale_date <= end_date)
+        )
+
+        summaries = OrderedDict()
+        for channel in cls.browse(channels):
+            summaries[channel.id] = {
+                'channel': channel.id,
+                'sales': 0,
+                'untaxed_amount': Decimal('0'),
+                'tax_amount': Decimal('0'),
+                'total_amount': Decimal('0'),
+                'lines': [],
+            }
+
+        cursor.execute(*sale.select(
+            sale.channel, Count(sale.id),
+            Sum(sale.untaxed_amount_cache), Sum(sale.tax_amount_cache),
+            Sum(sale.total_amount_cache),
+            where=where,
+            group_by=[sale.channel]
+        ))
+        for channel_id, count, untaxed, tax, total in cursor.fetchall():
+            summary = summaries[channel_id]
+            summary['sales'] = count
+            summary['untaxed_amount'] = cls._pos_sum_amount(
+                channel_id, untaxed
+            )
+            summary['tax_amount'] = cls._pos_sum_amount(channel_id, tax)
+            summary['total_amount'] = cls._pos_sum_amount(channel_id, total)
+
+        # The lines with the same quantity and unit price are grouped and
+        # their amount is rounded per line, like the amount of sale.line,
+        # so the groups add up to the amounts of the sales
+        is_round_off = Coalesce(line.is_round_off, False)
+        group_by = [
+            sale.channel, line.delivery_mode, is_round_off, sale.currency,
+            line.quantity, line.unit_price,
+        ]
+        cursor.execute(*line.join(
+            sale, condition=(sale.id == line.sale)
+        ).select(
+            *(group_by + [Count(line.id)]),
+            where=where & (line.type == 'line'),
+            group_by=group_by,
+            order_by=[sale.channel, line.delivery_mode, is_round_off]
+        ))
+        rows = cursor.fetchall()
+
+        currencies = dict((c.id, c) for c in Currency.browse(
+            list(set(row[3] for row in rows))
+        ))
+        groups = OrderedDict()
+        for (channel_id, delivery_mode, round_off, currency, quantity,
+                unit_price, count) in rows:
+            key = (channel_id, delivery_mode, bool(round_off))
+            group = groups.setdefault(key, {
+                'delivery_mode': delivery_mode,
+                'is_round_off': bool(round_off),
+                'lines': 0,
+                'quantity': 0.0,
+                'amount': Decimal('0'),
+                'return_lines': 0,
+            })
+            quantity = quantity or 0.0
+            group['lines'] += count
+            group['quantity'] += quantity * count
+            group['amount'] += currencies[currency].round(
+                Decimal(str(quantity)) * Decimal(str(unit_price or 0))
+            ) * count
+            if quantity < 0:
+                group['return_lines'] += count
+        for (channel_id, _, _), group in groups.iteritems():
+            group['amount'] = cls._pos_sum_amount(channel_id, group['amount'])
+            summaries[channel_id]['lines'].append(group)
+        return summaries.values()
+
+    @classmethod
+    def _pos_sum_amount(cls, channel_id, value):
+        """
+        Return the sum of amounts computed by the database as a Decimal
+        rounded to the currency of the channel.
+
+        SQLite returns the sums of numeric columns as floats.
+        """
+        if value is None:
+            return Decimal('0')
+        if not isinstance(value, Decimal):
+            value = Decimal(str(value))
+        return cls(channel_id).currency.round(value)
+
+    @classmethod
+    def cleanup_abandoned_carts_using_cron(cls):  # pragma: nocover
+        """
+        Cron method to cleanup the abandoned carts of the POS channels
+        """
+        for channel in cls.search([('source', '=', 'pos')]):
+            with Transaction().set_context(company=channel.company.id):
+                channel.cleanup_abandoned_carts()
+
+    def cleanup_abandoned_carts(self):
+        """
+        Cancel or delete the draft sales of the channel which were not
+        changed for `abandoned_cart_days` days (default 7).
+
+        The [pos] section of the configuration sets the days, the
+        `abandoned_cart_action`, which is `cancel` (default) or `delete`,
+        and the `abandoned_cart_batch_size` (default 100). The sales are
+        cleaned up by batches committed one after the other so the tables
+        are not locked for long and the progress is logged.
+
+        Returns the number of sales cleaned up.
+        """
+        action = config.get('pos', 'abandoned_cart_action', 'cancel')
+        if action not in ('cancel', 'delete'):
+            self.raise_user_error(
+                "Unknown abandoned cart action: %s" % action
+            )
+        date = datetime.now() - timedelta(
+            days=config.getint('pos', 'abandoned_cart_days', 7)
+        )
+        sale_ids = self._pos_abandoned_carts(date)
+
+        cleanup = self._pos_cleanup_abandoned_cart
+        processed, failures = process_in_chunks(
+            sale_ids, lambda sale_id: cleanup(action, sale_id),
+            chunk_size=config.getint('pos', 'abandoned_cart_batch_size', 100),
+            workers=1,
+        )
+        logger.info(
+            'Abandoned carts of channel %s: %s %s, %s failed',
+            self.id, len(processed), action, len(failures)
+        )
+        return len(processed)
+
+    @staticmethod
+    def _pos_cleanup_abandoned_cart(action, sale_id):
+        """
+        Cancel or delete the abandoned sale
+        """
+        Sale = Pool().get('sale.sale')
+        getattr(Sale, action)([Sale(sale_id)])
+
+    def _pos_abandoned_carts(self, date):
+        """
+        Return the ids of the draft sales of the channel which, like their
+        lines, were not changed since the date
+        """
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+
+        sale = Sale.__table__()
+        line = SaleLine.__table__()
+        cursor = Transaction().cursor
+
+        cursor.execute(*sale.select(
+            sale.id,
+            where=(
+                (sale.channel == self.id) &
+                (sale.state == 'draft') &
+                (Coalesce(sale.write_date, sale.create_date) < date) &
+                ~sale.id.in_(line.select(
+                    line.sale,
+                    where=(Coalesce(line.write_date, line.create_date) >= date)
+                ))
+            ),
+            order_by=[sale.id.asc]
+        ))
+        return [row[0] for row in cursor.fetchall()]
+
     @classmethod
     def __register__(cls, module_name):
         TableHandler = backend.get('TableHandler')
@@ -90,6 +387,9 @@ class SaleChannel:
 class Sale:
     __name__ = "sale.sale"
 
+    pos_parked_lines = fields.Text('Parked Lines', readonly=True)
+    pos_revision = fields.Integer('POS Revision', readonly=True)
+
     @staticmethod
     def default_party():
         User = Pool().get('res.user')
@@ -106,8 +406,20 @@ class Sale:
         super(Sale, cls).__setup__()
         cls.__rpc__.update({
             'pos_add_product': RPC(instantiate=0, readonly=False),
+            'pos_add_product_by_code': RPC(instantiate=0, readonly=False),
+            'pos_update_lines': RPC(instantiate=0, readonly=False),
+            'pos_apply_operations': RPC(instantiate=0, readonly=False),
             'pos_serialize': RPC(instantiate=0, readonly=True),
+            'pos_checkout': RPC(instantiate=0, readonly=False),
+            'pos_park': RPC(instantiate=0, readonly=False),
+            'pos_unpark': RPC(instantiate=0, readonly=False),
+            'pos_session': RPC(instantiate=0, readonly=True),
+            'pos_session_apply': RPC(instantiate=0, readonly=False),
+            'pos_session_flush': RPC(instantiate=0, readonly=False),
             'get_recent_sales': RPC(readonly=True),
+            'get_parked_sales': RPC(readonly=True),
+            'pos_query_stats': RPC(readonly=True),
+            'pos_latency_stats': RPC(readonly=True),
         })
         cls.lines.context = {
             'current_channel': Eval('channel'),
@@ -120,6 +432,9 @@ class Sale:
 
     @classmethod
     @ModelView.button
+    @timed('round_down_total', lambda args, res: sum(
+        len(record.lines) for record in args[1]
+    ))
     def round_down_total(cls, records):
         '''
         Round down total order price and add remaining amount as new sale line
@@ -153,12 +468,98 @@ class Sale:
         )
 
     @classmethod
+    def get_amount(cls, sales, names):
+        """
+        Compute the amounts of the POS sales which are not cached yet, like
+        the carts, at once with compute_totals. The amounts of the other
+        sales are computed as usual.
+        """
+        def is_pos_cart(sale):
+            cached = (
+                sale.state in cls._states_cached and
+                sale.untaxed_amount_cache is not None and
+                sale.tax_amount_cache is not None and
+                sale.total_amount_cache is not None
+            )
+            return (
+                not cached and sale.channel and sale.channel.source == 'pos'
+            )
+
+        result = super(Sale, cls).get_amount(
+            [sale for sale in sales if not is_pos_cart(sale)], names
+        )
+
+        totals = compute_totals([sale for sale in sales if is_pos_cart(sale)])
+        for sale_id, amounts in totals.iteritems():
+            for name, amount in zip(
+                    ['untaxed_amount', 'tax_amount', 'total_amount'],
+                    amounts):
+                if name in result:
+                    result[name][sale_id] = amount
+        return result
+
+    @classmethod
+    def process(cls, sales):
+        DailySummary = Pool().get('sale.channel.daily_summary')
+
+        # The states are read from the database as the POS shipments move
+        # the sales to processing while they are processed.
+        counted = set(
+            sale.id for sale in cls.browse(map(int, sales))
+            if sale.state in ('processing', 'done')
+        )
+        super(Sale, cls).process(sales)
+        DailySummary.add_lines([
+            line for sale in cls.browse(map(int, sales))
+            if sale.id not in counted and
+            sale.state in ('processing', 'done') and
+            sale.channel and sale.channel.source == 'pos'
+            for line in sale.lines
+        ])
+
+    @classmethod
+    def pos_query_stats(cls, reset=False):
+        """
+        Return the SQL statistics of the POS RPCs recorded by the process
+        since it started or the last reset, when the `query_stats` option of
+        the [pos] section of the configuration is set.
+
+        See querystats.get_stats for the format.
+        """
+        return get_stats(reset)
+
+    @classmethod
+    def pos_latency_stats(cls, text=False, reset=False):
+        """
+        Return the latency histograms of the POS entry points recorded by the
+        process since it started or the last reset, by method and number of
+        lines of the cart (of sales for get_recent_sales), when the
+        `latency_stats` option of the [pos] section of the configuration is
+        set.
+
+        See latency.get_stats for the format, or latency.dump if `text`.
+        """
+        if text:
+            return latency.dump(reset)
+        return latency.get_stats(reset)
+
+    @classmethod
+    @packed
+    @timed('get_recent_sales', lambda args, res: len(res))
+    @instrument('get_recent_sales')
     def get_recent_sales(cls):
         """
         Return sales of current channel, which were made within last 5 days
         and are in draft state. Sort by write_date or create_date of Sale and
         sale lines.
+
+        They are read from the replica database if any (see
+        replica.on_replica).
         """
+        return on_replica(cls._get_recent_sales)
+
+    @classmethod
+    def _get_recent_sales(cls):
         SaleLine = Pool().get('sale.line')
 
         context = Transaction().context
@@ -197,6 +598,23 @@ class Sale:
         ids = [x[0] for x in cursor.fetchall()]
         return [cls(id).serialize('recent_sales') for id in ids]
 
+    @classmethod
+    @packed
+    @timed('get_parked_sales', lambda args, res: len(res))
+    @instrument('get_parked_sales')
+    def get_parked_sales(cls):
+        """
+        Return the parked sales of current channel, most recently parked
+        first. They have no lines until resumed, so get_recent_sales does
+        not list them.
+        """
+        sales = cls.search([
+            ('channel', '=', Transaction().context['current_channel']),
+            ('state', '=', 'draft'),
+            ('pos_parked_lines', '!=', None),
+        ], order=[('write_date', 'DESC'), ('id', 'DESC')])
+        return [sale.serialize('recent_sales') for sale in sales]
+
     def pos_find_sale_line_domain(self):
         """
         Return domain to find existing sale line for given product.
@@ -215,14 +633,103 @@ class Sale:
 
         return domain
 
+    def _pos_line_parent_values(self):
+        """
+        Return the values of the sale used by the on_change methods of its
+        lines, in the form expected by SaleLine(**values)
+        """
+        return {
+            '_parent_sale.currency': self.currency.id,
+            '_parent_sale.party': self.party.id,
+            '_parent_sale.price_list': (
+                self.price_list.id if self.price_list else None
+            ),
+            '_parent_sale.sale_date': self.sale_date,
+            '_parent_sale.channel': self.channel,
+            '_parent_sale.shipment_address': self.shipment_address,
+            'warehouse': self.warehouse,
+            '_parent_sale.warehouse': self.warehouse,
+        }
+
+    @packed
+    @timed(
+        'pos_add_product',
+        lambda args, res: line_count(res['sale']['lines'])
+    )
+    @instrument('pos_add_product')
     def pos_add_product(self, product_ids, quantity, unit_price=None):
         """
         Add product to sale from POS.
         This method is for POS, to add multiple products to cart in single call
+
+        If the client gives a `pos_request_id` in the context, the response
+        is stored and a retry of the same request returns it without adding
+        the products again.
+
+        If `scan_coalesce_window` (milliseconds) is set in the [pos] section
+        of the configuration, scans of a single product arriving within the
+        window for the same sale, product and delivery mode are coalesced:
+        only the last one writes the line and all of them get its response.
+        They get it before the transaction of the last one is committed: if
+        it is rolled back, the scans of the batch are answered but not
+        stored, so terminals must check the revision of the sale (see
+        serialize) before trusting a coalesced response. On PostgreSQL, a
+        call started before the previous batch of the sale was committed
+        fails to lock the sale with a serialization error once the window is
+        over (see _pos_lock) and is retried, waiting for the window again.
         """
+        POSRequest = Pool().get('sale.pos.request')
+
+        request_id = Transaction().context.get('pos_request_id')
+        if request_id:
+            res = POSRequest.get_response(self, request_id)
+            if res is not None:
+                return res
+
+        window = config.getint('pos', 'scan_coalesce_window', 0)
+        context = Transaction().context
+        if window and len(product_ids) == 1 and 'sale_line' not in context:
+            key = (
+                Transaction().cursor.database_name, self.id, product_ids[0],
+                context.get('delivery_mode', 'pick_up'),
+            )
+            res = _scan_coalescer.run(
+                key, window / 1000.0,
+                lambda: self._pos_add_product(
+                    product_ids, quantity, unit_price
+                )
+            )
+        else:
+            res = self._pos_add_product(product_ids, quantity, unit_price)
+
+        if request_id:
+            POSRequest.store_response(self, request_id, res)
+        return res
+
+    @instrument('pos_add_product_by_code')
+    def pos_add_product_by_code(self, codes, quantity, unit_price=None):
+        """
+        Add products to sale from POS by their codes, as scanned by the
+        terminal, saving the round trip to resolve them to product ids.
+        """
+        Product = Pool().get('product.product')
+
+        product_ids = Product.get_ids_by_code(codes)
+        unknown = [code for code in codes if code not in product_ids]
+        if unknown:
+            self.raise_user_error(
+                "No product found for the code(s): %s" % ', '.join(unknown)
+            )
+        return self.pos_add_product(
+            [product_ids[code] for code in codes], quantity, unit_price
+        )
+
+    def _pos_add_product(self, product_ids, quantity, unit_price=None):
         AccountTax = Pool().get('account.tax')
         SaleLine = Pool().get('sale.line')
 
+        self._pos_lock_cart()
+        self._pos_flush_pending_session()
         updated_lines = []
         for product_id in product_ids:
             Transaction().set_context(product=product_id)
@@ -241,28 +748,20 @@ class Sale:
             )
 
             if sale_line:
-                values = {
+                values = self._pos_line_parent_values()
+                values.update({
                     'product': sale_line.product.id,
-                    '_parent_sale.currency': self.currency.id,
-                    '_parent_sale.party': self.party.id,
-                    '_parent_sale.price_list': (
-                        self.price_list.id if self.price_list else None
-                    ),
-                    '_parent_sale.sale_date': self.sale_date,
-                    '_parent_sale.channel': self.channel,
-                    '_parent_sale.shipment_address': self.shipment_address,
-                    'warehouse': self.warehouse,
-                    '_parent_sale.warehouse': self.warehouse,
                     'unit': sale_line.unit.id,
                     'quantity': quantity,
                     'type': 'line',
                     'delivery_mode': delivery_mode,
-                }
+                })
 
-                # Update the values by triggering an onchange which should
+                # Update the values by triggering the onchanges which should
                 # fill missing vals
-                values.update(SaleLine(**values).on_change_quantity())
-                values.update(SaleLine(**values).on_change_delivery_mode())
+                values.update(SaleLine(**values).pos_on_change(
+                    ['quantity', 'delivery_mode']
+                ))
 
                 values['unit_price'] = Decimal(unit_price) if unit_price else\
                     sale_line.unit_price
@@ -278,28 +777,9 @@ class Sale:
                     new_values[key] = value
                 SaleLine.write([sale_line], new_values)
             else:
-                values = {
-                    'product': product_id,
-                    '_parent_sale.currency': self.currency.id,
-                    '_parent_sale.party': self.party.id,
-                    '_parent_sale.price_list': (
-                        self.price_list.id if self.price_list else None
-                    ),
-                    '_parent_sale.sale_date': self.sale_date,
-                    '_parent_sale.channel': self.channel,
-                    '_parent_sale.shipment_address': self.shipment_address,
-                    'warehouse': self.warehouse,
-                    '_parent_sale.warehouse': self.warehouse,
-                    'sale': self.id,
-                    'type': 'line',
-                    'quantity': quantity,
-                    'unit': None,
-                    'description': None,
-                    'delivery_mode': delivery_mode,
-                }
-                values.update(SaleLine(**values).on_change_product())
-                values.update(SaleLine(**values).on_change_quantity())
-                values.update(SaleLine(**values).on_change_delivery_mode())
+                values = self._pos_new_line_values(
+                    product_id, quantity, delivery_mode
+                )
                 new_values = {}
                 for key, value in values.iteritems():
                     if '.' in key:
@@ -322,11 +802,623 @@ class Sale:
         }
         return res
 
+    @instrument('pos_update_lines')
+    def pos_update_lines(self, changes):
+        """
+        Update existing lines of the sale from POS.
+
+        This is the fast path for edits of lines the terminal already knows,
+        the most frequent being quantity changes. Only the onchanges of the
+        changed fields are evaluated and only the updated lines and the
+        totals of the sale are serialized.
+
+        :param changes: list of dictionaries with the `id` of a line of this
+                        sale and the new values of any of `quantity`,
+                        `unit_price` and `delivery_mode`
+        """
+        SaleLine = Pool().get('sale.line')
+
+        self._pos_lock_cart()
+        self._pos_flush_pending_session()
+        lines = SaleLine.browse([change['id'] for change in changes])
+        for line in lines:
+            if line.sale != self:
+                self.raise_user_error(
+                    "Line %s does not belong to this order" % line.id
+                )
+        self._pos_write_lines(lines, changes)
+
+        sale = self.__class__(self.id)
+        return {
+            'lines': self._pos_serialize_lines(
+                SaleLine.browse(map(int, lines))
+            ),
+            'total_amount': sale.total_amount,
+            'untaxed_amount': sale.untaxed_amount,
+            'tax_amount': sale.tax_amount,
+        }
+
+    def _pos_write_lines(self, lines, changes):
+        """
+        Write the changes of quantity, unit_price and delivery_mode on the
+        lines in a single call, evaluating only the onchanges of the changed
+        fields.
+
+        :param lines: list of lines of this sale
+        :param changes: list of dictionaries of changes, one per line
+        """
+        AccountTax = Pool().get('account.tax')
+        SaleLine = Pool().get('sale.line')
+
+        to_write = []
+        to_set_taxes = []
+        for line, change in zip(lines, changes):
+            changed = set(change) & set(['quantity', 'delivery_mode'])
+            values = {}
+            if changed:
+                line_values = self._pos_line_parent_values()
+                line_values.update({
+                    'product': line.product and line.product.id,
+                    'unit': line.unit and line.unit.id,
+                    'quantity': change.get('quantity', line.quantity),
+                    'type': line.type,
+                    'delivery_mode': change.get(
+                        'delivery_mode', line.delivery_mode
+                    ),
+                })
+                values = SaleLine(**line_values).pos_on_change(changed)
+                values.update(
+                    (name, line_values[name]) for name in changed
+                )
+                if 'taxes' in values:
+                    to_set_taxes.append((line, values['taxes']))
+
+            # Like pos_add_product, the price of the line is kept unless it
+            # is given explicitly.
+            if change.get('unit_price') is not None:
+                values['unit_price'] = Decimal(change['unit_price'])
+            else:
+                values['unit_price'] = line.unit_price
+
+            to_write.extend(([line], dict(
+                (key, value) for key, value in values.iteritems()
+                if '.' not in key and key != 'taxes'
+            )))
+
+        if to_write:
+            SaleLine.write(*to_write)
+        for line, tax_ids in to_set_taxes:
+            line.taxes = AccountTax.browse(tax_ids)
+            line.save()
+
+    def _pos_new_line_values(self, product_id, quantity, delivery_mode):
+        """
+        Return the values to create a line of the product, including the
+        taxes as a list of ids
+        """
+        SaleLine = Pool().get('sale.line')
+
+        values = self._pos_line_parent_values()
+        values.update({
+            'product': product_id,
+            'sale': self.id,
+            'type': 'line',
+            'quantity': quantity,
+            'unit': None,
+            'description': None,
+            'delivery_mode': delivery_mode,
+        })
+        values.update(SaleLine(**values).pos_on_change(
+            ['product', 'quantity', 'delivery_mode']
+        ))
+        return values
+
+    @instrument('pos_apply_operations')
+    def pos_apply_operations(self, operations):
+        """
+        Apply an ordered log of cart operations recorded by a terminal while
+        it was offline, in a single transaction.
+
+        Operations on the same line are coalesced before anything is written
+        (five scans of a product become a single line with a quantity of
+        five), then the new lines are created in one call, the changed
+        lines written in one call and the removed lines deleted in one call.
+
+        Each operation is a dictionary with a `type` and either the `line`
+        id or the `product` (and optionally `delivery_mode`, defaulting to
+        pick_up) it applies to:
+
+            * `add`: add `quantity` to the line, as a scan does.
+            * `set`: set the `quantity` and optionally the `unit_price` of
+              the line, as pos_add_product does.
+            * `remove`: remove the line.
+
+        Returns the same response as pos_add_product.
+        """
+        SaleLine = Pool().get('sale.line')
+
+        self._pos_lock_cart()
+        self._pos_flush_pending_session()
+        states = self._pos_coalesce_operations(operations)
+
+        to_create, to_write, changes, to_delete = [], [], [], []
+        for state in states.itervalues():
+            line = state['line']
+            if state['removed']:
+                if line:
+                    to_delete.append(line)
+                continue
+            if line:
+                change = {}
+                if state['quantity'] != line.quantity:
+                    change['quantity'] = state['quantity']
+                if state['unit_price'] is not None:
+                    change['unit_price'] = state['unit_price']
+                if change:
+                    to_write.append(line)
+                    changes.append(change)
+            elif state['quantity']:
+                values = self._pos_new_line_values(
+                    state['product'], state['quantity'],
+                    state['delivery_mode']
+                )
+                if state['unit_price'] is not None:
+                    values['unit_price'] = Decimal(state['unit_price'])
+                new_values = dict(
+                    (key, value) for key, value in values.iteritems()
+                    if '.' not in key and key != 'taxes'
+                )
+                if values.get('taxes'):
+                    new_values['taxes'] = [('add', values['taxes'])]
+                to_create.append(new_values)
+
+        if to_delete:
+            SaleLine.delete(to_delete)
+        if to_write:
+            self._pos_write_lines(to_write, changes)
+        created = SaleLine.create(to_create) if to_create else []
+
+        return {
+            'sale': self.__class__(self.id).serialize('pos'),
+            'updated_lines': map(int, to_write + created),
+        }
+
+    def _pos_coalesce_operations(self, operations):
+        """
+        Coalesce the operations (see pos_apply_operations) into the final
+        state of each line they touch.
+
+        The operations of a `line` apply to this line, even if the sale has
+        other lines of its product and delivery mode. The operations of a
+        `product` apply to the first line of the product and delivery mode.
+
+        Returns an ordered dictionary of the line id, or (product id,
+        delivery mode) for a new line, to a dictionary with the `product`,
+        the `delivery_mode`, the existing `line` if any, the final
+        `quantity`, the `unit_price` if one was set and whether the line was
+        `removed`.
+        """
+        lines_by_id = {}
+        lines_by_key = {}
+        for line in self.lines:
+            if line.type != 'line' or line.is_round_off or not line.product:
+                continue
+            lines_by_id[line.id] = line
+            lines_by_key.setdefault(
+                (line.product.id, line.delivery_mode), line
+            )
+
+        states = OrderedDict()
+        for operation in operations:
+            if operation.get('line'):
+                try:
+                    line = lines_by_id[operation['line']]
+                except KeyError:
+                    self.raise_user_error(
+                        "Line %s does not belong to this order"
+                        % operation['line']
+                    )
+            else:
+                line = lines_by_key.get((
+                    operation['product'],
+                    operation.get('delivery_mode', 'pick_up')
+                ))
+            if line:
+                key = line.id
+                product_id, delivery_mode = line.product.id, line.delivery_mode
+            else:
+                key = product_id, delivery_mode = (
+                    operation['product'],
+                    operation.get('delivery_mode', 'pick_up')
+                )
+            state = states.setdefault(key, {
+                'product': product_id,
+                'delivery_mode': delivery_mode,
+                'line': line,
+                'quantity': line.quantity if line else 0,
+                'unit_price': None,
+                'removed': False,
+            })
+
+            if operation['type'] == 'add':
+                state['quantity'] += operation['quantity']
+                state['removed'] = False
+            elif operation['type'] == 'set':
+                state['quantity'] = operation['quantity']
+                if operation.get('unit_price') is not None:
+                    state['unit_price'] = operation['unit_price']
+                state['removed'] = False
+            elif operation['type'] == 'remove':
+                state['quantity'] = 0
+                state['unit_price'] = None
+                state['removed'] = True
+            else:
+                self.raise_user_error(
+                    "Unknown operation %s" % operation['type']
+                )
+        return states
+
+    @instrument('pos_session')
+    def pos_session(self):
+        """
+        Return the cart session of the sale (see pos_session_apply)
+        """
+        session = self._pos_session()
+        set_session(Transaction().cursor.database_name, self.id, session)
+        return self._pos_serialize_session(session)
+
+    @instrument('pos_session_apply')
+    def pos_session_apply(self, operations):
+        """
+        Apply cart operations, as described by pos_apply_operations, to the
+        cart session of the sale instead of its lines.
+
+        The session keeps the lines of the cart in the memory of the process
+        and the changes are journaled in the sale.pos.cart_journal table,
+        from which the session is loaded back by any process. The lines are
+        written to the sale when the session is flushed, by
+        pos_session_flush, at checkout or before any other change of the
+        cart, with one bulk create.
+
+        A session can have up to `session_size_limit` lines (the [pos]
+        section of the configuration, default 500).
+
+        Returns the serialized session: its `lines` with their `line` id if
+        they exist, `product`, `delivery_mode`, `quantity`, `unit_price` and
+        `amount`, and the `untaxed_amount`, `tax_amount` and `total_amount`
+        of the cart.
+        """
+        Journal = Pool().get('sale.pos.cart_journal')
+
+        self._pos_lock_cart()
+        session = self._pos_session()
+        changed = OrderedDict()
+        for operation in operations:
+            if operation['type'] not in ('add', 'set', 'remove'):
+                self.raise_user_error(
+                    "Unknown operation %s" % operation['type']
+                )
+            key = session.get_key(operation)
+            if key is None:
+                self.raise_user_error(
+                    "Line %s does not belong to this order" % operation['line']
+                )
+            changed[key] = session.apply(key, operation)
+
+        size_limit = config.getint('pos', 'session_size_limit', 500)
+        if len(session) > size_limit:
+            self.raise_user_error(
+                "The order can not have more than %s lines" % size_limit
+            )
+        self._pos_session_prices(session)
+        if changed:
+            session.journal_id = Journal.append(self, changed)
+
+        set_session(Transaction().cursor.database_name, self.id, session)
+        return self._pos_serialize_session(session)
+
+    @instrument('pos_session_flush')
+    def pos_session_flush(self):
+        """
+        Write the lines of the cart session to the sale and end the session
+
+        Returns the same response as pos_add_product.
+        """
+        Journal = Pool().get('sale.pos.cart_journal')
+
+        self._pos_lock()
+        operations = self._pos_session().operations()
+        Journal.clear(self)
+        if operations:
+            return self.pos_apply_operations(operations)
+        return {
+            'sale': self.serialize('pos'),
+            'updated_lines': [],
+        }
+
+    def _pos_lock(self):
+        """
+        Lock the sale until the end of the transaction before changing its
+        cart, so the changes of the terminals sharing a sale are applied one
+        after the other.
+
+        The sale is locked by incrementing its pos_revision and it is locked
+        before anything else, so transactions lock a sale before its lines
+        and do not deadlock. After waiting for the lock, a transaction must
+        not change the cart from what it read before the other one was
+        committed (like searching the line of a product and creating a
+        duplicate of the line created by the other one):
+
+            * On SQLite, the lock is the write lock of the database, so the
+              transaction reads the committed cart once it has the lock.
+            * On PostgreSQL, the transaction fails with a serialization
+              error as the row was updated since its snapshot. It is retried
+              by the dispatcher and nothing was done yet.
+        """
+        table = self.__table__()
+        cursor = Transaction().cursor
+        cursor.execute(*table.update(
+            [table.pos_revision], [Coalesce(table.pos_revision, 0) + 1],
+            where=table.id == self.id
+        ))
+
+        # Like ModelStorage.write, forget the values read before the lock
+        self._local_cache.pop(self.id, None)
+        for cache in cursor.cache.itervalues():
+            if self.__name__ in cache:
+                cache[self.__name__].pop(self.id, None)
+
+    def _pos_lock_cart(self):
+        """
+        Lock the sale (see _pos_lock) to change the lines of its cart, which
+        can not be changed while the cart is parked
+        """
+        self._pos_lock()
+        if self.pos_parked_lines is not None:
+            self.raise_user_error("The sale is parked")
+
+    def _pos_flush_pending_session(self):
+        """
+        Flush the cart session of the sale if it has changes
+        """
+        Journal = Pool().get('sale.pos.cart_journal')
+
+        if Journal.last_entry(self) is not None:
+            # The session loads the lines on an instance of its own
+            self.__class__(self.id).pos_session_flush()
+
+    def _pos_session(self):
+        """
+        Return the cart session of the sale kept by the process or load it
+        from the lines and the journal of the sale if the process has none
+        or an outdated one.
+
+        The session is not kept by the process anymore until it is set back
+        once changed.
+        """
+        Journal = Pool().get('sale.pos.cart_journal')
+
+        journal_id = Journal.last_entry(self)
+        session = get_session(
+            Transaction().cursor.database_name, self.id, journal_id
+        )
+        if session is not None:
+            return session
+
+        session = CartSession()
+        for line in self.lines:
+            if line.type != 'line' or line.is_round_off or not line.product:
+                continue
+            session.load_line(
+                line.id, line.product.id, line.delivery_mode, line.quantity,
+                line.unit_price, map(int, line.taxes)
+            )
+        for key, quantity, unit_price, removed in Journal.get_entries(self):
+            if not isinstance(key, tuple) and key not in session.lines:
+                # The line was deleted since
+                continue
+            session.apply(key, {
+                'type': 'remove' if removed else 'set',
+                'quantity': quantity,
+                'unit_price': unit_price,
+            })
+        self._pos_session_prices(session)
+        session.journal_id = journal_id
+        return session
+
+    def _pos_session_prices(self, session):
+        """
+        Set the unit price and the taxes of the new lines of the session as
+        they would be on a new line of the sale
+        """
+        for line in session.lines.itervalues():
+            if line['removed'] or (
+                    line['unit_price'] is not None and
+                    line['taxes'] is not None):
+                continue
+            values = self._pos_new_line_values(
+                line['product'], line['quantity'] or 1, line['delivery_mode']
+            )
+            if line['unit_price'] is None:
+                line['unit_price'] = values['unit_price']
+            line['taxes'] = values.get('taxes') or []
+
+    def _pos_serialize_session(self, session):
+        """
+        Serialize the session with the totals of its lines, computed like
+        the ones of the sale
+        """
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        Tax = pool.get('account.tax')
+
+        sale_lines = []
+        lines = []
+        for line in session.lines.itervalues():
+            if line['removed']:
+                continue
+            amount = self.currency.round(
+                Decimal(str(line['quantity'])) * line['unit_price']
+            )
+            sale_line = SaleLine(
+                type='line', quantity=line['quantity'],
+                unit_price=line['unit_price'],
+                taxes=Tax.browse(line['taxes']),
+            )
+            sale_line.amount = amount
+            sale_lines.append(sale_line)
+            lines.append({
+                'line': line['line'],
+                'product': line['product'],
+                'delivery_mode': line['delivery_mode'],
+                'quantity': line['quantity'],
+                'unit_price': line['unit_price'],
+                'amount': amount,
+            })
+
+        sale = self.__class__(self.id)
+        sale.lines = sale_lines
+        totals = sale.on_change_lines()
+        return {
+            'lines': lines,
+            'untaxed_amount': totals['untaxed_amount'],
+            'tax_amount': totals['tax_amount'],
+            'total_amount': totals['total_amount'],
+        }
+
+    @packed
+    @timed('pos_serialize', lambda args, res: line_count(res['lines']))
+    @instrument('pos_serialize')
     def pos_serialize(self):
         """
         Serialize sale for pos
+
+        The sale is read from the replica database if any (see
+        replica.on_replica).
+        """
+        return on_replica(lambda: self.__class__(self.id).serialize('pos'))
+
+    @instrument('pos_park')
+    def pos_park(self):
+        """
+        Park the cart for later: its lines are stored as a compact snapshot
+        on the sale and deleted, so a parked cart has no rows in the line
+        table until it is resumed by pos_unpark and its cart can not be
+        changed meanwhile. The round off line is not stored as it is computed
+        again at checkout.
+
+        Returns the serialized sale.
         """
-        return self.serialize('pos')
+        SaleLine = Pool().get('sale.line')
+
+        self._pos_lock()
+        if self.state != 'draft':
+            self.raise_user_error("Only draft sales can be parked")
+        if self.pos_parked_lines is not None:
+            self.raise_user_error("The sale is already parked")
+        self._pos_flush_pending_session()
+        lines = self.__class__(self.id).lines
+
+        def value(line, name):
+            value = getattr(line, name, None)
+            if isinstance(value, Decimal):
+                return str(value)
+            return getattr(value, 'id', value)
+
+        snapshot = [
+            [value(line, name) for name in _PARKED_LINE_FIELDS] +
+            [map(int, line.taxes)]
+            for line in lines if not line.is_round_off
+        ]
+        SaleLine.delete(lines)
+        self.write([self], {
+            'pos_parked_lines': json.dumps(snapshot, separators=(',', ':')),
+        })
+        return self.__class__(self.id).serialize('pos')
+
+    @instrument('pos_unpark')
+    def pos_unpark(self):
+        """
+        Resume a parked cart: its lines are created back from the snapshot
+        stored by pos_park in one call.
+
+        Returns the serialized sale.
+        """
+        SaleLine = Pool().get('sale.line')
+
+        self._pos_lock()
+        if self.pos_parked_lines is None:
+            self.raise_user_error("The sale is not parked")
+
+        vlist = []
+        for row in json.loads(self.pos_parked_lines):
+            values = dict(zip(_PARKED_LINE_FIELDS, row[:-1]), sale=self.id)
+            if values['unit_price'] is not None:
+                values['unit_price'] = Decimal(values['unit_price'])
+            if 'warehouse' not in SaleLine._fields:  # pragma: no cover
+                del values['warehouse']
+            taxes = row[-1]
+            if taxes:
+                values['taxes'] = [('add', taxes)]
+            vlist.append(values)
+        SaleLine.create(vlist)
+        self.write([self], {'pos_parked_lines': None})
+        return self.__class__(self.id).serialize('pos')
+
+    @instrument('pos_checkout')
+    def pos_checkout(self):
+        """
+        Checkout the sale from POS in a single call.
+
+        The total is rounded down and the sale is quoted, confirmed and
+        processed, as far as its state requires, in the transaction of the
+        call. Processing creates the shipments, with the pick up ones done
+        right away, and the invoices, posted if invoiced on shipment.
+
+        Returns the serialized sale with the ids of its shipments, shipment
+        returns and invoices.
+        """
+        self._pos_checkout()
+
+        sale = self.__class__(self.id)
+        return {
+            'sale': sale.serialize('pos'),
+            'shipments': map(int, sale.shipments),
+            'shipment_returns': map(int, sale.shipment_returns),
+            'invoices': map(int, sale.invoices),
+        }
+
+    def _pos_checkout(self):
+        """
+        Round down the total, quote, confirm and process the sale as far as
+        its state requires
+        """
+        self._pos_lock_cart()
+        self._pos_flush_pending_session()
+
+        sales = [self]
+        if self.state in ('draft', 'quotation'):
+            self.round_down_total(sales)
+        if self.state == 'draft':
+            self.quote(sales)
+        if self.__class__(self.id).state == 'quotation':
+            self.confirm(sales)
+        if self.__class__(self.id).state == 'confirmed':
+            self.process(sales)
+
+    @staticmethod
+    def _pos_serialize_lines(lines):
+        """
+        Serialize the lines for POS as a list of dictionaries or, if the
+        client gives `pos_line_format` 'columnar' in the context, in the
+        columnar format of columnar.encode_lines which is smaller for large
+        carts.
+        """
+        lines = [line.serialize('pos') for line in lines]
+        line_format = Transaction().context.get('pos_line_format')
+        if line_format == 'columnar':
+            return encode_lines(lines)
+        return lines
 
     def serialize(self, purpose=None):
         """
@@ -348,8 +1440,10 @@ class Sale:
                     invoice_address.serialize(purpose),
                 'shipment_address': shipment_address and
                     shipment_address.serialize(purpose),
-                'lines': [line.serialize(purpose) for line in self.lines],
+                'lines': self._pos_serialize_lines(self.lines),
                 'reference': self.reference,
+                'parked': self.pos_parked_lines is not None,
+                'revision': self.pos_revision or 0,
             }
         elif purpose == 'recent_sales':
             return {
@@ -505,6 +1599,13 @@ class SaleLine:
 
         table.not_null_action('delivery_mode', action='remove')
 
+        # Composite indexes for the lines looked up on every POS scan
+        # (Sale.pos_find_sale_line_domain) and for the round off line
+        # (Sale.round_down_total). index_action is a no-op when the index
+        # already exists, so this is safe to run on every module update.
+        table.index_action(['sale', 'product', 'delivery_mode'], 'add')
+        table.index_action(['sale', 'is_round_off'], 'add')
+
     @classmethod
     def __setup__(cls):
         super(SaleLine, cls).__setup__()
@@ -534,6 +1635,51 @@ class SaleLine:
             res['warehouse'] = self.sale.channel.backorder_warehouse.id
         return res
 
+    @staticmethod
+    def _pos_on_change_methods(changed):
+        """
+        Return the names of the on_change methods to evaluate, in order, for
+        the given changed fields.
+
+        on_change_product already prices the line for its quantity, so
+        on_change_quantity is only needed when the product did not change.
+        This is also what the client does when the product of a line is
+        changed.
+        """
+        methods = []
+        if 'product' in changed:
+            methods.append('on_change_product')
+        elif 'quantity' in changed:
+            methods.append('on_change_quantity')
+        if changed & set(['product', 'delivery_mode']):
+            methods.append('on_change_delivery_mode')
+        return methods
+
+    def pos_on_change(self, changed):
+        """
+        Evaluate the on_change methods for the changed fields on this single
+        instance and return the merged changes.
+
+        The changes returned by each method are set on the instance before
+        the next one runs, so the product, the sale (party, price list,
+        channel and its backorder warehouse) and their related records are
+        read once and shared by all of them instead of being loaded again by
+        a new SaleLine(**values) per on_change. The methods are looked up
+        on the instance, so overrides in downstream modules (typically of
+        on_change_delivery_mode) are honoured.
+
+        :param changed: iterable of the names of the changed fields
+        """
+        res = {}
+        for method in self._pos_on_change_methods(set(changed)):
+            changes = getattr(self, method)()
+            res.update(changes)
+            for name, value in changes.iteritems():
+                if '.' in name or name not in self._fields:
+                    continue
+                setattr(self, name, value)
+        return res
+
     @staticmethod
     def default_delivery_mode():
         Channel = Pool().get('sale.channel')
@@ -551,6 +1697,23 @@ class SaleLine:
     def default_is_round_off():
         return False
 
+    @classmethod
+    def create(cls, vlist):
+        DailySummary = Pool().get('sale.channel.daily_summary')
+
+        lines = super(SaleLine, cls).create(vlist)
+        if not any(values.get('is_round_off') for values in vlist):
+            return lines
+
+        # The other lines are added when the sale is processed
+        DailySummary.add_lines([
+            line for line in lines
+            if line.is_round_off and
+            line.sale.state in ('processing', 'done') and
+            line.sale.channel and line.sale.channel.source == 'pos'
+        ])
+        return lines
+
     def get_invoice_line(self, invoice_type):
         SaleConfiguration = Pool().get('sale.configuration')
         InvoiceLine = Pool().get('account.invoice.line')
@@ -610,6 +1773,8 @@ class SaleLine:
                     'rec_name': self.product.rec_name,
                     'default_image': self.product.default_image and
                                     self.product.default_image.id,
+                    'thumbnail': self.product.default_image and
+                                self.product.default_image.get_pos_thumbnail(),
                 },
                 'unit': self.unit and {
                     'id': self.unit.id,
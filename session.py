@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+    session.py
+
+"""
+from datetime import datetime
+from decimal import Decimal
+from collections import OrderedDict
+from threading import Lock
+
+from sql.aggregate import Max
+from trytond.model import ModelSQL, fields
+from trytond.transaction import Transaction
+from trytond.cache import LRUDict
+from trytond.config import config
+
+__all__ = ['POSCartJournal', 'CartSession', 'get_session', 'set_session']
+
+_sessions = LRUDict(config.getint('pos', 'session_cache_size', 1000))
+_sessions_lock = Lock()
+
+
+def get_session(database_name, sale_id, journal_id):
+    """
+    Return and remove the session of the sale kept by the process if it is
+    up to date with the last journal entry of the sale, else None.
+
+    The session is removed while it is changed so it is not used by another
+    request until set back by set_session.
+    """
+    with _sessions_lock:
+        session = _sessions.pop((database_name, sale_id), None)
+    if (session is not None and journal_id is not None and
+            session.journal_id == journal_id):
+        return session
+
+
+def set_session(database_name, sale_id, session):
+    with _sessions_lock:
+        _sessions[(database_name, sale_id)] = session
+
+
+class CartSession(object):
+    """
+    The lines of a cart kept in memory, by line id for the existing lines
+    and by (product id, delivery mode) for the new ones.
+
+    Each line is a dictionary with the id of the existing `line` if any,
+    the `product`, the `delivery_mode`, the `quantity`, the `unit_price`,
+    the `taxes` ids, whether it was `removed` and whether it was changed
+    (`dirty`) since the session was loaded from the sale.
+    """
+    __slots__ = ('lines', 'product_keys', 'journal_id')
+
+    def __init__(self):
+        self.lines = OrderedDict()
+        # (product id, delivery mode) to the key of its first line
+        self.product_keys = {}
+        self.journal_id = None
+
+    def __len__(self):
+        return sum(1 for line in self.lines.itervalues() if not line['removed'])
+
+    def load_line(
+            self, line_id, product_id, delivery_mode, quantity, unit_price,
+            taxes):
+        """
+        Load an existing line of the sale
+        """
+        self.lines[line_id] = {
+            'line': line_id,
+            'product': product_id,
+            'delivery_mode': delivery_mode,
+            'quantity': quantity,
+            'unit_price': unit_price,
+            'taxes': taxes,
+            'removed': False,
+            'dirty': False,
+        }
+        self.product_keys.setdefault((product_id, delivery_mode), line_id)
+
+    def get_key(self, operation):
+        """
+        Return the key of the line of the operation or None if it refers to
+        a line which is not in the session. An operation of a product
+        applies to the first line of the product and delivery mode.
+        """
+        if operation.get('line'):
+            if operation['line'] in self.lines:
+                return operation['line']
+            return None
+        key = (
+            operation['product'], operation.get('delivery_mode', 'pick_up')
+        )
+        return self.product_keys.get(key, key)
+
+    def apply(self, key, operation):
+        """
+        Apply the operation (see Sale.pos_apply_operations) to the line of
+        the key and return the line. The line of a new key, a (product id,
+        delivery mode), has no unit price and taxes yet.
+        """
+        if key not in self.lines:
+            product_id, delivery_mode = key
+            self.lines[key] = {
+                'line': None,
+                'product': product_id,
+                'delivery_mode': delivery_mode,
+                'quantity': 0,
+                'unit_price': None,
+                'taxes': None,
+                'removed': False,
+                'dirty': False,
+            }
+            self.product_keys.setdefault(key, key)
+        line = self.lines[key]
+        if operation['type'] == 'add':
+            line['quantity'] += operation['quantity']
+            line['removed'] = False
+        elif operation['type'] == 'set':
+            line['quantity'] = operation['quantity']
+            if operation.get('unit_price') is not None:
+                line['unit_price'] = Decimal(str(operation['unit_price']))
+            line['removed'] = False
+        else:
+            line['quantity'] = 0
+            line['removed'] = True
+        line['dirty'] = True
+        return line
+
+    def operations(self):
+        """
+        Return the `set` and `remove` operations of the changed lines, by
+        `line` for the existing ones
+        """
+        operations = []
+        for line in self.lines.itervalues():
+            if not line['dirty']:
+                continue
+            operation = {
+                'type': 'remove' if line['removed'] else 'set',
+            }
+            if line['line']:
+                operation['line'] = line['line']
+            else:
+                operation['product'] = line['product']
+                operation['delivery_mode'] = line['delivery_mode']
+            if not line['removed']:
+                operation['quantity'] = line['quantity']
+                operation['unit_price'] = line['unit_price']
+            operations.append(operation)
+        return operations
+
+
+class POSCartJournal(ModelSQL):
+    """
+    Journal of the lines changed by the cart sessions.
+
+    Each entry is the state of a line after a change, so replaying the
+    entries of a sale in order on its lines gives back its session. The
+    entries are written in the transaction of the change, so a session
+    survives the crash or restart of the process and can be loaded by any
+    process. They are deleted when the session is flushed.
+    """
+    __name__ = 'sale.pos.cart_journal'
+
+    sale = fields.Many2One(
+        'sale.sale', 'Sale', required=True, select=True, ondelete='CASCADE'
+    )
+    line = fields.Integer('Line')
+    product = fields.Integer('Product', required=True)
+    delivery_mode = fields.Char('Delivery Mode')
+    quantity = fields.Float('Quantity')
+    unit_price = fields.Numeric('Unit Price', digits=(16, 4))
+    removed = fields.Boolean('Removed')
+
+    @classmethod
+    def last_entry(cls, sale):
+        """
+        Return the id of the last entry of the sale or None
+        """
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        cursor.execute(*table.select(
+            Max(table.id), where=(table.sale == sale.id)
+        ))
+        return cursor.fetchone()[0]
+
+    @classmethod
+    def get_entries(cls, sale):
+        """
+        Return the entries of the sale in order as tuples of (key, quantity,
+        unit price, removed), the key being the line id or (product id,
+        delivery mode) for a new line like in the session.
+        """
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        cursor.execute(*table.select(
+            table.line, table.product, table.delivery_mode, table.quantity,
+            table.unit_price, table.removed,
+            where=(table.sale == sale.id),
+            order_by=[table.id.asc]
+        ))
+        return [(
+            line or (product, delivery_mode), quantity,
+            Decimal(str(unit_price)) if unit_price is not None else None,
+            bool(removed)
+        ) for line, product, delivery_mode, quantity, unit_price, removed
+            in cursor.fetchall()]
+
+    @classmethod
+    def append(cls, sale, lines):
+        """
+        Write the state of the lines, a dictionary of key to line of the
+        session, and return the id of the last entry of the sale.
+        """
+        table = cls.__table__()
+        cursor = Transaction().cursor
+        now = datetime.now()
+
+        cursor.execute(*table.insert(
+            [
+                table.create_uid, table.create_date, table.sale, table.line,
+                table.product, table.delivery_mode, table.quantity,
+                table.unit_price, table.removed,
+            ],
+            [[
+                Transaction().user, now, sale.id, line['line'],
+                line['product'], line['delivery_mode'], line['quantity'],
+                line['unit_price'], line['removed'],
+            ] for line in lines.itervalues()]
+        ))
+        return cls.last_entry(sale)
+
+    @classmethod
+    def clear(cls, sale):
+        table = cls.__table__()
+        Transaction().cursor.execute(*table.delete(
+            where=(table.sale == sale.id)
+        ))
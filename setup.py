@@ -98,6 +98,8 @@ requires.append(
         major_version, minor_version, major_version, minor_version + 1
     )
 )
+requires.append('Pillow')
+requires.append('msgpack >= 0.6.1')
 setup(
     name='%s_%s' % (PREFIX, MODULE),
     version=info.get('version', '0.0.1'),
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+    static_file.py
+
+"""
+import os
+import re
+import glob
+import logging
+from io import BytesIO
+
+from PIL import Image
+from trytond.pool import Pool, PoolMeta
+from trytond.rpc import RPC
+from trytond.transaction import Transaction
+from trytond.config import config
+
+__metaclass__ = PoolMeta
+__all__ = ['NereidStaticFile']
+
+logger = logging.getLogger('pos')
+
+# Thumbnail file names: image id, size and version of the image
+KEY_PATTERN = re.compile(r'^(\d+)-(\d+)-(\d+)\.jpg$')
+
+
+def thumbnail_directory():
+    """
+    Return the directory of the POS thumbnails of the database: in the
+    `thumbnail_path` option of the [pos] section of the configuration, else
+    in the directory of the database files.
+    """
+    database_name = Transaction().cursor.database_name
+    path = config.get('pos', 'thumbnail_path')
+    if path:
+        return os.path.join(path, database_name)
+    return os.path.join(
+        config.get('database', 'path'), database_name, 'pos_thumbnails'
+    )
+
+
+class NereidStaticFile:
+    __name__ = 'nereid.static.file'
+
+    @classmethod
+    def __setup__(cls):
+        super(NereidStaticFile, cls).__setup__()
+        cls.__rpc__.update({
+            'get_pos_thumbnail_file': RPC(readonly=True),
+        })
+
+    def get_pos_thumbnail_key(self):
+        """
+        Return the key of the POS thumbnail of the image, which is also the
+        name of its file: the image id, the `thumbnail_size` (the [pos]
+        section of the configuration, default 128 pixels) and the last
+        change of the image. So a changed image gets a new key.
+        """
+        date = self.write_date or self.create_date
+        return '%s-%s-%s.jpg' % (
+            self.id, config.getint('pos', 'thumbnail_size', 128),
+            date.strftime('%Y%m%d%H%M%S')
+        )
+
+    def get_pos_thumbnail(self):
+        """
+        Return the reference of the POS thumbnail of the image, a dictionary
+        with the `key` to get it with get_pos_thumbnail and its `size`, or
+        None if it is not generated yet.
+        """
+        key = self.get_pos_thumbnail_key()
+        if not os.path.isfile(os.path.join(thumbnail_directory(), key)):
+            return None
+        return {
+            'key': key,
+            'size': config.getint('pos', 'thumbnail_size', 128),
+        }
+
+    @classmethod
+    def get_pos_thumbnail_file(cls, key):
+        """
+        Return the JPEG file of the POS thumbnail of the key. The file of a
+        key never changes, so terminals can cache it forever.
+        """
+        if not KEY_PATTERN.match(key):
+            cls.raise_user_error("Invalid thumbnail %s" % key)
+        path = os.path.join(thumbnail_directory(), key)
+        if not os.path.isfile(path):
+            cls.raise_user_error("Unknown thumbnail %s" % key)
+        with open(path, 'rb') as thumbnail_file:
+            return buffer(thumbnail_file.read())
+
+    def _generate_pos_thumbnail(self):
+        """
+        Write the POS thumbnail of the image if it does not exist yet and
+        remove the thumbnails of its previous versions.
+
+        Returns whether the thumbnail was written.
+        """
+        directory = thumbnail_directory()
+        key = self.get_pos_thumbnail_key()
+        path = os.path.join(directory, key)
+        if os.path.isfile(path):
+            return False
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        size = config.getint('pos', 'thumbnail_size', 128)
+        image = Image.open(BytesIO(self.file_binary[:]))
+        image.thumbnail((size, size), Image.ANTIALIAS)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            # JPEG has no transparency, use a white background
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.split()[3])
+            image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        # Written under another name first so the thumbnail is never read
+        # while it is written
+        temporary_path = '%s.%s.tmp' % (path, os.getpid())
+        image.save(temporary_path, 'JPEG', quality=85, optimize=True)
+        os.rename(temporary_path, path)
+
+        for old_path in glob.glob(os.path.join(
+                directory, '%s-%s-*.jpg' % (self.id, size))):
+            if old_path != path:
+                os.remove(old_path)
+        return True
+
+    @classmethod
+    def generate_pos_thumbnails(cls, files=None):
+        """
+        Generate the missing POS thumbnails of the files or of the images of
+        the products. An image which can not be read is skipped.
+
+        Returns the number of thumbnails written.
+        """
+        ProductMedia = Pool().get('product.media')
+
+        if files is None:
+            files = set(media.static_file for media in ProductMedia.search([]))
+        count = 0
+        for static_file in files:
+            if not (static_file.mimetype or '').startswith('image/'):
+                continue
+            try:
+                count += static_file._generate_pos_thumbnail()
+            except IOError, exception:
+                logger.warning(
+                    'POS thumbnail of %s failed: %s', static_file.id, exception
+                )
+        return count
+
+    @classmethod
+    def generate_pos_thumbnails_using_cron(cls):  # pragma: nocover
+        """
+        Cron method to generate the missing POS thumbnails
+        """
+        cls.generate_pos_thumbnails()
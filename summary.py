@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+    summary.py
+
+"""
+from decimal import Decimal
+from collections import defaultdict
+
+from sql import Null
+from sql.aggregate import Count
+from sql.conditionals import Coalesce
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.rpc import RPC
+
+__all__ = ['SaleChannelDailySummary']
+
+
+class SaleChannelDailySummary(ModelSQL, ModelView):
+    """
+    Sales of a channel per day and delivery mode.
+
+    The rows are maintained incrementally: the lines of a POS sale are
+    added when it is processed or done and the round off lines created on
+    such sales afterwards are added. Dashboards read the rows instead of
+    computing the sales of the day.
+
+    `rebuild` computes the rows again from the sales, to backfill the table
+    or to fix it after changes made outside of the POS flow.
+    """
+    __name__ = 'sale.channel.daily_summary'
+
+    channel = fields.Many2One(
+        'sale.channel', 'Channel', required=True, readonly=True, select=True,
+        ondelete='CASCADE'
+    )
+    day = fields.Date('Day', required=True, readonly=True, select=True)
+    delivery_mode = fields.Selection([
+        (None, ''),
+        ('pick_up', 'Pick Up'),
+        ('ship', 'Ship'),
+    ], 'Delivery Mode', readonly=True)
+    sales = fields.Integer('Sales', readonly=True)
+    lines = fields.Integer('Lines', readonly=True)
+    quantity = fields.Float('Quantity', readonly=True)
+    amount = fields.Numeric('Amount', digits=(16, 4), readonly=True)
+    round_off_amount = fields.Numeric(
+        'Round Off Amount', digits=(16, 4), readonly=True
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(SaleChannelDailySummary, cls).__setup__()
+        cls._sql_constraints += [
+            ('channel_day_delivery_mode_uniq',
+                'UNIQUE(channel, day, delivery_mode)',
+                'The summary must be unique per channel, day and delivery '
+                'mode.'),
+        ]
+        cls._order.insert(0, ('day', 'DESC'))
+        cls.__rpc__.update({
+            'rebuild': RPC(readonly=False),
+        })
+
+    @staticmethod
+    def _key(line):
+        return (line.sale.channel.id, line.sale.sale_date, line.delivery_mode)
+
+    @classmethod
+    def add_lines(cls, lines):
+        """
+        Add the lines to the summary of their channel, day and delivery mode.
+
+        A sale is counted once for each delivery mode of the lines added,
+        round off lines excepted as they are added to counted sales.
+        """
+        totals = cls._totals(
+            (cls._key(line), line.sale.id, line.is_round_off, 1,
+                line.quantity or 0.0, line.amount)
+            for line in lines
+            if line.type == 'line' and line.sale.sale_date
+        )
+        for key, total in totals.iteritems():
+            cls._add(key, total)
+
+    @staticmethod
+    def _totals(groups):
+        """
+        Return the totals per key of the groups of lines, which are tuples
+        of the key, the sale id, whether the lines are round off lines, the
+        number of lines, their quantity and their amount
+        """
+        totals = defaultdict(lambda: {
+            'sales': set(),
+            'lines': 0,
+            'quantity': 0.0,
+            'amount': Decimal('0'),
+            'round_off_amount': Decimal('0'),
+        })
+        for key, sale_id, is_round_off, count, quantity, amount in groups:
+            total = totals[key]
+            total['lines'] += count
+            total['quantity'] += quantity
+            if is_round_off:
+                total['round_off_amount'] += amount
+            else:
+                total['sales'].add(sale_id)
+                total['amount'] += amount
+        for total in totals.itervalues():
+            total['sales'] = len(total['sales'])
+        return totals
+
+    @classmethod
+    def _add(cls, key, total):
+        """
+        Add the totals to the row of the key, creating it if needed.
+
+        The row is updated in the database, like a counter, so the
+        concurrent transactions adding to it do not override each other.
+        """
+        table = cls.__table__()
+        cursor = Transaction().cursor
+        channel, day, delivery_mode = key
+
+        if delivery_mode:
+            same_mode = table.delivery_mode == delivery_mode
+        else:
+            # Not compared with "= NULL" which never matches, and the unique
+            # constraint does not prevent duplicate rows without mode
+            same_mode = Coalesce(table.delivery_mode, '') == ''
+
+        columns = ['sales', 'lines', 'quantity', 'amount', 'round_off_amount']
+        cursor.execute(*table.update(
+            [getattr(table, name) for name in columns],
+            [getattr(table, name) + total[name] for name in columns],
+            where=(
+                (table.channel == channel) &
+                (table.day == day) &
+                same_mode
+            )
+        ))
+        if cursor.rowcount:
+            return
+        cls.create([dict(
+            ((name, total[name]) for name in columns),
+            channel=channel, day=day, delivery_mode=delivery_mode
+        )])
+
+    @classmethod
+    def rebuild(cls, channels=None, start_date=None, end_date=None):
+        """
+        Compute again the summary of the POS sales of the channels (all the
+        POS channels by default) for the dates between start_date and
+        end_date (included), from the processing and done sales.
+        """
+        pool = Pool()
+        Channel = pool.get('sale.channel')
+        Currency = pool.get('currency.currency')
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+
+        if channels is None:
+            channels = Channel.search([('source', '=', 'pos')])
+        channel_ids = map(int, channels)
+
+        domain = [('channel', 'in', channel_ids)]
+        if start_date:
+            domain.append(('day', '>=', start_date))
+        if end_date:
+            domain.append(('day', '<=', end_date))
+        cls.delete(cls.search(domain))
+        if not channel_ids:
+            return
+
+        sale = Sale.__table__()
+        line = SaleLine.__table__()
+        cursor = Transaction().cursor
+
+        where = (
+            sale.channel.in_(channel_ids) &
+            sale.state.in_(['processing', 'done']) &
+            (sale.sale_date != Null) &
+            (line.type == 'line')
+        )
+        if start_date:
+            where &= (sale.sale_date >= start_date)
+        if end_date:
+            where &= (sale.sale_date <= end_date)
+
+        # Lines of a sale with the same quantity and unit price are grouped
+        # and their amount is rounded per line, like the amount of the lines
+        # added by add_lines
+        round_off = Coalesce(line.is_round_off, False)
+        group_by = [
+            sale.channel, sale.sale_date, line.delivery_mode, sale.id,
+            sale.currency, round_off, line.quantity, line.unit_price,
+        ]
+        query = line.join(sale, condition=(sale.id == line.sale)).select(
+            *(group_by + [Count(line.id)]), where=where, group_by=group_by
+        )
+        cursor.execute(*query)
+        rows = cursor.fetchall()
+
+        currencies = dict((c.id, c) for c in Currency.browse(
+            list(set(row[4] for row in rows))
+        ))
+        groups = []
+        for (channel, day, delivery_mode, sale_id, currency, is_round_off,
+                quantity, unit_price, count) in rows:
+            amount = currencies[currency].round(
+                Decimal(str(quantity or 0.0)) * Decimal(str(unit_price or 0))
+            )
+            groups.append((
+                (channel, day, delivery_mode), sale_id, is_round_off, count,
+                (quantity or 0.0) * count, amount * count,
+            ))
+        cls.create([
+            dict(total, channel=channel, day=day, delivery_mode=delivery_mode)
+            for (channel, day, delivery_mode), total
+            in cls._totals(groups).iteritems()
+        ])
@@ -10,6 +10,7 @@ import trytond.tests.test_tryton
 from tests.test_views_depends import TestViewsDepends
 from tests.test_sale import TestSale
 from tests.test_address import TestAddress
+from tests.test_coalesce import TestCoalescer
 
 
 def suite():
@@ -17,10 +18,13 @@ def suite():
     Define suite
     """
     test_suite = trytond.tests.test_tryton.suite()
+    # TestSale commits its fixtures to the database (see setup_defaults),
+    # so it runs last not to change the database of the other test cases
     test_suite.addTests([
-        unittest.TestLoader().loadTestsFromTestCase(TestSale),
         unittest.TestLoader().loadTestsFromTestCase(TestAddress),
         unittest.TestLoader().loadTestsFromTestCase(TestViewsDepends),
+        unittest.TestLoader().loadTestsFromTestCase(TestCoalescer),
+        unittest.TestLoader().loadTestsFromTestCase(TestSale),
     ])
     return test_suite
 
@@ -23,6 +23,9 @@ class TestAddress(unittest.TestCase):
     Address Test Case for lie-nielsen module.
     '''
 
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('pos')
+
     def setup_defaults(self):
         """
         Setup Defaults
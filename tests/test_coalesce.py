@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_coalesce.py
+
+"""
+import sys
+import os
+import unittest
+from threading import Thread, Lock
+
+import trytond.tests.test_tryton
+
+DIR = os.path.abspath(os.path.normpath(os.path.join(
+    __file__, '..', '..', '..', '..', '..', 'trytond'
+)))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+
+from trytond.modules.pos.coalesce import Coalescer  # noqa
+
+
+class TestCoalescer(unittest.TestCase):
+    '''
+    Test the coalescing of rapid repeated calls
+    '''
+
+    def _run_concurrently(self, coalescer, calls, window=0.2):
+        """
+        Start one thread per call, each a tuple of key and value, and
+        return the results in order of the calls as well as the values
+        actually run.
+        """
+        results = [None] * len(calls)
+        ran = []
+        lock = Lock()
+
+        def call(index, key, value):
+            def function():
+                with lock:
+                    ran.append(value)
+                return value
+            results[index] = coalescer.run(key, window, function)
+
+        threads = []
+        for index, (key, value) in enumerate(calls):
+            thread = Thread(target=call, args=(index, key, value))
+            thread.start()
+            threads.append(thread)
+            # Keep the order of arrival
+            thread.join(0.01)
+        for thread in threads:
+            thread.join()
+        return results, ran
+
+    def test_0010_coalesce_same_key(self):
+        """
+        Only the last call of a key runs and all callers get its result
+        """
+        results, ran = self._run_concurrently(
+            Coalescer(), [('scan', i) for i in range(1, 11)]
+        )
+        self.assertEqual(ran, [10])
+        self.assertEqual(results, [10] * 10)
+
+    def test_0020_different_keys(self):
+        """
+        Calls for different keys are not coalesced
+        """
+        results, ran = self._run_concurrently(
+            Coalescer(), [('a', 1), ('b', 2), ('a', 3)]
+        )
+        self.assertEqual(sorted(ran), [2, 3])
+        self.assertEqual(results, [3, 2, 3])
+
+    def test_0030_failure(self):
+        """
+        Superseded calls run themselves if the last call fails
+        """
+        coalescer = Coalescer()
+        results = []
+
+        def failing():
+            raise ValueError
+
+        def superseded():
+            results.append(coalescer.run('key', 0.2, lambda: 'own'))
+
+        thread = Thread(target=superseded)
+        thread.start()
+        thread.join(0.01)
+        self.assertRaises(ValueError, coalescer.run, 'key', 0.2, failing)
+        thread.join()
+        self.assertEqual(results, ['own'])
+
+
+def suite():
+    """
+    Define suite
+    """
+    test_suite = trytond.tests.test_tryton.suite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestCoalescer)
+    )
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
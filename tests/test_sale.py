@@ -6,14 +6,22 @@
 import sys
 import os
 import unittest
+import json
 import datetime
+import shutil
+import threading
+import tempfile
+from io import BytesIO
 from decimal import Decimal
 from dateutil.relativedelta import relativedelta
+from PIL import Image
 
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
 from trytond.transaction import Transaction
 from trytond.exceptions import UserError
+from trytond import backend
+from trytond.config import config
 
 DIR = os.path.abspath(os.path.normpath(os.path.join(
     __file__, '..', '..', '..', '..', '..', 'trytond'
@@ -21,6 +29,28 @@ DIR = os.path.abspath(os.path.normpath(os.path.join(
 if os.path.isdir(DIR):
     sys.path.insert(0, os.path.dirname(DIR))
 
+from trytond.modules.pos import session as cart_session  # noqa
+from trytond.modules.pos.totals import compute_totals  # noqa
+from trytond.modules.pos.querystats import max_queries  # noqa
+from trytond.modules.pos.latency import Histogram  # noqa
+from trytond.modules.pos import replica  # noqa
+from trytond.modules.pos import batch  # noqa
+from trytond.modules.pos import sale as sale_module  # noqa
+from trytond.modules.pos.sale import _scan_coalescer as scan_coalescer  # noqa
+from trytond.modules.pos.columnar import encode_lines, decode_lines  # noqa
+from trytond.modules.pos.binary import pack, unpack  # noqa
+
+# Attributes of the test case set by setup_defaults
+DEFAULTS = [
+    'usd', 'country', 'subdivision', 'uom', 'party', 'anonymous_customer',
+    'address', 'company', 'payment_term', 'channel', 'channel1', 'category',
+    'template1', 'template2', 'template3', 'template4', 'product1',
+    'product2', 'product3', 'product4',
+]
+
+# Ids of the records of setup_defaults committed in each database
+_snapshots = {}
+
 
 class TestSale(unittest.TestCase):
     '''
@@ -212,9 +242,106 @@ class TestSale(unittest.TestCase):
         }])
         return guest_price_list.id, user_price_list.id
 
+    def _create_products(self, count, **values):
+        """
+        Create salable goods with list prices of 10, 11, 12... and return
+        their products
+
+        :param count: Number of products
+        :param values: Other values of the templates
+        """
+        vlist = []
+        for i in xrange(count):
+            template_values = {
+                'category': self.category.id,
+                'type': 'goods',
+                'salable': True,
+                'list_price': Decimal('10') + i,
+                'cost_price': Decimal('5'),
+                'account_expense': self._get_account_by_kind('expense').id,
+                'account_revenue': self._get_account_by_kind('revenue').id,
+            }
+            template_values.update(values)
+            vlist.append(template_values)
+        return [
+            template.products[0]
+            for template in self._create_product_template('product', vlist)
+        ]
+
+    def _create_stock(self, products, quantity):
+        """
+        Put the quantity of each product in the storage of the warehouse
+        with one inventory
+        """
+        Inventory = POOL.get('stock.inventory')
+
+        warehouse, = self.Location.search([('code', '=', 'WH')])
+        inventory, = Inventory.create([{
+            'location': warehouse.storage_location,
+            'company': self.company.id,
+            'lines': [('create', [{
+                'product': product.id,
+                'quantity': quantity,
+            } for product in products])]
+        }])
+        Inventory.confirm([inventory])
+
+    def _create_cart(
+            self, products, quantity=1, delivery_mode='pick_up', **values):
+        """
+        Create a draft sale of the anonymous customer of the channel with a
+        line of the quantity of each product at its list price, all the lines
+        being created at once
+
+        :param values: Other values of the sale
+        """
+        sale_values = {
+            'currency': self.usd.id,
+            'company': self.company.id,
+            'channel': self.channel.id,
+            'invoice_address': self.address.id,
+            'shipment_address': self.address.id,
+        }
+        sale_values.update(values)
+        with Transaction().set_context(use_anonymous_customer=True):
+            sale, = self.Sale.create([sale_values])
+        self.SaleLine.create([{
+            'sale': sale.id,
+            'type': 'line',
+            'quantity': quantity,
+            'unit': self.uom,
+            'unit_price': product.list_price,
+            'description': product.rec_name,
+            'delivery_mode': delivery_mode,
+            'product': product.id,
+            'taxes': [('add', map(int, product.customer_taxes_used))],
+        } for product in products])
+        return self.Sale(sale.id)
+
     def setup_defaults(self):
         """
         Setup Defaults
+
+        The records are created and committed once per database, as a
+        snapshot every test starts from: the transaction of a test is rolled
+        back, so its changes are undone for the next one. The attributes of
+        the test case are bound to the records of the snapshot.
+        """
+        snapshot = _snapshots.get(DB_NAME)
+        if snapshot is None:
+            self._create_defaults()
+            snapshot = dict(
+                (name, (getattr(self, name).__name__, getattr(self, name).id))
+                for name in DEFAULTS
+            )
+            Transaction().cursor.commit()
+            _snapshots[DB_NAME] = snapshot
+        for name, (model, record_id) in snapshot.iteritems():
+            setattr(self, name, POOL.get(model)(record_id))
+
+    def _create_defaults(self):
+        """
+        Create the records of setup_defaults
         """
         Uom = POOL.get('product.uom')
         AccountTax = POOL.get('account.tax')
@@ -441,6 +568,23 @@ class TestSale(unittest.TestCase):
 
             self.assertEqual(len(rv['sale']['lines']), 2)
 
+    def test_0015_sale_line_lookup_indexes(self):
+        """
+        Ensure the indexes used by POS line lookups exist and that
+        registering them again is harmless
+        """
+        TableHandler = backend.get('TableHandler')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            table = TableHandler(transaction.cursor, self.SaleLine, 'pos')
+            self.assertIn(
+                'sale_line_sale_product_delivery_mode_index', table._indexes
+            )
+            self.assertIn('sale_line_sale_is_round_off_index', table._indexes)
+
+            # Module update
+            self.SaleLine.__register__('pos')
+
     def test_0020_test_delivery_mode_on_adding(self):
         """
         Ensure that delivery mode is respected when added to cart
@@ -583,12 +727,19 @@ class TestSale(unittest.TestCase):
                 sale_line = self.SaleLine(rv['updated_lines'][0])
                 self.assertEqual(rv['sale']['tax_amount'], Decimal('3'))
 
-    def test_0030_serialization_fallback(self):
+    def test_0027_pos_on_change(self):
         """
-        Ensure that serialization for other purposes still work
+        Evaluate the onchanges of a new line in a single pass
         """
+        Location = POOL.get('stock.location')
+
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
             self.setup_defaults()
+
+            backorder_warehouse, = Location.copy([self.channel.warehouse])
+            self.Channel.write([self.channel], {
+                'backorder_warehouse': backorder_warehouse.id
+            })
             with Transaction().set_context(use_anonymous_customer=True):
                 sale, = self.Sale.create([{
                     'currency': self.usd.id,
@@ -596,317 +747,1852 @@ class TestSale(unittest.TestCase):
 
             with Transaction().set_context(
                     company=self.company.id, channel=self.channel.id):
-                rv = sale.pos_add_product([self.product1.id], 1)
-                sale_line = self.SaleLine(rv['updated_lines'][0])
+                values = sale._pos_line_parent_values()
+                values.update({
+                    'product': self.product3.id,
+                    'sale': sale.id,
+                    'type': 'line',
+                    'quantity': 2,
+                    'unit': None,
+                    'description': None,
+                    'delivery_mode': 'ship',
+                })
+                line = self.SaleLine(**values)
+                rv = line.pos_on_change(
+                    ['product', 'quantity', 'delivery_mode']
+                )
 
-            # Serialize sale
-            sale.serialize()
-            sale_line.serialize()
+            self.assertEqual(rv['unit'], self.product3.sale_uom.id)
+            self.assertEqual(rv['unit_price'], Decimal('15'))
+            self.assertEqual(rv['taxes'], [
+                tax.id for tax in self.product3.customer_taxes_used
+            ])
+            self.assertEqual(rv['warehouse'], backorder_warehouse.id)
+            # Changes are applied on the instance as they are evaluated
+            self.assertEqual(line.unit_price, Decimal('15'))
+            self.assertEqual(line.warehouse, backorder_warehouse)
 
-    def test_0035_sale_pos_serialization(self):
+            self.assertEqual(
+                self.SaleLine._pos_on_change_methods(set(['quantity'])),
+                ['on_change_quantity']
+            )
+
+    def test_0028_pos_update_lines(self):
         """
-        Serialize sale for pos
+        Update quantity, price and delivery mode of known lines
         """
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
             self.setup_defaults()
             with Transaction().set_context(use_anonymous_customer=True):
                 sale, = self.Sale.create([{
                     'currency': self.usd.id,
-                    'invoice_address': self.address,
-                    'shipment_address': self.address,
+                }])
+                other_sale, = self.Sale.create([{
+                    'currency': self.usd.id,
                 }])
 
             with Transaction().set_context(
                     company=self.company.id, channel=self.channel.id):
-                sale.pos_add_product([self.product1.id], 1)
+                rv = sale.pos_add_product(
+                    [self.product1.id, self.product3.id], 1
+                )
+                line1, line3 = rv['updated_lines']
+
+                rv = sale.pos_update_lines([{
+                    'id': line1,
+                    'quantity': 3,
+                }, {
+                    'id': line3,
+                    'unit_price': Decimal('20'),
+                    'delivery_mode': 'ship',
+                }])
 
-            # Serialize sale for pos
-            rv = sale.pos_serialize()
-            self.assertEqual(rv['total_amount'], sale.total_amount)
-            self.assertEqual(rv['tax_amount'], sale.tax_amount)
-            self.assertEqual(len(rv['lines']), 1)
+                self.assertEqual(len(rv['lines']), 2)
+                self.assertEqual(rv['lines'][0]['id'], line1)
+                self.assertEqual(rv['lines'][0]['quantity'], 3)
+                self.assertEqual(rv['lines'][0]['amount'], Decimal('30'))
+                self.assertEqual(rv['lines'][1]['id'], line3)
+                self.assertEqual(rv['lines'][1]['quantity'], 1)
+                self.assertEqual(rv['lines'][1]['delivery_mode'], 'ship')
+                self.assertEqual(rv['lines'][1]['amount'], Decimal('20'))
+                self.assertEqual(rv['untaxed_amount'], Decimal('50'))
+                self.assertEqual(rv['tax_amount'], Decimal('2'))
+                self.assertEqual(rv['total_amount'], sale.total_amount)
+
+                # Lines of another sale cannot be updated
+                with self.assertRaises(UserError):
+                    other_sale.pos_update_lines([{
+                        'id': line1,
+                        'quantity': 1,
+                    }])
 
-    def test_0040_default_delivery_mode(self):
+    def test_0029_pos_add_product_replay(self):
         """
-        Test default delivery_mode for saleLine
+        Retried requests with the same request id are replayed
         """
+        POSRequest = POOL.get('sale.pos.request')
+
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
             self.setup_defaults()
-            with Transaction().set_context(
-                use_anonymous_customer=True, channel=self.channel.id
-            ):
+            with Transaction().set_context(use_anonymous_customer=True):
                 sale, = self.Sale.create([{
                     'currency': self.usd.id,
                 }])
 
-            self.assertEqual(sale.channel.delivery_mode, 'ship')
             with Transaction().set_context(
-                company=self.company.id, channel=self.channel.id,
-                current_channel=self.channel.id
-            ):
-                sale_line, = self.SaleLine.create([{
-                    'sale': sale.id,
-                    'product': self.product1.id,
-                    'description': 'test product',
-                    'quantity': 1,
-                    'unit': self.product1.default_uom.id,
-                    'unit_price': Decimal('10'),
-                }])
+                    company=self.company.id, channel=self.channel.id):
+                with Transaction().set_context(pos_request_id='req-1'):
+                    rv1 = sale.pos_add_product([self.product1.id], 1)
+                    # A retry gets the stored response and nothing is
+                    # changed
+                    rv2 = sale.pos_add_product([self.product1.id], 5)
+                self.assertEqual(rv1, rv2)
+                self.assertEqual(rv2['sale']['lines'][0]['quantity'], 1)
                 self.assertEqual(
-                    sale_line.delivery_mode, self.channel.delivery_mode
+                    rv2['sale']['total_amount'], Decimal('10')
                 )
+                self.assertEqual(len(sale.lines), 1)
+                self.assertEqual(sale.lines[0].quantity, 1)
 
-            with Transaction().set_user(0):
-                with Transaction().set_context(
-                    company=self.company.id, channel=None
-                ):
-                    new_sale_line, = self.SaleLine.create([{
-                        'sale': sale.id,
-                        'product': self.product4.id,
-                        'description': 'test service product',
-                        'quantity': 1,
-                        'unit': self.product4.default_uom.id,
-                        'unit_price': Decimal('10'),
-                    }])
-                    self.assertIsNone(new_sale_line.delivery_mode)
+                with Transaction().set_context(pos_request_id='req-2'):
+                    rv3 = sale.pos_add_product([self.product1.id], 5)
+                self.assertEqual(rv3['sale']['lines'][0]['quantity'], 5)
 
-            # Test if sale line's product type is goods
-            self.assertTrue(sale_line.product_type_is_goods)
-            self.assertFalse(new_sale_line.product_type_is_goods)
+                # Without request id nothing is stored
+                sale.pos_add_product([self.product1.id], 2)
+                self.assertEqual(POSRequest.search([], count=True), 2)
 
-    def test_0120_ship_pick_diff_warehouse(self):
+    def test_0031_pos_apply_operations(self):
         """
-        Ensure that backorder_warehouse is used for back orders while orders
-        are picked from the channel's warehouse
+        Apply a log of offline operations in one call
         """
-        Location = POOL.get('stock.location')
-        Channel = POOL.get('sale.channel')
-        Date = POOL.get('ir.date')
-
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
             self.setup_defaults()
-
-            backorder_warehouse, = Location.copy([self.channel.warehouse])
-
-            # Set that as the new backorder warehouse
-            Channel.write([self.channel], {
-                'backorder_warehouse': backorder_warehouse.id}
-            )
-
-            with Transaction().set_context({
-                    'company': self.company.id,
-                    'channel': self.channel.id,
-                    'channels': [self.channel.id], }):
-                # Now create an order
+            with Transaction().set_context(use_anonymous_customer=True):
                 sale, = self.Sale.create([{
-                    'reference': 'Test Sale',
-                    'payment_term': self.payment_term,
-                    'currency': self.company.currency.id,
-                    'party': self.party.id,
-                    'invoice_address': self.party.addresses[0].id,
-                    'shipment_address': self.party.addresses[0].id,
-                    'sale_date': Date.today(),
-                    'company': self.company.id,
+                    'currency': self.usd.id,
+                }])
 
-                    # keep invoicing out of the way for this test's sake
-                    'invoice_method': 'manual',
-                    'shipment_method': 'order',
+            with Transaction().set_context(
+                    company=self.company.id, channel=self.channel.id):
+                rv = sale.pos_add_product([self.product1.id], 1)
+                line1, = rv['updated_lines']
 
-                    # Explicitly specify the channel
-                    'channel': Channel(self.channel).id,
-                }])
-                line1, = self.SaleLine.create([{
-                    'sale': sale,
-                    'type': 'line',
+                operations = [{
+                    'type': 'add',
+                    'product': self.product2.id,
+                    'quantity': 1,
+                }] * 5
+                operations += [{
+                    'type': 'add',
+                    'product': self.product1.id,
+                    'quantity': 1,
+                }, {
+                    'type': 'set',
+                    'line': line1,
+                    'quantity': 3,
+                    'unit_price': Decimal('12'),
+                }, {
+                    'type': 'add',
+                    'product': self.product3.id,
+                    'delivery_mode': 'ship',
                     'quantity': 2,
-                    'delivery_mode': 'pick_up',
-                    'unit': self.uom,
-                    'unit_price': 20000,
-                    'description': 'Picked Item',
-                    'product': self.product1.id
+                }, {
+                    'type': 'add',
+                    'product': self.product4.id,
+                    'quantity': 1,
+                }, {
+                    'type': 'remove',
+                    'product': self.product4.id,
+                }]
+                rv = sale.pos_apply_operations(operations)
+
+            lines = dict(
+                ((line['product']['id'], line['delivery_mode']), line)
+                for line in rv['sale']['lines']
+            )
+            self.assertEqual(len(lines), 3)
+            self.assertEqual(lines[(self.product1.id, 'pick_up')]['id'], line1)
+            self.assertEqual(
+                lines[(self.product1.id, 'pick_up')]['quantity'], 3
+            )
+            self.assertEqual(
+                lines[(self.product1.id, 'pick_up')]['unit_price'],
+                Decimal('12')
+            )
+            self.assertEqual(
+                lines[(self.product2.id, 'pick_up')]['quantity'], 5
+            )
+            self.assertEqual(
+                lines[(self.product3.id, 'ship')]['quantity'], 2
+            )
+            self.assertEqual(rv['sale']['tax_amount'], Decimal('3'))
+            self.assertEqual(len(rv['updated_lines']), 3)
+
+            # Unknown lines are refused
+            with self.assertRaises(UserError):
+                sale.pos_apply_operations([{
+                    'type': 'remove',
+                    'line': -1,
                 }])
-                self.SaleLine.write([line1], line1.on_change_delivery_mode())
 
-                line2, = self.SaleLine.create([{
-                    'sale': sale,
-                    'type': 'line',
-                    'quantity': 2,
-                    'delivery_mode': 'ship',
-                    'unit': self.uom,
-                    'unit_price': 20000,
-                    'description': 'Shipped Item',
-                    'product': self.product1.id
+            # The operations of a line apply to it even if another line of
+            # the sale has the same product
+            duplicate, = self.SaleLine.copy([self.SaleLine(line1)])
+            with Transaction().set_context(
+                    company=self.company.id, channel=self.channel.id):
+                sale.pos_apply_operations([{
+                    'type': 'set',
+                    'line': duplicate.id,
+                    'quantity': 7,
                 }])
-                self.SaleLine.write([line2], line2.on_change_delivery_mode())
-
-                # Quote, Confirm and Process the order
-                self.Sale.quote([sale])
-                self.Sale.confirm([sale])
-                self.Sale.process([sale])
+                self.assertEqual(self.SaleLine(line1).quantity, 3)
+                self.assertEqual(self.SaleLine(duplicate.id).quantity, 7)
 
-                self.assertEqual(len(sale.shipments), 2)
-                for shipment in sale.shipments:
-                    if shipment.delivery_mode == 'pick_up':
-                        self.assertEqual(shipment.state, 'done')
-                        self.assertEqual(
-                            shipment.warehouse, self.channel.warehouse
-                        )
-                    elif shipment.delivery_mode == 'ship':
-                        self.assertEqual(shipment.state, 'waiting')
-                        self.assertEqual(
-                            shipment.warehouse, self.channel.backorder_warehouse
-                        )
-                    else:
-                        self.fail('Invalid delivery mode')
+                sale.pos_apply_operations([{
+                    'type': 'remove',
+                    'line': duplicate.id,
+                }])
+                self.assertEqual(
+                    map(int, self.Sale(sale.id).lines),
+                    [line['id'] for line in rv['sale']['lines']]
+                )
 
-    def test_1010_delivery_method_2shipping_case_1(self):
+    def test_0032_pos_add_product_by_code(self):
         """
-        Ensure shipment method is respected by sale order processing
-
-        Case 1: Ship only order
+        Add products by code
         """
-        Date = POOL.get('ir.date')
+        ProductProduct = POOL.get('product.product')
 
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
             self.setup_defaults()
+            ProductProduct.write([self.product1], {'code': 'P1'})
+            ProductProduct.write([self.product2], {'code': 'P2'})
 
-            sale, = self.Sale.create([{
-                'reference': 'Test Sale',
-                'payment_term': self.payment_term,
-                'currency': self.company.currency.id,
-                'party': self.party.id,
-                'invoice_address': self.party.addresses[0].id,
-                'shipment_address': self.party.addresses[0].id,
-                'sale_date': Date.today(),
-                'company': self.company.id,
+            with Transaction().set_context(use_anonymous_customer=True):
+                sale, = self.Sale.create([{
+                    'currency': self.usd.id,
+                }])
 
-                # keep invoicing out of the way for this test's sake
-                'invoice_method': 'manual',
-                'shipment_method': 'order',
-            }])
-            sale_line, = self.SaleLine.create([{
-                'sale': sale,
-                'type': 'line',
-                'quantity': 2,
-                'delivery_mode': 'ship',
-                'unit': self.uom,
-                'unit_price': 20000,
-                'description': 'Test description',
-                'product': self.product1.id
-            }])
+            with Transaction().set_context(
+                    company=self.company.id, channel=self.channel.id):
+                rv = sale.pos_add_product_by_code(['P1', 'P2'], 2)
+                self.assertEqual(len(rv['sale']['lines']), 2)
+                self.assertEqual(
+                    set(line['product']['id'] for line in rv['sale']['lines']),
+                    set([self.product1.id, self.product2.id])
+                )
 
-            # Quote, Confirm and Process the order
-            self.Sale.quote([sale])
-            self.Sale.confirm([sale])
-            self.Sale.process([sale])
+                with self.assertRaises(UserError):
+                    sale.pos_add_product_by_code(['P3'], 1)
 
-            self.assertEqual(len(sale.shipments), 1)
-            self.assertEqual(sale.shipments[0].delivery_mode, 'ship')
-            self.assertEqual(sale.shipments[0].state, 'waiting')
+            # The index follows changes of codes
+            self.assertEqual(
+                ProductProduct.get_ids_by_code(['P1']),
+                {'P1': self.product1.id}
+            )
+            ProductProduct.write([self.product1], {'code': 'P3'})
+            ProductProduct.write([self.product3], {'code': 'P1'})
+            self.assertEqual(
+                ProductProduct.get_ids_by_code(['P1', 'P3']),
+                {'P1': self.product3.id, 'P3': self.product1.id}
+            )
+
+    def test_0033_pos_park(self):
+        """
+        Park a cart and resume it
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            with Transaction().set_context(use_anonymous_customer=True):
+                sale, = self.Sale.create([{
+                    'currency': self.usd.id,
+                }])
+
+            with Transaction().set_context(
+                    company=self.company.id, channel=self.channel.id):
+                sale.pos_add_product([self.product1.id], 2)
+                with Transaction().set_context(delivery_mode='ship'):
+                    sale.pos_add_product([self.product2.id], 1, 5)
+                line1, line2 = self.Sale(sale.id).lines
+                self.SaleLine.write([line1], {'sequence': 2, 'note': 'Gift'})
+                self.SaleLine.write([line2], {'sequence': 1})
+                lines = sorted(
+                    (line.product, line.quantity, line.unit_price,
+                        line.delivery_mode, line.unit, tuple(line.taxes))
+                    for line in self.Sale(sale.id).lines
+                )
+                total_amount = self.Sale(sale.id).total_amount
+
+                rv = sale.pos_park()
+                self.assertTrue(rv['parked'])
+                self.assertEqual(rv['lines'], [])
+                self.assertFalse(self.SaleLine.search([('sale', '=', sale)]))
+
+                with Transaction().set_context(
+                        current_channel=self.channel.id):
+                    parked = self.Sale.get_parked_sales()
+                    self.assertEqual([s['id'] for s in parked], [sale.id])
+                    self.assertNotIn(
+                        sale.id,
+                        [s['id'] for s in self.Sale.get_recent_sales()]
+                    )
+
+                with self.assertRaises(UserError):
+                    self.Sale(sale.id).pos_park()
+                with self.assertRaises(UserError):
+                    self.Sale(sale.id).pos_checkout()
+                with self.assertRaises(UserError):
+                    self.Sale(sale.id).pos_add_product([self.product1.id], 3)
+                with self.assertRaises(UserError):
+                    self.Sale(sale.id).pos_update_lines([
+                        {'id': line1.id, 'quantity': 3},
+                    ])
+                with self.assertRaises(UserError):
+                    self.Sale(sale.id).pos_apply_operations([
+                        {'type': 'add', 'product': self.product1.id,
+                            'quantity': 1},
+                    ])
+                with self.assertRaises(UserError):
+                    self.Sale(sale.id).pos_session_apply([
+                        {'type': 'add', 'product': self.product1.id,
+                            'quantity': 1},
+                    ])
+
+                rv = self.Sale(sale.id).pos_unpark()
+                self.assertFalse(rv['parked'])
+                sale = self.Sale(sale.id)
+                self.assertEqual(sorted(
+                    (line.product, line.quantity, line.unit_price,
+                        line.delivery_mode, line.unit, tuple(line.taxes))
+                    for line in sale.lines
+                ), lines)
+                self.assertEqual(sale.total_amount, total_amount)
+                self.assertEqual(
+                    [(line.product, line.sequence, line.note)
+                        for line in sale.lines],
+                    [(self.product2, 1, None), (self.product1, 2, 'Gift')]
+                )
+                with Transaction().set_context(
+                        current_channel=self.channel.id):
+                    self.assertEqual(self.Sale.get_parked_sales(), [])
+
+                with self.assertRaises(UserError):
+                    sale.pos_unpark()
+
+                # Snapshots without the fields appended since still resume
+                warehouse = sale.lines[0].warehouse
+                sale.pos_park()
+                self.Sale.write([sale], {
+                    'pos_parked_lines': json.dumps([
+                        ['line', self.product1.id, self.uom.id, 1.0, '10',
+                            'pick_up', 'Old', warehouse.id, []],
+                    ]),
+                })
+                sale = self.Sale(sale.id)
+                sale.pos_unpark()
+                line, = self.Sale(sale.id).lines
+                self.assertEqual(
+                    (line.product, line.quantity, line.description,
+                        line.sequence),
+                    (self.product1, 1, 'Old', None)
+                )
+
+    def test_0034_pos_session(self):
+        """
+        Change a cart in a session and flush it
+        """
+        Journal = POOL.get('sale.pos.cart_journal')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            with Transaction().set_context(use_anonymous_customer=True):
+                sale, = self.Sale.create([{
+                    'currency': self.usd.id,
+                }])
+
+            with Transaction().set_context(
+                    company=self.company.id, channel=self.channel.id):
+                rv = sale.pos_add_product([self.product1.id], 1)
+                line_id, = rv['updated_lines']
+
+                rv = sale.pos_session_apply([
+                    {'type': 'add', 'product': self.product1.id,
+                        'quantity': 1},
+                    {'type': 'add', 'product': self.product1.id,
+                        'quantity': 1},
+                    {'type': 'set', 'product': self.product2.id,
+                        'delivery_mode': 'ship', 'quantity': 2,
+                        'unit_price': '5'},
+                    {'type': 'add', 'product': self.product3.id,
+                        'quantity': 1},
+                ])
+                rv = sale.pos_session_apply([
+                    {'type': 'remove', 'product': self.product3.id},
+                ])
+                self.assertEqual(len(rv['lines']), 2)
+                line1, line2 = rv['lines']
+                self.assertEqual(line1['line'], line_id)
+                self.assertEqual(line1['quantity'], 3)
+                self.assertEqual(line2['line'], None)
+                self.assertEqual(line2['unit_price'], Decimal('5'))
+                self.assertEqual(line2['amount'], Decimal('10'))
+                self.assertEqual(
+                    rv['untaxed_amount'], line1['amount'] + Decimal('10')
+                )
+
+                # The lines of the sale are not changed
+                self.assertEqual(len(self.Sale(sale.id).lines), 1)
+                self.assertEqual(self.SaleLine(line_id).quantity, 1)
+
+                # The session is loaded back from the journal
+                cart_session._sessions.clear()
+                self.assertEqual(self.Sale(sale.id).pos_session(), rv)
+
+                with self.assertRaises(UserError):
+                    sale.pos_session_apply([{'type': 'add', 'line': -1}])
+
+                rv = self.Sale(sale.id).pos_session_flush()
+                sale = self.Sale(sale.id)
+                self.assertEqual(len(sale.lines), 2)
+                self.assertEqual(self.SaleLine(line_id).quantity, 3)
+                self.assertEqual(
+                    sale.untaxed_amount, rv['sale']['untaxed_amount']
+                )
+                self.assertEqual(Journal.last_entry(sale), None)
+
+                # A pending session is flushed at checkout
+                sale.pos_session_apply([
+                    {'type': 'remove', 'product': self.product2.id,
+                        'delivery_mode': 'ship'},
+                ])
+                self.assertEqual(len(self.Sale(sale.id).lines), 2)
+                self.Sale(sale.id)._pos_flush_pending_session()
+                self.assertEqual(len(self.Sale(sale.id).lines), 1)
+
+                # The operations of a line apply to it even if another line
+                # of the sale has the same product
+                duplicate, = self.SaleLine.copy([self.SaleLine(line_id)])
+                rv = self.Sale(sale.id).pos_session_apply([
+                    {'type': 'set', 'line': duplicate.id, 'quantity': 4},
+                ])
+                self.assertEqual(
+                    [(line['line'], line['quantity']) for line in rv['lines']],
+                    [(line_id, 3), (duplicate.id, 4)]
+                )
+                cart_session._sessions.clear()
+                self.assertEqual(self.Sale(sale.id).pos_session(), rv)
+                self.Sale(sale.id).pos_session_flush()
+                self.assertEqual(self.SaleLine(line_id).quantity, 3)
+                self.assertEqual(self.SaleLine(duplicate.id).quantity, 4)
+
+                # The journal entries of a deleted line are skipped
+                self.Sale(sale.id).pos_session_apply([
+                    {'type': 'set', 'line': duplicate.id, 'quantity': 5},
+                ])
+                self.SaleLine.delete([self.SaleLine(duplicate.id)])
+                cart_session._sessions.clear()
+                rv = self.Sale(sale.id).pos_session()
+                self.assertEqual(
+                    [line['line'] for line in rv['lines']], [line_id]
+                )
+
+                # Rejected operations change neither the journal nor the
+                # session
+                last_entry = Journal.last_entry(sale)
+                with self.assertRaises(UserError):
+                    self.Sale(sale.id).pos_session_apply([
+                        {'type': 'bogus', 'product': self.product2.id},
+                    ])
+                with self.assertRaises(UserError):
+                    self.Sale(sale.id).pos_session_apply([
+                        {'type': 'set', 'line': duplicate.id, 'quantity': 1},
+                    ])
+                self.assertEqual(Journal.last_entry(sale), last_entry)
+
+                if not config.has_section('pos'):
+                    config.add_section('pos')
+                config.set('pos', 'session_size_limit', '1')
+                try:
+                    self.Sale(sale.id).pos_session_apply([
+                        {'type': 'add', 'line': line_id, 'quantity': 1},
+                    ])
+                    last_entry = Journal.last_entry(sale)
+                    rv = self.Sale(sale.id).pos_session()
+                    with self.assertRaises(UserError):
+                        self.Sale(sale.id).pos_session_apply([
+                            {'type': 'add', 'product': self.product2.id,
+                                'quantity': 1},
+                        ])
+                finally:
+                    config.remove_option('pos', 'session_size_limit')
+                self.assertEqual(Journal.last_entry(sale), last_entry)
+                self.assertEqual(self.Sale(sale.id).pos_session(), rv)
+
+                # The other changes of the cart apply after the session
+                self.Sale(sale.id).pos_session_apply([
+                    {'type': 'set', 'line': line_id, 'quantity': 2},
+                ])
+                self.Sale(sale.id).pos_add_product([self.product1.id], 7)
+                self.assertEqual(Journal.last_entry(sale), None)
+                self.assertEqual(self.SaleLine(line_id).quantity, 7)
+
+                self.Sale(sale.id).pos_session_apply([
+                    {'type': 'set', 'line': line_id, 'quantity': 2},
+                ])
+                self.Sale(sale.id).pos_update_lines([
+                    {'id': line_id, 'quantity': 6},
+                ])
+                self.assertEqual(Journal.last_entry(sale), None)
+                self.assertEqual(self.SaleLine(line_id).quantity, 6)
+
+                self.Sale(sale.id).pos_session_apply([
+                    {'type': 'set', 'line': line_id, 'quantity': 2},
+                ])
+                self.Sale(sale.id).pos_apply_operations([
+                    {'type': 'add', 'line': line_id, 'quantity': 1},
+                ])
+                self.assertEqual(Journal.last_entry(sale), None)
+                self.assertEqual(self.SaleLine(line_id).quantity, 3)
+
+                rv = self.Sale(sale.id).pos_session()
+                self.assertEqual(
+                    [(line['line'], line['quantity']) for line in rv['lines']],
+                    [(line_id, 3)]
+                )
+                self.Sale(sale.id).pos_session_flush()
+                self.assertEqual(self.SaleLine(line_id).quantity, 3)
+
+    def test_0036_pos_compute_totals(self):
+        """
+        Compute the totals of carts at once like the sale amounts
+        """
+        Configuration = POOL.get('account.configuration')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            with Transaction().set_context(use_anonymous_customer=True):
+                sales = self.Sale.create([{
+                    'currency': self.usd.id,
+                } for i in range(2)])
+
+            with Transaction().set_context(
+                    company=self.company.id, channel=self.channel.id):
+                self.SaleLine.create([{
+                    'sale': sales[i % 2],
+                    'type': 'line',
+                    'quantity': 1 + i % 7,
+                    'unit': self.uom,
+                    'unit_price': Decimal('0.333') * (1 + i % 5),
+                    'description': 'Item',
+                    'delivery_mode': 'pick_up',
+                    'product': self.product3.id,
+                    'taxes': [
+                        ('add', map(int, self.product3.customer_taxes_used))
+                    ],
+                } for i in range(50)])
+
+            for tax_rounding in ('document', 'line'):
+                Configuration.write([Configuration(1)], {
+                    'tax_rounding': tax_rounding,
+                })
+                totals = compute_totals(self.Sale.browse(sales))
+                for sale in self.Sale.browse(sales):
+                    untaxed_amount = sum(line.amount for line in sale.lines)
+                    tax_amount = sale.get_tax_amount()
+                    self.assertTrue(tax_amount)
+                    self.assertEqual(totals[sale.id], (
+                        untaxed_amount, tax_amount,
+                        untaxed_amount + tax_amount
+                    ))
+                    self.assertEqual(sale.total_amount, totals[sale.id][2])
+
+            # The amounts of the sales of other channels are computed as
+            # usual
+            manual, = self.Channel.copy([self.channel], {'source': 'manual'})
+            computed = []
+
+            def record_totals(sales):
+                computed.extend(map(int, sales))
+                return compute_totals(sales)
+
+            # The rules give access to the sales of the channels of the user
+            with Transaction().set_user(0), Transaction().set_context(
+                    company=self.company.id,
+                    allowed_read_channels=[manual.id]):
+                other = self._create_cart(
+                    [self.product3], channel=manual.id, party=self.party.id,
+                    invoice_address=self.party.addresses[0].id,
+                    shipment_address=self.party.addresses[0].id,
+                    payment_term=self.payment_term.id
+                )
+                sale_module.compute_totals = record_totals
+                try:
+                    amounts = [sale.total_amount for sale in self.Sale.browse(
+                        map(int, sales) + [other.id]
+                    )]
+                finally:
+                    sale_module.compute_totals = compute_totals
+                self.assertEqual(sorted(computed), sorted(map(int, sales)))
+                self.assertEqual(amounts, [
+                    totals[sale.id][2] for sale in sales
+                ] + [compute_totals([other])[other.id][2]])
+
+    def test_0037_pos_query_budget(self):
+        """
+        Check the SQL statements executed by the POS RPCs
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            products = self._create_products(30)
+
+            with Transaction().set_context(
+                    company=self.company.id, channel=self.channel.id):
+                small = self._create_cart(products[:2])
+                large = self._create_cart(products)
+                # Warm up the caches
+                self.Sale(small.id).serialize('pos')
+
+                # The statements do not depend on the number of lines
+                with max_queries(25) as small_queries:
+                    self.Sale(small.id).serialize('pos')
+                with max_queries(small_queries.count):
+                    self.Sale(large.id).serialize('pos')
+
+                with self.assertRaises(AssertionError):
+                    with max_queries(0):
+                        self.Sale(small.id).serialize('pos')
+
+                if not config.has_section('pos'):
+                    config.add_section('pos')
+                config.set('pos', 'query_stats', 'True')
+                try:
+                    self.Sale.pos_query_stats(reset=True)
+                    self.Sale(small.id).pos_serialize()
+                    self.Sale(large.id).pos_serialize()
+                finally:
+                    config.remove_option('pos', 'query_stats')
+                self.Sale(small.id).pos_serialize()
+
+                stats = self.Sale.pos_query_stats(reset=True)
+                self.assertEqual(stats.keys(), ['pos_serialize'])
+                self.assertEqual(stats['pos_serialize']['calls'], 2)
+                self.assertEqual(
+                    stats['pos_serialize']['max_queries'],
+                    small_queries.count
+                )
+                self.assertTrue(stats['pos_serialize']['slowest'])
+                self.assertEqual(self.Sale.pos_query_stats(), {})
+
+    def test_0038_pos_latency_stats(self):
+        """
+        Check the latency histograms of the POS entry points
+        """
+        histogram = Histogram()
+        self.assertEqual(histogram.percentile(50), 0)
+        for duration in [0.5] * 90 + [15] * 9 + [3000]:
+            histogram.add(duration)
+        self.assertEqual(histogram.count, 100)
+        self.assertTrue(0 < histogram.percentile(50) <= 1)
+        self.assertTrue(10 < histogram.percentile(99) <= 20)
+        self.assertEqual(histogram.percentile(100), 3000)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            with Transaction().set_context(use_anonymous_customer=True):
+                sale, = self.Sale.create([{
+                    'currency': self.usd.id,
+                }])
+
+            with Transaction().set_context(
+                    company=self.company.id, channel=self.channel.id,
+                    current_channel=self.channel.id):
+                if not config.has_section('pos'):
+                    config.add_section('pos')
+                config.set('pos', 'latency_stats', 'True')
+                try:
+                    self.Sale.pos_latency_stats(reset=True)
+                    sale.pos_add_product([self.product1.id], 1)
+                    self.Sale(sale.id).pos_serialize()
+                    self.Sale(sale.id).pos_serialize()
+                    self.Sale.get_recent_sales()
+                    self.Sale.round_down_total([self.Sale(sale.id)])
+                finally:
+                    config.remove_option('pos', 'latency_stats')
+                self.Sale(sale.id).pos_serialize()
+
+            stats = self.Sale.pos_latency_stats()
+            self.assertEqual(set(stats), set([
+                'pos_add_product', 'pos_serialize', 'get_recent_sales',
+                'round_down_total',
+            ]))
+            self.assertEqual(stats['pos_serialize'].keys(), ['0-9'])
+            values = stats['pos_serialize']['0-9']
+            self.assertEqual(values['count'], 2)
+            self.assertEqual(
+                sum(count for bound, count in values['buckets']), 2
+            )
+            self.assertTrue(values['p50'] <= values['p99'] <= values['max'])
+
+            text = self.Sale.pos_latency_stats(text=True, reset=True)
+            self.assertIn('pos_serialize', text)
+            self.assertEqual(self.Sale.pos_latency_stats(), {})
+
+    def test_0039_pos_large_cart(self):
+        """
+        Price and serialize a cart of many lines and check out a stocked one
+        """
+        Product = POOL.get('product.product')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            products = self._create_products(100)
+            stocked = products[:10]
+            self._create_stock(stocked, 10)
+            warehouse, = self.Location.search([('code', '=', 'WH')])
+
+            with Transaction().set_context(
+                    company=self.company.id, channel=self.channel.id):
+                sale = self._create_cart(products, quantity=2)
+                total = sum(2 * product.list_price for product in products)
+                self.assertEqual(sale.total_amount, total)
+
+                rv = sale.pos_serialize()
+                self.assertEqual(len(rv['lines']), 100)
+                self.assertEqual(rv['total_amount'], total)
+
+                sale = self._create_cart(
+                    stocked, quantity=2, shipment_method='order'
+                )
+                rv = sale.pos_checkout()
+                self.assertEqual(rv['sale']['state'], 'processing')
+
+            with Transaction().set_context(
+                    locations=[warehouse.storage_location.id]):
+                self.assertEqual(
+                    set(p.quantity for p in Product.browse(map(int, stocked))),
+                    set([8])
+                )
+
+    def test_0030_serialization_fallback(self):
+        """
+        Ensure that serialization for other purposes still work
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            with Transaction().set_context(use_anonymous_customer=True):
+                sale, = self.Sale.create([{
+                    'currency': self.usd.id,
+                }])
+
+            with Transaction().set_context(
+                    company=self.company.id, channel=self.channel.id):
+                rv = sale.pos_add_product([self.product1.id], 1)
+                sale_line = self.SaleLine(rv['updated_lines'][0])
+
+            # Serialize sale
+            sale.serialize()
+            sale_line.serialize()
+
+    def test_0035_sale_pos_serialization(self):
+        """
+        Serialize sale for pos
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            with Transaction().set_context(use_anonymous_customer=True):
+                sale, = self.Sale.create([{
+                    'currency': self.usd.id,
+                    'invoice_address': self.address,
+                    'shipment_address': self.address,
+                }])
+
+            with Transaction().set_context(
+                    company=self.company.id, channel=self.channel.id):
+                sale.pos_add_product([self.product1.id], 1)
+
+            # Serialize sale for pos
+            rv = sale.pos_serialize()
+            self.assertEqual(rv['total_amount'], sale.total_amount)
+            self.assertEqual(rv['tax_amount'], sale.tax_amount)
+            self.assertEqual(len(rv['lines']), 1)
+
+    def test_0040_default_delivery_mode(self):
+        """
+        Test default delivery_mode for saleLine
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            with Transaction().set_context(
+                use_anonymous_customer=True, channel=self.channel.id
+            ):
+                sale, = self.Sale.create([{
+                    'currency': self.usd.id,
+                }])
+
+            self.assertEqual(sale.channel.delivery_mode, 'ship')
+            with Transaction().set_context(
+                company=self.company.id, channel=self.channel.id,
+                current_channel=self.channel.id
+            ):
+                sale_line, = self.SaleLine.create([{
+                    'sale': sale.id,
+                    'product': self.product1.id,
+                    'description': 'test product',
+                    'quantity': 1,
+                    'unit': self.product1.default_uom.id,
+                    'unit_price': Decimal('10'),
+                }])
+                self.assertEqual(
+                    sale_line.delivery_mode, self.channel.delivery_mode
+                )
+
+            with Transaction().set_user(0):
+                with Transaction().set_context(
+                    company=self.company.id, channel=None
+                ):
+                    new_sale_line, = self.SaleLine.create([{
+                        'sale': sale.id,
+                        'product': self.product4.id,
+                        'description': 'test service product',
+                        'quantity': 1,
+                        'unit': self.product4.default_uom.id,
+                        'unit_price': Decimal('10'),
+                    }])
+                    self.assertIsNone(new_sale_line.delivery_mode)
+
+            # Test if sale line's product type is goods
+            self.assertTrue(sale_line.product_type_is_goods)
+            self.assertFalse(new_sale_line.product_type_is_goods)
+
+    def test_0041_pos_thumbnails(self):
+        """
+        Generate the POS thumbnails of the product images and serve them
+        """
+        StaticFolder = POOL.get('nereid.static.folder')
+        StaticFile = POOL.get('nereid.static.file')
+        ProductMedia = POOL.get('product.media')
+
+        image = BytesIO()
+        Image.new('RGBA', (400, 200), (255, 0, 0, 128)).save(image, 'PNG')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            folder, = StaticFolder.create([{
+                'name': 'pos-images',
+                'description': 'POS Images',
+            }])
+            static_file, = StaticFile.create([{
+                'name': 'product.png',
+                'folder': folder.id,
+                'file_binary': buffer(image.getvalue()),
+            }])
+            ProductMedia.create([{
+                'sequence': 1,
+                'product': self.product1.id,
+                'static_file': static_file.id,
+            }])
+            with Transaction().set_context(use_anonymous_customer=True):
+                sale, = self.Sale.create([{
+                    'currency': self.usd.id,
+                }])
+
+            path = tempfile.mkdtemp()
+            if not config.has_section('pos'):
+                config.add_section('pos')
+            config.set('pos', 'thumbnail_path', path)
+            try:
+                with Transaction().set_context(
+                        company=self.company.id, channel=self.channel.id):
+                    rv = sale.pos_add_product([self.product1.id], 1)
+                    product = rv['sale']['lines'][0]['product']
+                    self.assertEqual(product['default_image'], static_file.id)
+                    self.assertIsNone(product['thumbnail'])
+
+                    self.assertEqual(StaticFile.generate_pos_thumbnails(), 1)
+                    self.assertEqual(StaticFile.generate_pos_thumbnails(), 0)
+
+                    rv = self.Sale(sale.id).pos_serialize()
+                    thumbnail = rv['lines'][0]['product']['thumbnail']
+                    self.assertEqual(
+                        thumbnail['key'],
+                        static_file.get_pos_thumbnail_key()
+                    )
+                    self.assertEqual(thumbnail['size'], 128)
+
+                data = StaticFile.get_pos_thumbnail_file(thumbnail['key'])
+                result = Image.open(BytesIO(data[:]))
+                self.assertEqual(result.format, 'JPEG')
+                self.assertEqual(result.size, (128, 64))
+
+                self.assertRaises(
+                    UserError, StaticFile.get_pos_thumbnail_file,
+                    '../%s' % thumbnail['key']
+                )
+                self.assertRaises(
+                    UserError, StaticFile.get_pos_thumbnail_file,
+                    '%s-128-20000101000000.jpg' % static_file.id
+                )
+            finally:
+                config.remove_option('pos', 'thumbnail_path')
+                shutil.rmtree(path)
+
+    def test_0042_pos_columnar_lines(self):
+        """
+        Serialize the lines of a cart in the columnar format
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            products = self._create_products(3)
+
+            with Transaction().set_context(
+                    company=self.company.id, channel=self.channel.id):
+                sale = self._create_cart(products, quantity=2)
+                with Transaction().set_context(delivery_mode='ship'):
+                    sale.pos_add_product([products[0].id], 1)
+                rv = self.Sale(sale.id).pos_serialize()
+                self.assertEqual(len(rv['lines']), 4)
+
+                with Transaction().set_context(pos_line_format='columnar'):
+                    columnar_rv = self.Sale(sale.id).pos_serialize()
+                    table = columnar_rv['lines']
+                    self.assertEqual(table['count'], 4)
+                    self.assertEqual(len(table['products']), 3)
+                    self.assertEqual(len(table['units']), 1)
+                    self.assertEqual(set(table['columns']['unit']), set([0]))
+                    self.assertEqual(
+                        sorted(table['columns']['id']),
+                        sorted(line['id'] for line in rv['lines'])
+                    )
+                    self.assertEqual(decode_lines(table), rv['lines'])
+                    self.assertEqual(
+                        columnar_rv['total_amount'], rv['total_amount']
+                    )
+
+                    line = rv['lines'][0]
+                    rv = sale.pos_add_product([products[1].id], 3)
+                    self.assertEqual(rv['sale']['lines']['count'], 4)
+                    rv = sale.pos_update_lines([{
+                        'id': line['id'], 'quantity': 5,
+                    }])
+                    self.assertEqual(
+                        decode_lines(rv['lines'])[0]['quantity'], 5
+                    )
+
+            self.assertEqual(decode_lines(encode_lines([])), [])
+
+    def test_0043_pos_msgpack_encoding(self):
+        """
+        Pack the responses of the POS RPCs with MessagePack
+        """
+        value = {
+            'amount': Decimal('12.50'),
+            'create_date': datetime.datetime(2015, 6, 1, 10, 20, 30, 500),
+            'sale_date': datetime.date(2015, 6, 1),
+            'lines': [{1: u'caf\xe9', 2: None}],
+        }
+        self.assertEqual(unpack(pack(value)), value)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            products = self._create_products(2)
+
+            with Transaction().set_context(
+                    company=self.company.id, channel=self.channel.id,
+                    current_channel=self.channel.id):
+                sale = self._create_cart(products)
+                rv = self.Sale(sale.id).pos_serialize()
+                recent_sales = self.Sale.get_recent_sales()
+
+                with Transaction().set_context(pos_encoding='msgpack'):
+                    data = self.Sale(sale.id).pos_serialize()
+                    self.assertTrue(isinstance(data, buffer))
+                    self.assertEqual(unpack(data), rv)
+                    self.assertEqual(
+                        unpack(self.Sale.get_recent_sales()), recent_sales
+                    )
+                    self.assertTrue(isinstance(
+                        unpack(self.Sale.get_recent_sales())[0][
+                            'create_date'], datetime.datetime
+                    ))
+
+                    result = unpack(
+                        sale.pos_add_product([products[0].id], 3)
+                    )
+                    self.assertEqual(len(result['sale']['lines']), 2)
+                    self.assertEqual(
+                        result['sale']['total_amount'],
+                        self.Sale(sale.id).total_amount
+                    )
+
+                    with Transaction().set_context(
+                            pos_line_format='columnar'):
+                        result = unpack(self.Sale(sale.id).pos_serialize())
+                        self.assertEqual(result['lines']['count'], 2)
+                        self.assertTrue(isinstance(
+                            result['lines']['columns']['amount'][0], Decimal
+                        ))
+
+    def test_0044_pos_scan_coalescing(self):
+        """
+        Add products with the coalescing of repeated scans enabled
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            with Transaction().set_context(use_anonymous_customer=True):
+                sale, = self.Sale.create([{
+                    'currency': self.usd.id,
+                }])
+
+            if not config.has_section('pos'):
+                config.add_section('pos')
+            config.set('pos', 'scan_coalesce_window', '10')
+            try:
+                with Transaction().set_context(
+                        company=self.company.id, channel=self.channel.id):
+                    rv = sale.pos_add_product([self.product1.id], 1)
+                    line_id, = rv['updated_lines']
+                    rv = self.Sale(sale.id).pos_add_product(
+                        [self.product1.id], 3
+                    )
+                    self.assertEqual(rv['updated_lines'], [line_id])
+                    self.assertEqual(rv['sale']['lines'][0]['quantity'], 3)
+
+                    # Several products are not coalesced
+                    rv = self.Sale(sale.id).pos_add_product(
+                        [self.product1.id, self.product2.id], 2
+                    )
+                    self.assertEqual(len(rv['sale']['lines']), 2)
+            finally:
+                config.remove_option('pos', 'scan_coalesce_window')
+            self.assertFalse(scan_coalescer._batches)
+
+    def test_0120_ship_pick_diff_warehouse(self):
+        """
+        Ensure that backorder_warehouse is used for back orders while orders
+        are picked from the channel's warehouse
+        """
+        Location = POOL.get('stock.location')
+        Channel = POOL.get('sale.channel')
+        Date = POOL.get('ir.date')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            backorder_warehouse, = Location.copy([self.channel.warehouse])
+
+            # Set that as the new backorder warehouse
+            Channel.write([self.channel], {
+                'backorder_warehouse': backorder_warehouse.id}
+            )
+
+            with Transaction().set_context({
+                    'company': self.company.id,
+                    'channel': self.channel.id,
+                    'channels': [self.channel.id], }):
+                # Now create an order
+                sale, = self.Sale.create([{
+                    'reference': 'Test Sale',
+                    'payment_term': self.payment_term,
+                    'currency': self.company.currency.id,
+                    'party': self.party.id,
+                    'invoice_address': self.party.addresses[0].id,
+                    'shipment_address': self.party.addresses[0].id,
+                    'sale_date': Date.today(),
+                    'company': self.company.id,
+
+                    # keep invoicing out of the way for this test's sake
+                    'invoice_method': 'manual',
+                    'shipment_method': 'order',
+
+                    # Explicitly specify the channel
+                    'channel': Channel(self.channel).id,
+                }])
+                line1, = self.SaleLine.create([{
+                    'sale': sale,
+                    'type': 'line',
+                    'quantity': 2,
+                    'delivery_mode': 'pick_up',
+                    'unit': self.uom,
+                    'unit_price': 20000,
+                    'description': 'Picked Item',
+                    'product': self.product1.id
+                }])
+                self.SaleLine.write([line1], line1.on_change_delivery_mode())
+
+                line2, = self.SaleLine.create([{
+                    'sale': sale,
+                    'type': 'line',
+                    'quantity': 2,
+                    'delivery_mode': 'ship',
+                    'unit': self.uom,
+                    'unit_price': 20000,
+                    'description': 'Shipped Item',
+                    'product': self.product1.id
+                }])
+                self.SaleLine.write([line2], line2.on_change_delivery_mode())
+
+                # Quote, Confirm and Process the order
+                self.Sale.quote([sale])
+                self.Sale.confirm([sale])
+                self.Sale.process([sale])
+
+                self.assertEqual(len(sale.shipments), 2)
+                for shipment in sale.shipments:
+                    if shipment.delivery_mode == 'pick_up':
+                        self.assertEqual(shipment.state, 'done')
+                        self.assertEqual(
+                            shipment.warehouse, self.channel.warehouse
+                        )
+                    elif shipment.delivery_mode == 'ship':
+                        self.assertEqual(shipment.state, 'waiting')
+                        self.assertEqual(
+                            shipment.warehouse, self.channel.backorder_warehouse
+                        )
+                    else:
+                        self.fail('Invalid delivery mode')
+
+    def test_1010_delivery_method_2shipping_case_1(self):
+        """
+        Ensure shipment method is respected by sale order processing
+
+        Case 1: Ship only order
+        """
+        Date = POOL.get('ir.date')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            sale, = self.Sale.create([{
+                'reference': 'Test Sale',
+                'payment_term': self.payment_term,
+                'currency': self.company.currency.id,
+                'party': self.party.id,
+                'invoice_address': self.party.addresses[0].id,
+                'shipment_address': self.party.addresses[0].id,
+                'sale_date': Date.today(),
+                'company': self.company.id,
+
+                # keep invoicing out of the way for this test's sake
+                'invoice_method': 'manual',
+                'shipment_method': 'order',
+            }])
+            sale_line, = self.SaleLine.create([{
+                'sale': sale,
+                'type': 'line',
+                'quantity': 2,
+                'delivery_mode': 'ship',
+                'unit': self.uom,
+                'unit_price': 20000,
+                'description': 'Test description',
+                'product': self.product1.id
+            }])
+
+            # Quote, Confirm and Process the order
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+            self.Sale.process([sale])
+
+            self.assertEqual(len(sale.shipments), 1)
+            self.assertEqual(sale.shipments[0].delivery_mode, 'ship')
+            self.assertEqual(sale.shipments[0].state, 'waiting')
+
+    def test_1020_delivery_method_2shipping_case_2(self):
+        """
+        Ensure shipment method is respected by sale order processing
+
+        Case 2: Pick up only order
+        """
+        Date = POOL.get('ir.date')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            sale, = self.Sale.create([{
+                'reference': 'Test Sale',
+                'payment_term': self.payment_term,
+                'currency': self.company.currency.id,
+                'party': self.party.id,
+                'invoice_address': self.party.addresses[0].id,
+                'shipment_address': self.party.addresses[0].id,
+                'sale_date': Date.today(),
+                'company': self.company.id,
+
+                # keep invoicing out of the way for this test's sake
+                'invoice_method': 'manual',
+                'shipment_method': 'order',
+            }])
+            sale_line, = self.SaleLine.create([{
+                'sale': sale,
+                'type': 'line',
+                'quantity': 2,
+                'delivery_mode': 'pick_up',
+                'unit': self.uom,
+                'unit_price': 20000,
+                'description': 'Test description',
+                'product': self.product1.id
+            }])
+
+            # Quote, Confirm and Process the order
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+            self.Sale.process([sale])
+
+            self.assertEqual(len(sale.shipments), 1)
+            self.assertEqual(sale.shipments[0].delivery_mode, 'pick_up')
+            self.assertEqual(sale.shipments[0].state, 'done')
+
+    def test_1030_delivery_method_2shipping_case_3(self):
+        """
+        Ensure shipment method is respected by sale order processing
+
+        Case 2: Pick up + Ship order for same item
+        """
+        Date = POOL.get('ir.date')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            sale, = self.Sale.create([{
+                'reference': 'Test Sale',
+                'payment_term': self.payment_term,
+                'currency': self.company.currency.id,
+                'party': self.party.id,
+                'invoice_address': self.party.addresses[0].id,
+                'shipment_address': self.party.addresses[0].id,
+                'sale_date': Date.today(),
+                'company': self.company.id,
+
+                # keep invoicing out of the way for this test's sake
+                'invoice_method': 'manual',
+                'shipment_method': 'order',
+            }])
+            self.SaleLine.create([{
+                'sale': sale,
+                'type': 'line',
+                'quantity': 2,
+                'delivery_mode': 'pick_up',
+                'unit': self.uom,
+                'unit_price': 20000,
+                'description': 'Picked Item',
+                'product': self.product1.id
+            }, {
+                'sale': sale,
+                'type': 'line',
+                'quantity': 2,
+                'delivery_mode': 'ship',
+                'unit': self.uom,
+                'unit_price': 20000,
+                'description': 'Shipped Item',
+                'product': self.product1.id
+            }])
+
+            # Quote, Confirm and Process the order
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+            self.Sale.process([sale])
+
+            self.assertEqual(len(sale.shipments), 2)
+            for shipment in sale.shipments:
+                if shipment.delivery_mode == 'pick_up':
+                    self.assertEqual(shipment.state, 'done')
+                elif shipment.delivery_mode == 'ship':
+                    self.assertEqual(shipment.state, 'waiting')
+                else:
+                    self.fail('Invalid delivery mode')
+
+    def test_1035_pos_checkout(self):
+        """
+        Checkout a sale from POS in one call
+        """
+        Date = POOL.get('ir.date')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context(company=self.company.id):
+                sale, = self.Sale.create([{
+                    'payment_term': self.payment_term,
+                    'currency': self.company.currency.id,
+                    'party': self.party.id,
+                    'invoice_address': self.party.addresses[0].id,
+                    'shipment_address': self.party.addresses[0].id,
+                    'sale_date': Date.today(),
+                    'company': self.company.id,
+                    'invoice_method': 'shipment',
+                    'shipment_method': 'order',
+                }])
+                self.SaleLine.create([{
+                    'sale': sale,
+                    'type': 'line',
+                    'quantity': 2,
+                    'delivery_mode': 'pick_up',
+                    'unit': self.uom,
+                    'unit_price': Decimal('10'),
+                    'description': 'Picked Item',
+                    'product': self.product1.id
+                }, {
+                    'sale': sale,
+                    'type': 'line',
+                    'quantity': 1,
+                    'delivery_mode': 'ship',
+                    'unit': self.uom,
+                    'unit_price': Decimal('10'),
+                    'description': 'Shipped Item',
+                    'product': self.product1.id
+                }])
+
+                rv = sale.pos_checkout()
+
+            sale = self.Sale(sale.id)
+            self.assertEqual(sale.state, 'processing')
+            self.assertEqual(rv['sale']['state'], 'processing')
+            self.assertEqual(rv['sale']['total_amount'], Decimal('30'))
+            self.assertEqual(
+                sorted(rv['shipments']), sorted(map(int, sale.shipments))
+            )
+            self.assertEqual(len(rv['shipments']), 2)
+            self.assertEqual(rv['shipment_returns'], [])
+            for shipment in sale.shipments:
+                if shipment.delivery_mode == 'pick_up':
+                    self.assertEqual(shipment.state, 'done')
+                else:
+                    self.assertEqual(shipment.state, 'waiting')
+            invoice, = self.Invoice.browse(rv['invoices'])
+            self.assertEqual(invoice.state, 'posted')
+            self.assertEqual(invoice.total_amount, Decimal('20'))
+
+    def test_1036_pos_sales_to_process(self):
+        """
+        Select the sales of the end of shift processing
+        """
+        Date = POOL.get('ir.date')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            today = Date.today()
+
+            with Transaction().set_context(company=self.company.id):
+                values = {
+                    'payment_term': self.payment_term,
+                    'currency': self.company.currency.id,
+                    'party': self.party.id,
+                    'invoice_address': self.party.addresses[0].id,
+                    'shipment_address': self.party.addresses[0].id,
+                    'company': self.company.id,
+                }
+                dated, undated, yesterday, other = self.Sale.create([
+                    dict(values, channel=self.channel.id, sale_date=today),
+                    dict(values, channel=self.channel.id, sale_date=None),
+                    dict(
+                        values, channel=self.channel.id,
+                        sale_date=today - relativedelta(days=1)
+                    ),
+                    dict(values, channel=self.channel1.id, sale_date=today),
+                ])
+
+                self.assertEqual(
+                    self.Channel._pos_sales_to_process(
+                        [self.channel], today, today
+                    ), [dated, undated]
+                )
+                self.assertEqual(
+                    self.Channel._pos_sales_to_process(
+                        [self.channel, self.channel1],
+                        today - relativedelta(days=1), today
+                    ), [dated, undated, yesterday, other]
+                )
+
+                # Nothing to process
+                self.assertEqual(
+                    self.Channel.pos_process_sales(
+                        [self.channel1], today - relativedelta(days=1),
+                        today - relativedelta(days=1)
+                    ), {'processed': [], 'failed': []}
+                )
+
+    def test_1046_pos_batch_chunks(self):
+        """
+        Process ids in chunks, recording the failures without aborting the
+        batch
+        """
+        calls = []
+
+        def process(id_):
+            calls.append(id_)
+            if id_ == 2:
+                raise UserError('Failed %s' % id_)
+
+        def fail_commit(id_):
+            def commit():
+                raise ValueError('Commit failed')
+            Transaction().cursor.commit = commit
+
+        # The chunk is retried without the failed id
+        self.assertEqual(
+            batch._process_chunk(DB_NAME, USER, CONTEXT, process, [1, 2, 3]),
+            ([1, 3], [(2, 'Failed 2')])
+        )
+        self.assertEqual(calls, [1, 2, 1, 3])
+
+        # A failed commit is recorded for all the ids of the chunk
+        self.assertEqual(
+            batch._process_chunk(DB_NAME, USER, CONTEXT, fail_commit, [4, 5]),
+            ([], [
+                (4, "ValueError('Commit failed',)"),
+                (5, "ValueError('Commit failed',)"),
+            ])
+        )
+
+        # An operational error retries the chunk instead of failing the id
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        del calls[:]
+
+        def conflict(id_):
+            calls.append(id_)
+            if len(calls) == 2:
+                raise DatabaseOperationalError('could not serialize access')
+
+        self.assertEqual(
+            batch._process_chunk(DB_NAME, USER, CONTEXT, conflict, [6, 7]),
+            ([6, 7], [])
+        )
+        self.assertEqual(calls, [6, 7, 6, 7])
+
+        # Until the retries are exhausted
+        del calls[:]
+
+        def locked(id_):
+            calls.append(id_)
+            raise DatabaseOperationalError('database is locked')
+
+        self.assertEqual(
+            batch._process_chunk(DB_NAME, USER, CONTEXT, locked, [8, 9]),
+            ([], [
+                (8, "OperationalError('database is locked',)"),
+                (9, "OperationalError('database is locked',)"),
+            ])
+        )
+        self.assertEqual(
+            calls, [8] * (config.getint('database', 'retry') + 1)
+        )
+
+        if DB_NAME == ':memory:':
+            # The workers have a memory database of their own
+            return
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.assertEqual(
+                batch.process_in_chunks(
+                    [1, 2, 3, 4, 5], process, chunk_size=2
+                ), ([1, 3, 4, 5], [(2, 'Failed 2')])
+            )
+
+    def test_1037_pos_sales_summary(self):
+        """
+        Summarize the sales of a channel for the end of day
+        """
+        Date = POOL.get('ir.date')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            today = Date.today()
+
+            with Transaction().set_context(company=self.company.id):
+                sale, draft = self.Sale.create([{
+                    'payment_term': self.payment_term,
+                    'currency': self.company.currency.id,
+                    'party': self.party.id,
+                    'invoice_address': self.party.addresses[0].id,
+                    'shipment_address': self.party.addresses[0].id,
+                    'sale_date': today,
+                    'company': self.company.id,
+                    'channel': self.channel.id,
+                    'invoice_method': 'shipment',
+                    'shipment_method': 'order',
+                } for i in range(2)])
+                self.SaleLine.create([{
+                    'sale': record,
+                    'type': 'line',
+                    'quantity': 2,
+                    'delivery_mode': 'pick_up',
+                    'unit': self.uom,
+                    'unit_price': Decimal('10'),
+                    'description': 'Picked Item',
+                    'product': self.product1.id
+                } for record in (sale, draft)] + [{
+                    'sale': sale,
+                    'type': 'line',
+                    'quantity': 1,
+                    'delivery_mode': 'ship',
+                    'unit': self.uom,
+                    'unit_price': Decimal('10'),
+                    'description': 'Shipped Item',
+                    'product': self.product1.id
+                }])
+                sale.pos_checkout()
 
-    def test_1020_delivery_method_2shipping_case_2(self):
-        """
-        Ensure shipment method is respected by sale order processing
+                summary, other = self.Channel.pos_sales_summary(
+                    [self.channel, self.channel1], today, today
+                )
 
-        Case 2: Pick up only order
+            self.assertEqual(summary['channel'], self.channel.id)
+            self.assertEqual(summary['sales'], 1)
+            self.assertEqual(summary['total_amount'], Decimal('30'))
+            self.assertEqual(summary['untaxed_amount'], Decimal('30'))
+            self.assertEqual(summary['tax_amount'], Decimal('0'))
+
+            lines = dict(
+                ((group['delivery_mode'], group['is_round_off']), group)
+                for group in summary['lines']
+            )
+            self.assertEqual(lines[('pick_up', False)]['lines'], 1)
+            self.assertEqual(lines[('pick_up', False)]['quantity'], 2)
+            self.assertEqual(
+                lines[('pick_up', False)]['amount'], Decimal('20')
+            )
+            self.assertEqual(lines[('pick_up', False)]['return_lines'], 0)
+            self.assertEqual(
+                lines[('ship', False)]['amount'], Decimal('10')
+            )
+            self.assertEqual(
+                sum(group['amount'] for group in summary['lines']),
+                summary['total_amount']
+            )
+
+            self.assertEqual(other['channel'], self.channel1.id)
+            self.assertEqual(other['sales'], 0)
+            self.assertEqual(other['lines'], [])
+
+    def test_1038_pos_daily_summary(self):
+        """
+        Maintain the daily summary of the channels
         """
         Date = POOL.get('ir.date')
+        DailySummary = POOL.get('sale.channel.daily_summary')
+
+        def read_summary():
+            return dict(
+                (row.delivery_mode, (
+                    row.sales, row.lines, row.quantity, row.amount,
+                    row.round_off_amount
+                )) for row in DailySummary.search([
+                    ('channel', '=', self.channel.id),
+                    ('day', '=', Date.today()),
+                ])
+            )
 
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
             self.setup_defaults()
 
-            sale, = self.Sale.create([{
-                'reference': 'Test Sale',
-                'payment_term': self.payment_term,
-                'currency': self.company.currency.id,
-                'party': self.party.id,
-                'invoice_address': self.party.addresses[0].id,
-                'shipment_address': self.party.addresses[0].id,
-                'sale_date': Date.today(),
-                'company': self.company.id,
-
-                # keep invoicing out of the way for this test's sake
-                'invoice_method': 'manual',
-                'shipment_method': 'order',
-            }])
-            sale_line, = self.SaleLine.create([{
-                'sale': sale,
-                'type': 'line',
-                'quantity': 2,
-                'delivery_mode': 'pick_up',
-                'unit': self.uom,
-                'unit_price': 20000,
-                'description': 'Test description',
-                'product': self.product1.id
-            }])
+            with Transaction().set_context(company=self.company.id):
+                sales = self.Sale.create([{
+                    'payment_term': self.payment_term,
+                    'currency': self.company.currency.id,
+                    'party': self.party.id,
+                    'invoice_address': self.party.addresses[0].id,
+                    'shipment_address': self.party.addresses[0].id,
+                    'sale_date': Date.today(),
+                    'company': self.company.id,
+                    'channel': self.channel.id,
+                    'invoice_method': 'shipment',
+                    'shipment_method': 'order',
+                } for i in range(2)])
+                self.SaleLine.create(sum([[{
+                    'sale': sale,
+                    'type': 'line',
+                    'quantity': 2,
+                    'delivery_mode': 'pick_up',
+                    'unit': self.uom,
+                    'unit_price': Decimal('10'),
+                    'description': 'Picked Item',
+                    'product': self.product1.id
+                }, {
+                    'sale': sale,
+                    'type': 'line',
+                    'quantity': 1,
+                    'delivery_mode': 'ship',
+                    'unit': self.uom,
+                    'unit_price': Decimal('10'),
+                    'description': 'Shipped Item',
+                    'product': self.product1.id
+                }] for sale in sales], []))
+
+                sales[0].pos_checkout()
+                self.assertEqual(read_summary(), {
+                    'pick_up': (1, 1, 2, Decimal('20'), Decimal('0')),
+                    'ship': (1, 1, 1, Decimal('10'), Decimal('0')),
+                })
+
+                # Processing the sale again does not add it twice
+                self.Sale.process([sales[0]])
+                sales[1].pos_checkout()
+                self.assertEqual(read_summary(), {
+                    'pick_up': (2, 2, 4, Decimal('40'), Decimal('0')),
+                    'ship': (2, 2, 2, Decimal('20'), Decimal('0')),
+                })
+
+                self.SaleLine.create([{
+                    'sale': sales[1],
+                    'type': 'line',
+                    'is_round_off': True,
+                    'quantity': -1,
+                    'delivery_mode': 'pick_up',
+                    'unit_price': Decimal('0.5'),
+                    'description': 'Round Off',
+                }])
+                expected = {
+                    'pick_up': (2, 3, 3, Decimal('40'), Decimal('-0.5')),
+                    'ship': (2, 2, 2, Decimal('20'), Decimal('0')),
+                }
+                self.assertEqual(read_summary(), expected)
 
-            # Quote, Confirm and Process the order
-            self.Sale.quote([sale])
-            self.Sale.confirm([sale])
-            self.Sale.process([sale])
+                DailySummary.rebuild()
+                self.assertEqual(read_summary(), expected)
 
-            self.assertEqual(len(sale.shipments), 1)
-            self.assertEqual(sale.shipments[0].delivery_mode, 'pick_up')
-            self.assertEqual(sale.shipments[0].state, 'done')
+                DailySummary.rebuild([self.channel], end_date=Date.today())
+                self.assertEqual(read_summary(), expected)
 
-    def test_1030_delivery_method_2shipping_case_3(self):
+    def test_1045_pos_daily_summary_round_off(self):
         """
-        Ensure shipment method is respected by sale order processing
+        Add the round off lines without delivery mode of the checked out
+        carts to a single row of the daily summary
+        """
+        Date = POOL.get('ir.date')
+        DailySummary = POOL.get('sale.channel.daily_summary')
 
-        Case 2: Pick up + Ship order for same item
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            products = self._create_products(1, list_price=Decimal('10.25'))
+            self._create_stock(products, 10)
+            self.SaleConfiguration.create([{
+                'round_down_account': self._get_account_by_kind('revenue').id,
+            }])
+
+            with Transaction().set_context(
+                    company=self.company.id, channel=self.channel.id):
+                for _ in xrange(2):
+                    sale = self._create_cart(
+                        products, shipment_method='order'
+                    )
+                    sale.pos_checkout()
+                    round_off_line, = self.SaleLine.search([
+                        ('sale', '=', sale.id),
+                        ('is_round_off', '=', True),
+                    ])
+                    self.assertIsNone(round_off_line.delivery_mode)
+
+            rows = DailySummary.search([
+                ('channel', '=', self.channel.id),
+                ('day', '=', Date.today()),
+                ('delivery_mode', '=', None),
+            ])
+            self.assertEqual(len(rows), 1)
+            self.assertEqual(rows[0].lines, 2)
+            self.assertEqual(rows[0].sales, 0)
+            self.assertEqual(rows[0].round_off_amount, Decimal('-0.5'))
+
+    def test_1048_pos_daily_summary_sub_cent(self):
+        """
+        Round the amount of each line in the daily summary, incrementally
+        and when rebuilt, and in the end of day summary of the channel, like
+        the amounts of the sale
         """
         Date = POOL.get('ir.date')
+        DailySummary = POOL.get('sale.channel.daily_summary')
 
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
             self.setup_defaults()
 
-            sale, = self.Sale.create([{
-                'reference': 'Test Sale',
-                'payment_term': self.payment_term,
-                'currency': self.company.currency.id,
-                'party': self.party.id,
-                'invoice_address': self.party.addresses[0].id,
-                'shipment_address': self.party.addresses[0].id,
-                'sale_date': Date.today(),
-                'company': self.company.id,
+            with Transaction().set_context(company=self.company.id):
+                sale, = self.Sale.create([{
+                    'payment_term': self.payment_term,
+                    'currency': self.company.currency.id,
+                    'party': self.party.id,
+                    'invoice_address': self.party.addresses[0].id,
+                    'shipment_address': self.party.addresses[0].id,
+                    'sale_date': Date.today(),
+                    'company': self.company.id,
+                    'channel': self.channel.id,
+                    'invoice_method': 'shipment',
+                    'shipment_method': 'order',
+                }])
+                self.SaleLine.create([{
+                    'sale': sale,
+                    'type': 'line',
+                    'quantity': 1,
+                    'delivery_mode': 'pick_up',
+                    'unit': self.uom,
+                    'unit_price': unit_price,
+                    'description': 'Item',
+                    'product': self.product1.id
+                } for unit_price in [Decimal('0.3330')] * 3 + [
+                    Decimal('0.3340')
+                ]])
+                self.Sale.quote([sale])
+                self.Sale.confirm([sale])
+                self.Sale.process([sale])
+                self.assertEqual(
+                    self.Sale(sale.id).untaxed_amount, Decimal('1.32')
+                )
 
-                # keep invoicing out of the way for this test's sake
-                'invoice_method': 'manual',
-                'shipment_method': 'order',
-            }])
-            self.SaleLine.create([{
-                'sale': sale,
-                'type': 'line',
-                'quantity': 2,
-                'delivery_mode': 'pick_up',
-                'unit': self.uom,
-                'unit_price': 20000,
-                'description': 'Picked Item',
-                'product': self.product1.id
-            }, {
-                'sale': sale,
-                'type': 'line',
-                'quantity': 2,
-                'delivery_mode': 'ship',
-                'unit': self.uom,
-                'unit_price': 20000,
-                'description': 'Shipped Item',
-                'product': self.product1.id
-            }])
+                def read_amount():
+                    row, = DailySummary.search([
+                        ('channel', '=', self.channel.id),
+                        ('day', '=', Date.today()),
+                    ])
+                    return row.lines, row.amount
 
-            # Quote, Confirm and Process the order
-            self.Sale.quote([sale])
-            self.Sale.confirm([sale])
-            self.Sale.process([sale])
+                self.assertEqual(read_amount(), (4, Decimal('1.32')))
+                DailySummary.rebuild([self.channel])
+                self.assertEqual(read_amount(), (4, Decimal('1.32')))
 
-            self.assertEqual(len(sale.shipments), 2)
-            for shipment in sale.shipments:
-                if shipment.delivery_mode == 'pick_up':
-                    self.assertEqual(shipment.state, 'done')
-                elif shipment.delivery_mode == 'ship':
-                    self.assertEqual(shipment.state, 'waiting')
-                else:
-                    self.fail('Invalid delivery mode')
+                summary, = self.Channel.pos_sales_summary(
+                    [self.channel], Date.today(), Date.today()
+                )
+                self.assertEqual(summary['untaxed_amount'], Decimal('1.32'))
+                group, = summary['lines']
+                self.assertEqual(
+                    (group['lines'], group['quantity'], group['amount']),
+                    (4, 4, Decimal('1.32'))
+                )
+
+    def test_1039_pos_abandoned_carts(self):
+        """
+        Find the draft sales which were not changed for a while
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context(company=self.company.id):
+                abandoned, recent, recent_line, other = self.Sale.create([{
+                    'payment_term': self.payment_term,
+                    'currency': self.company.currency.id,
+                    'party': self.party.id,
+                    'invoice_address': self.party.addresses[0].id,
+                    'shipment_address': self.party.addresses[0].id,
+                    'company': self.company.id,
+                    'channel': channel.id,
+                } for channel in [self.channel] * 3 + [self.channel1]])
+                self.SaleLine.create([{
+                    'sale': sale,
+                    'type': 'line',
+                    'quantity': 1,
+                    'delivery_mode': 'pick_up',
+                    'unit': self.uom,
+                    'unit_price': Decimal('10'),
+                    'description': 'Item',
+                    'product': self.product1.id
+                } for sale in (abandoned, recent_line)])
+
+                # Age the sales and the line of the abandoned one
+                old = datetime.datetime.now() - relativedelta(days=10)
+                sale_table = self.Sale.__table__()
+                line_table = self.SaleLine.__table__()
+                cursor = Transaction().cursor
+                cursor.execute(*sale_table.update(
+                    [sale_table.create_date], [old],
+                    where=sale_table.id.in_(
+                        [abandoned.id, recent_line.id, other.id]
+                    )
+                ))
+                cursor.execute(*line_table.update(
+                    [line_table.create_date], [old],
+                    where=line_table.sale == abandoned.id
+                ))
+
+                date = datetime.datetime.now() - relativedelta(days=7)
+                self.assertEqual(
+                    self.channel._pos_abandoned_carts(date), [abandoned.id]
+                )
+                self.assertEqual(
+                    self.channel1._pos_abandoned_carts(date), [other.id]
+                )
+
+                self.Sale.quote([abandoned])
+                self.assertEqual(self.channel._pos_abandoned_carts(date), [])
+
+                # The abandoned sales are cancelled or deleted
+                self.Channel._pos_cleanup_abandoned_cart('cancel', other.id)
+                self.assertEqual(self.Sale(other.id).state, 'cancel')
+                self.Channel._pos_cleanup_abandoned_cart('delete', other.id)
+                self.assertFalse(self.Sale.search([('id', '=', other.id)]))
+
+                if not config.has_section('pos'):
+                    config.add_section('pos')
+                config.set('pos', 'abandoned_cart_action', 'archive')
+                try:
+                    with self.assertRaises(UserError):
+                        self.channel.cleanup_abandoned_carts()
+                finally:
+                    config.remove_option('pos', 'abandoned_cart_action')
+                self.assertEqual(self.channel.cleanup_abandoned_carts(), 0)
+
+    @unittest.skipIf(
+        DB_NAME == ':memory:', 'The batches need a database shared by threads'
+    )
+    def test_1047_pos_cleanup_abandoned_carts(self):
+        """
+        Cancel or delete the abandoned carts of a channel by batches
+        """
+        committed = []
+
+        with Transaction().start(
+                DB_NAME, USER, context=CONTEXT) as transaction:
+            self.setup_defaults()
+            context = dict(CONTEXT, company=self.company.id)
+
+            def abandoned_carts(count):
+                carts = [
+                    self._create_cart([self.product1]) for _ in xrange(count)
+                ]
+                sale_table = self.Sale.__table__()
+                line_table = self.SaleLine.__table__()
+                old = datetime.datetime.now() - relativedelta(days=10)
+                cursor = transaction.cursor
+                cursor.execute(*sale_table.update(
+                    [sale_table.create_date], [old],
+                    where=sale_table.id.in_(map(int, carts))
+                ))
+                cursor.execute(*line_table.update(
+                    [line_table.create_date], [old],
+                    where=line_table.sale.in_(map(int, carts))
+                ))
+                # The batches only see committed sales
+                cursor.commit()
+                committed.extend(map(int, carts))
+                return map(int, carts)
+
+            if not config.has_section('pos'):
+                config.add_section('pos')
+            config.set('pos', 'abandoned_cart_batch_size', '2')
+            try:
+                with Transaction().set_context(context):
+                    carts = abandoned_carts(3)
+                    self.assertEqual(
+                        self.channel.cleanup_abandoned_carts(), 3
+                    )
+                    self.assertEqual(
+                        set(s.state for s in self.Sale.browse(carts)),
+                        set(['cancel'])
+                    )
+
+                    carts = abandoned_carts(2)
+                    config.set('pos', 'abandoned_cart_action', 'delete')
+                    self.assertEqual(
+                        self.channel.cleanup_abandoned_carts(), 2
+                    )
+                    self.assertFalse(
+                        self.Sale.search([('id', 'in', carts)])
+                    )
+            finally:
+                config.remove_option('pos', 'abandoned_cart_batch_size')
+                config.remove_option('pos', 'abandoned_cart_action')
+                transaction.cursor.rollback()
+                with Transaction().set_context(context):
+                    self.Sale.delete(
+                        self.Sale.search([('id', 'in', committed)])
+                    )
+                transaction.cursor.commit()
 
     def test_1040_delivery_method_2shipping_case_4(self):
         """
@@ -958,6 +2644,239 @@ class TestSale(unittest.TestCase):
             self.Sale.process([sale])
             self.assertEqual(len(sale.shipments), 0)
 
+    def test_1041_pos_lock(self):
+        """
+        Lock the sale before changing its cart
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            with Transaction().set_context(
+                    company=self.company.id, channel=self.channel.id):
+                sale = self._create_cart([self.product1])
+                self.assertEqual(sale.pos_revision, None)
+
+                sale.pos_add_product([self.product2.id], 1)
+                self.assertEqual(self.Sale(sale.id).pos_revision, 1)
+
+                self.Sale(sale.id).pos_update_lines([{
+                    'id': sale.lines[0].id, 'quantity': 3,
+                }])
+                self.assertEqual(self.Sale(sale.id).pos_revision, 2)
+
+                # Reading the cart does not lock it
+                self.Sale(sale.id).pos_serialize()
+                self.assertEqual(self.Sale(sale.id).pos_revision, 2)
+
+    @unittest.skipIf(
+        DB_NAME == ':memory:', 'The terminals need a database shared by threads'
+    )
+    def test_1042_pos_concurrent_adds(self):
+        """
+        Terminals adding the same products to a sale at the same time
+        """
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        terminals, scans = 4, 10
+
+        with Transaction().start(
+                DB_NAME, USER, context=CONTEXT) as transaction:
+            self.setup_defaults()
+            context = dict(
+                CONTEXT, company=self.company.id, channel=self.channel.id
+            )
+            with Transaction().set_context(context):
+                sale = self._create_cart([])
+            products = [self.product1.id, self.product2.id]
+            transaction.cursor.commit()
+
+        errors = []
+
+        def terminal(number):
+            retries = config.getint('database', 'retry')
+            for scan in xrange(scans):
+                for count in xrange(retries, -1, -1):
+                    with Transaction().start(
+                            DB_NAME, USER, context=context) as transaction:
+                        try:
+                            self.Sale(sale.id).pos_add_product(
+                                [products[scan % 2]], number
+                            )
+                            transaction.cursor.commit()
+                        except DatabaseOperationalError:
+                            transaction.cursor.rollback()
+                            if count:
+                                continue
+                            raise
+                    break
+
+        def run(number):
+            try:
+                terminal(number)
+            except Exception, exception:
+                errors.append(exception)
+
+        threads = [
+            threading.Thread(target=run, args=(number,))
+            for number in xrange(1, terminals + 1)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        with Transaction().start(
+                DB_NAME, USER, context=CONTEXT) as transaction:
+            try:
+                self.assertEqual(errors, [])
+                sale = self.Sale(sale.id)
+                # The scans of a product were merged in one line with the
+                # quantity of the last one
+                self.assertEqual(
+                    sorted(line.product.id for line in sale.lines), products
+                )
+                for line in sale.lines:
+                    self.assertIn(line.quantity, range(1, terminals + 1))
+                self.assertEqual(sale.pos_revision, terminals * scans)
+            finally:
+                self.Sale.delete([sale])
+                transaction.cursor.commit()
+
+    def test_1043_pos_read_replica(self):
+        """
+        Fall back to the database when the replica is behind or missing
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            with Transaction().set_context(
+                    company=self.company.id, channel=self.channel.id,
+                    current_channel=self.channel.id):
+                sale = self._create_cart([self.product1])
+                revision = sale.pos_add_product(
+                    [self.product2.id], 1
+                )['sale']['revision']
+                self.assertEqual(revision, 1)
+
+                cursor = Transaction().cursor
+                self.assertTrue(replica.is_fresh(cursor, None))
+                self.assertTrue(replica.is_fresh(cursor, [sale.id, revision]))
+                self.assertFalse(
+                    replica.is_fresh(cursor, [sale.id, revision + 1])
+                )
+                self.assertFalse(replica.is_fresh(cursor, [-1, 0]))
+                if DB_NAME == ':memory:':
+                    self.assertEqual(replica.replica_lag(cursor), 0)
+
+                if not config.has_section('pos'):
+                    config.add_section('pos')
+                config.set('pos', 'replica_database', 'pos_missing_replica')
+                try:
+                    self.assertEqual(
+                        len(self.Sale(sale.id).pos_serialize()['lines']), 2
+                    )
+                    self.assertEqual(
+                        [s['id'] for s in self.Sale.get_recent_sales()],
+                        [sale.id, sale.id]
+                    )
+                finally:
+                    config.remove_option('pos', 'replica_database')
+                    replica._lags.clear()
+
+    @unittest.skipIf(
+        backend.name() != 'postgresql',
+        'The replica is another PostgreSQL database'
+    )
+    def test_1049_pos_replica_lag(self):
+        """
+        Measure the lag of a PostgreSQL database which is not a standby by
+        the sales it does not have
+        """
+        with Transaction().start(
+                DB_NAME, USER, context=CONTEXT) as transaction:
+            self.setup_defaults()
+            primary = transaction.cursor
+            self.assertEqual(replica.replica_lag(primary, primary), 0)
+
+            with Transaction().set_context(
+                    company=self.company.id, channel=self.channel.id):
+                sale = self._create_cart([self.product1])
+            table = self.Sale.__table__()
+            primary.execute(*table.update(
+                [table.create_date],
+                [table.create_date - datetime.timedelta(hours=1)],
+                where=table.id == sale.id
+            ))
+
+            # Another connection does not see the uncommitted sale
+            other = backend.get('Database')(DB_NAME).connect().cursor()
+            try:
+                self.assertIsNone(replica.replica_lag(other))
+                lag = replica.replica_lag(other, primary)
+                self.assertTrue(3600 <= lag < 3660, lag)
+            finally:
+                other.close()
+
+    @unittest.skipIf(
+        backend.name() != 'sqlite' or DB_NAME == ':memory:',
+        'The replica is a copy of a SQLite file'
+    )
+    def test_1044_pos_read_replica_copy(self):
+        """
+        Read the carts from a copy of the database
+        """
+        path = config.get('database', 'path')
+        replica_name = DB_NAME + '_replica'
+
+        with Transaction().start(
+                DB_NAME, USER, context=CONTEXT) as transaction:
+            self.setup_defaults()
+            context = dict(
+                CONTEXT, company=self.company.id, channel=self.channel.id
+            )
+            with Transaction().set_context(context):
+                sale = self._create_cart([self.product1])
+            transaction.cursor.commit()
+        shutil.copy(
+            os.path.join(path, DB_NAME + '.sqlite'),
+            os.path.join(path, replica_name + '.sqlite')
+        )
+
+        if not config.has_section('pos'):
+            config.add_section('pos')
+        config.set('pos', 'replica_database', replica_name)
+        config.set('pos', 'replica_max_lag', '60')
+        try:
+            with Transaction().start(
+                    DB_NAME, USER, context=context) as transaction:
+                revision = self.Sale(sale.id).pos_add_product(
+                    [self.product2.id], 1
+                )['sale']['revision']
+                transaction.cursor.commit()
+
+            with Transaction().start(DB_NAME, USER, context=context):
+                # The copy does not have the new line
+                rv = self.Sale(sale.id).pos_serialize()
+                self.assertEqual(len(rv['lines']), 1)
+                self.assertEqual(rv['revision'], 0)
+
+                # Unless the client wrote it
+                with Transaction().set_context(
+                        pos_last_write=[sale.id, revision]):
+                    rv = self.Sale(sale.id).pos_serialize()
+                self.assertEqual(len(rv['lines']), 2)
+
+                # Or the copy is too old
+                config.set('pos', 'replica_max_lag', '0')
+                rv = self.Sale(sale.id).pos_serialize()
+                self.assertEqual(len(rv['lines']), 2)
+        finally:
+            config.remove_option('pos', 'replica_database')
+            config.remove_option('pos', 'replica_max_lag')
+            replica._lags.clear()
+            os.remove(os.path.join(path, replica_name + '.sqlite'))
+            with Transaction().start(
+                    DB_NAME, USER, context=CONTEXT) as transaction:
+                self.Sale.delete([self.Sale(sale.id)])
+                transaction.cursor.commit()
+
     def test_1050_delivery_method_2shipping_case_5(self):
         """
         Return Shipment
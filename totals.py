@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+    totals.py
+
+"""
+from decimal import Decimal
+from collections import defaultdict
+
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+__all__ = ['compute_totals']
+
+_ZERO = Decimal('0.0')
+
+
+def _unit_taxes(tax_ids, unit_price, date):
+    """
+    Return the taxes of a unit at the price, as computed by account.tax,
+    as a list of (invoice tax key, amount).
+    """
+    pool = Pool()
+    Tax = pool.get('account.tax')
+    Invoice = pool.get('account.invoice')
+
+    taxes = Tax.sort_taxes(Tax.browse(tax_ids))
+    result = []
+    for tax in Tax._unit_compute(taxes, unit_price, date):
+        key, value = Invoice._compute_tax(tax, 'out_invoice')
+        result.append((key, value['amount']))
+    return result
+
+
+def compute_totals(sales):
+    """
+    Return a dictionary of sale id to the (untaxed amount, tax amount,
+    total amount) of the sale, computed from its lines like the amounts of
+    the sale and with the same rounding, but for all the sales at once.
+
+    The quantity, unit price and taxes of the lines are read with one query
+    each and the taxes of a unit are computed once per set of taxes and unit
+    price: account.tax computes the taxes of a line as the taxes of a unit
+    multiplied by the quantity.
+    """
+    pool = Pool()
+    SaleLine = pool.get('sale.line')
+    LineTax = pool.get('sale.line-account.tax')
+    Configuration = pool.get('account.configuration')
+    Date = pool.get('ir.date')
+
+    sale_ids = map(int, sales)
+    totals = {}
+    if not sale_ids:
+        return totals
+
+    tax_rounding = Configuration(1).tax_rounding
+    date = Date.today()
+    currencies = dict((sale.id, sale.currency) for sale in sales)
+    cursor = Transaction().cursor
+
+    # The lines are processed in the order of the sale lines as the
+    # rounding of the taxes per line depends on it
+    line_ids = map(int, SaleLine.search([
+        ('sale', 'in', sale_ids),
+        ('type', '=', 'line'),
+    ]))
+    values = {}
+    line_taxes = defaultdict(list)
+    line = SaleLine.__table__()
+    line_tax = LineTax.__table__()
+    for sub_ids in (
+            line_ids[i:i + cursor.IN_MAX]
+            for i in xrange(0, len(line_ids), cursor.IN_MAX)):
+        cursor.execute(*line.select(
+            line.id, line.sale, line.quantity, line.unit_price,
+            where=line.id.in_(sub_ids)
+        ))
+        for line_id, sale_id, quantity, unit_price in cursor.fetchall():
+            values[line_id] = (sale_id, quantity, unit_price)
+        cursor.execute(*line_tax.select(
+            line_tax.line, line_tax.tax,
+            where=line_tax.line.in_(sub_ids)
+        ))
+        for line_id, tax_id in cursor.fetchall():
+            line_taxes[line_id].append(tax_id)
+
+    untaxed_amounts = dict((sale_id, _ZERO) for sale_id in sale_ids)
+    sale_taxes = dict((sale_id, {}) for sale_id in sale_ids)
+    unit_taxes = {}
+    for line_id in line_ids:
+        sale_id, quantity, unit_price = values[line_id]
+        currency = currencies[sale_id]
+        quantity = Decimal(str(quantity or 0.0))
+        if unit_price is not None and not isinstance(unit_price, Decimal):
+            unit_price = Decimal(str(unit_price))
+
+        # Like sale.line amount
+        untaxed_amounts[sale_id] += currency.round(
+            quantity * (unit_price or _ZERO)
+        )
+
+        # Like sale.sale get_tax_amount
+        key = (tuple(sorted(line_taxes[line_id])), unit_price)
+        if key not in unit_taxes:
+            unit_taxes[key] = _unit_taxes(key[0], unit_price, date)
+        taxes = sale_taxes[sale_id]
+        for tax_key, amount in unit_taxes[key]:
+            taxes[tax_key] = taxes.get(tax_key, _ZERO) + amount * quantity
+        if tax_rounding == 'line':
+            for tax_key, amount in taxes.iteritems():
+                taxes[tax_key] = currency.round(amount)
+
+    for sale_id in sale_ids:
+        taxes = sale_taxes[sale_id]
+        if tax_rounding == 'document':
+            currency = currencies[sale_id]
+            for tax_key, amount in taxes.iteritems():
+                taxes[tax_key] = currency.round(amount)
+        tax_amount = sum(taxes.itervalues(), _ZERO)
+        totals[sale_id] = (
+            untaxed_amounts[sale_id], tax_amount,
+            untaxed_amounts[sale_id] + tax_amount
+        )
+    return totals